@@ -12,13 +12,58 @@
 
 from __future__ import print_function
 import argparse
+import binascii
 import collections
+import contextlib
+import cProfile
 import errno
+import hashlib
+import hmac
+import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import pstats
 import re
+import select
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 ###############################################################
 # Configuration values, no corresponding command-line args
@@ -28,6 +73,129 @@ import sys
 # of the binary if the script cannot find it automatically.
 HANDBRAKE_EXE = "HandBrakeCLI"
 
+# The maximum number of entries to keep in the scan cache (see
+# "--scan-cache" below). When this is exceeded, the least
+# recently used entries are evicted.
+SCAN_CACHE_MAX_ENTRIES = 100000
+
+# The maximum number of seconds between commits of new scan cache
+# entries, so that a run that is killed or crashes keeps most of
+# the scans it did
+SCAN_CACHE_COMMIT_INTERVAL = 10
+
+# Name of the journal file that is kept in the output directory
+# while a conversion is running. It records the state of each
+# video and the tracks that were selected for it, so that an
+# interrupted run can be resumed with "--resume". A new run without
+# "--resume" moves an existing journal aside to a file ending in
+# ".old" instead. Once a run completes, the journal is deleted and
+# the videos that failed to convert are listed in a file ending in
+# "-failed" next to it.
+JOURNAL_FILE_NAME = ".aniconvert-journal"
+
+# Name of the manifest file that is kept in the output directory
+# (see "--no-manifest" below)
+MANIFEST_FILE_NAME = ".aniconvert-manifest.json"
+
+# The minimum number of seconds between writes of the manifest.
+# Videos converted in between are written together, and whatever
+# is left is written once the run is over.
+MANIFEST_WRITE_INTERVAL = 30
+
+# The minimum number of seconds between updates of the
+# Prometheus metrics file (see "--metrics-prom" below)
+METRICS_WRITE_INTERVAL = 5
+
+# The number of most recent videos to list individually in the
+# metrics file (see "--metrics-json" below). The totals always
+# cover every video in the run.
+METRICS_MAX_JOBS = 1000
+
+# The number of seconds a worker may go without sending a heartbeat
+# before the coordinator gives its job to another worker (see
+# "--serve" below)
+LEASE_TIMEOUT = 60
+
+# The number of seconds between heartbeats sent by workers, and
+# between "no job yet" replies sent to idle workers
+HEARTBEAT_INTERVAL = 10
+
+# The number of messages the server (see "--daemon" below) holds
+# for a client that is not reading them. Clients that fall further
+# behind are disconnected, and their videos are still converted.
+DAEMON_MAX_PENDING_MESSAGES = 1000
+
+# The number of times the coordinator hands out the same job
+# before giving up on it, when the workers converting it keep
+# disappearing
+LEASE_MAX_ATTEMPTS = 3
+
+# How often, in seconds, "--jobs auto" reconsiders the number of
+# videos to convert at once. Each decision is based on the total
+# encoding FPS measured over this interval.
+AUTO_JOBS_INTERVAL = 60
+
+# The minimum relative increase in total FPS (0.05 = 5%) for
+# "--jobs auto" to keep an extra concurrent conversion
+AUTO_JOBS_MIN_GAIN = 0.05
+
+# The number of intervals "--jobs auto" waits after backing off
+# before trying to run more conversions at once again
+AUTO_JOBS_HOLD_INTERVALS = 5
+
+# The memory stall percentage (from /proc/pressure/memory), or
+# the percentage of memory in use if that is not available, above
+# which "--jobs auto" runs fewer conversions at once
+AUTO_JOBS_MEMORY_PRESSURE = 10
+AUTO_JOBS_MEMORY_USED = 90
+
+# Linux syscall numbers of ioprio_set, used by "--ionice" below
+IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+}
+
+# The size in bytes of each read and write when copying videos to
+# and from the scratch directory (see "--scratch-dir" below)
+SCRATCH_COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Videos shorter than this many seconds are never split into
+# segments (see "--split" below)
+SPLIT_MIN_DURATION = 20 * 60
+
+# Videos without enough chapters are split into fewer segments
+# than asked for where needed to keep each one at least this many
+# seconds long
+SPLIT_MIN_SEGMENT_DURATION = 2 * 60
+
+# The number of seconds the size and modification time of a new
+# video must stay the same before "--watch" converts it, so that
+# downloads and copies in progress are left alone
+WATCH_SETTLE_TIME = 30
+
+# How often, in seconds, "--watch" checks whether new videos have
+# settled, and lists the input directory again when inotify is not
+# available
+WATCH_CHECK_INTERVAL = 1
+WATCH_POLL_INTERVAL = 30
+
+# inotify event flags used by "--watch", from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# How much each finished conversion moves the remembered encoding
+# speed for videos like it, from 0 (not at all) to 1 (replace it)
+ETA_HISTORY_WEIGHT = 0.3
+
 # The format string for logging messages
 LOGGING_FORMAT = "[%(levelname)s] %(message)s"
 
@@ -102,6 +270,13 @@ SUBTITLE_LANGUAGES = ["eng"]
 #    "prompt": Ask the user what to do
 #    "skip": Skip the file and proceed to the next one
 #    "overwrite": Overwrite the destination file
+#    "changed": Overwrite the destination file only if the source
+#               video or the HandBrake arguments changed since it
+#               was converted, according to the manifest (see
+#               "--no-manifest" below). Files that are not in the
+#               manifest are overwritten if they are older than
+#               the source video. Track languages are not checked,
+#               the tracks selected last time are compared instead.
 # On the command line, specify as "-w skip"
 DUPLICATE_ACTION = "skip"
 
@@ -113,6 +288,19 @@ DUPLICATE_ACTION = "skip"
 # as "-d 1280x720", "-d 720p", or "-d auto"
 OUTPUT_DIMENSIONS = "auto"
 
+# The order to convert videos in when several are converted at
+# once. Can be one of:
+#    "input": Directory order, as with a single job
+#    "longest": Longest videos first
+#    "cost": Highest duration x pixel count first
+# Starting the longest conversions first keeps a long movie from
+# being converted alone at the end while the other job slots sit
+# idle. Any order other than "input" scans every video before the
+# first conversion starts, so conversions no longer start while
+# the rest of the videos are being scanned. Videos of unknown
+# length go first. On the command line, specify as "--order cost"
+JOB_ORDER = "input"
+
 # The minimum severity for an event to be logged. Levels
 # from least severe to most servere are "debug", "info",
 # "warning", "error", and "critical". On the command line,
@@ -125,12 +313,269 @@ LOGGING_LEVEL = "info"
 # to true. On the command line, specify as "-u"
 MANUAL_UND = False
 
+# Path of a file used to remember which track was picked at each
+# track selection prompt, keyed by the layout of the tracks (their
+# indices, languages, codecs, channels and formats). Videos
+# with the same layout in other directories or later runs use the
+# same track without asking again. Set to None to only remember
+# choices within a directory, or to "default" to store them in
+# the user cache directory. Decisions can be copied between files
+# with "--import-decisions path" and "--export-decisions path".
+# On the command line, specify as "--decisions path/to/file.json",
+# or "--decisions default" to use the default location.
+DECISIONS_FILE = None
+
+# Whether to skip videos that would need a track selection prompt
+# (or an overwrite prompt with "-w prompt") instead of waiting for
+# an answer. Skipped track layouts are added to the decisions file
+# without a selected track, so that they can be filled in before
+# the next run. On the command line, specify as "--non-interactive"
+NON_INTERACTIVE = False
+
 # Set this to true to search sub-directories within the input
 # directory. Files will be output in the correspondingly named
 # folder in the destination directory. On the command line,
 # specify as "-r"
 RECURSIVE_SEARCH = False
 
+# Set this to true to resume a previous run that was interrupted.
+# Videos that were already converted are skipped, and videos that
+# were already scanned use the tracks selected last time, without
+# scanning or prompting again. On the command line, specify
+# as "--resume"
+RESUME = False
+
+# Set this to false to not keep a manifest in the output directory.
+# The manifest records the size, modification time and sampled
+# contents of the source of each converted video, the selected
+# tracks and a hash of the HandBrake arguments, which lets
+# "--duplicate-action changed" tell which outputs are out of date.
+# On the command line, specify as "--no-manifest"
+WRITE_MANIFEST = True
+
+# The minimum number of seconds between progress updates. Updates
+# from HandBrake that arrive faster than this are combined. Progress
+# is only shown when writing to a terminal. On the command line,
+# specify as "--progress-interval 1"
+PROGRESS_INTERVAL = 0.5
+
+# Path of a file to write progress events to, as one JSON object
+# per line. This can also be an open file descriptor, in the format
+# "fd:3". Set to None to disable. On the command line, specify
+# as "--progress-events path/to/events.jsonl"
+PROGRESS_EVENTS_FILE = None
+
+# Run as a coordinator, scanning videos and selecting tracks as
+# usual but handing the conversions out to worker processes (see
+# below) instead of running HandBrake locally. Workers must see
+# the input and output directories at the same paths. Specify as
+# "[host:]port" to listen on, where the host defaults to the
+# loopback interface. Listening on any other address requires a
+# shared secret (see below). On the command line, specify as
+# "--serve 0.0.0.0:7345"
+SERVE_ADDRESS = None
+
+# Run as a worker, converting videos handed out by the coordinator
+# at the given "host:port". "--jobs" sets the number of videos the
+# worker converts at once, and the input directory is not needed.
+# On the command line, specify as "--worker encode-host:7345"
+WORKER_ADDRESS = None
+
+# Path of a file holding a secret shared by the coordinator and its
+# workers. Workers have to prove that they know the secret before
+# they are given any jobs, and the coordinator has to prove it before
+# workers accept any, without sending it over the network.
+# On the command line, specify as "--secret-file path/to/secret"
+SECRET_FILE = None
+
+# Run as a server that listens on a Unix domain socket at the given
+# path and converts videos as clients ask for them, instead of
+# converting a single input directory. HandBrake is located, scan
+# results are cached (in memory, unless "--scan-cache" is given)
+# and track decisions (see "--decisions") are loaded once for the
+# life of the server, and "--jobs" limits the number of videos
+# being converted at once across all requests. Clients send one
+# JSON object per line, such as
+#   {"type": "convert", "path": "/videos/show", "options":
+#    {"output_dir": "/converted/show", "audio_languages": "jpn"}}
+# where "path" is a directory or a single video, and "options" may
+# set output_dir, recursive_search, input_formats, duplicate_action,
+# output_dimensions, audio_languages and subtitle_languages in the
+# same format as on the command line. The server replies with the
+# request ID and the ID of each video, followed by status updates
+# in the format of "--progress-events" and a "finished" message
+# once every video is done. {"type": "list"} lists the requests
+# in progress. Videos are never prompted for, as with
+# "--non-interactive". On the command line, specify as
+# "--daemon /run/aniconvert.sock"
+DAEMON_SOCKET = None
+
+# Path of a file to write a conversion plan to instead of converting.
+# Videos are scanned and tracks selected as usual, then every video
+# to convert is written to the plan along with its tracks and
+# estimated cost. On the command line, specify as "--plan plan.json"
+PLAN_FILE = None
+
+# Path of a plan file written with "--plan" to convert, and the
+# slice of it to convert on this host, as "i/n". The videos in the
+# plan are split into n slices of about the same total cost, the
+# same way on every host, so n hosts can each convert their own
+# slice of a shared plan. The input and output directories default
+# to the ones the plan was written with, and can be given to use a
+# different mount point, but the output format and dimensions are
+# always the ones of the plan. Every video in the slice is converted
+# (with "--resume", ones that were already converted are skipped).
+# On the command line, specify as
+# "--execute-plan plan.json --shard 2/4"
+EXECUTE_PLAN_FILE = None
+PLAN_SHARD = None
+
+# Whether to give each concurrent conversion its own share of the
+# CPU cores, keeping every share on a single NUMA node, instead of
+# letting all HandBrake processes run on every core. The x264
+# thread count is matched to the size of each share. Linux only.
+# On the command line, specify as "--pin-cpus"
+PIN_CPUS = False
+
+# Niceness to run HandBrake with, from -20 (highest priority) to 19
+# (lowest priority), or None to leave it unchanged. On the command
+# line, specify as "--nice 10"
+NICE_LEVEL = None
+
+# I/O scheduling class to run HandBrake with, one of "idle",
+# "best-effort" or "realtime", optionally followed by a priority
+# level from 0 (highest) to 7 (lowest), or None to leave it
+# unchanged. Linux only. On the command line, specify as
+# "--ionice best-effort:7"
+IONICE_CLASS = None
+
+# Path of a cgroup v2 directory, delegated to the current user, to
+# run HandBrake in. Each concurrent conversion gets a child group
+# of its own. On the command line, specify as
+# "--cgroup /sys/fs/cgroup/user.slice/.../aniconvert"
+CGROUP_DIR = None
+
+# Maximum number of CPU cores each conversion may use, enforced
+# through the cgroup given above, or None for no limit. The x264
+# thread count is matched to this quota. On the command line,
+# specify as "--cpu-quota 2.5"
+CPU_QUOTA = None
+
+# Whether to keep running after converting the videos in the
+# input directory, and convert new videos as they appear. New
+# files are picked up with inotify on Linux, and by listing the
+# input directory periodically elsewhere. SIGTERM stops watching
+# and lets the videos being converted finish. On the command
+# line, specify as "--watch"
+WATCH_INPUT_DIR = False
+
+# Path of a file to remember encoding speeds in, per resolution,
+# source codec and HandBrake settings, used to estimate how long
+# the whole run will take. Set to None to disable the estimate,
+# or to "default" to keep the history in the user cache directory.
+# On the command line, specify as "--eta-history path/to/history.json"
+# or "--eta-history default"
+ETA_HISTORY_FILE = None
+
+# Path of a file to write a timeline of the run to, in the Chrome
+# trace event format (open it in Perfetto or chrome://tracing).
+# It shows the time spent walking directories, scanning, waiting
+# on prompts and encoding, with one track per worker thread. On the
+# command line, specify as "--trace path/to/trace.json"
+TRACE_FILE = None
+
+# Path of a file to write cProfile statistics of the Python side of
+# the run to, for viewing with pstats or snakeviz. On the command
+# line, specify as "--profile path/to/aniconvert.prof"
+PROFILE_FILE = None
+
+# Path of a file to write a JSON summary of the run to once it
+# finishes, including the scan time, encode time, average FPS and
+# file sizes of every video. On the command line, specify as
+# "--metrics-json path/to/summary.json"
+METRICS_JSON_FILE = None
+
+# Path of a file to write run metrics to in the Prometheus text
+# format, for use with the node exporter textfile collector. It is
+# updated while the run is in progress. On the command line,
+# specify as "--metrics-prom path/to/aniconvert.prom"
+METRICS_PROM_FILE = None
+
+# Set this to true to read the audio and subtitle tracks directly
+# from the headers of Matroska and MP4 files instead of running a
+# full HandBrake scan, which is much faster. If a file contains
+# tracks that HandBrake may number differently, it is scanned by
+# HandBrake as usual. Note that track descriptions may differ
+# slightly from the ones HandBrake shows. On the command line,
+# specify as "--native-probe"
+NATIVE_PROBE = False
+
+# The number of files to scan concurrently. Scanning is mostly
+# spent waiting on HandBrake to start up and read the file, so
+# using a value greater than 1 can greatly speed up the scan
+# phase, especially for files on network storage. Track
+# selection prompts will still be shown one at a time, in
+# order. On the command line, specify as "--scan-jobs 4"
+SCAN_JOBS = 1
+
+# The number of videos to convert at the same time. A single
+# HandBrake process often cannot make use of every core on
+# machines with many CPUs, in which case running several
+# at once will improve throughput. Set to "auto" to start with
+# one and adjust the number while converting, based on the total
+# encoding FPS and memory pressure. On the command line,
+# specify as "--jobs 4"
+ENCODE_JOBS = 1
+
+# The number of segments to split each long video into, which are
+# encoded at the same time and joined afterwards. A single encode
+# often cannot keep a machine with many cores busy. Segments follow
+# the chapters of the video where it has enough of them, and are
+# equal lengths of time otherwise. Joining the segments requires
+# ffmpeg, or mkvmerge for MKV output, to be in PATH. Set to None to
+# never split videos. On the command line, specify as "--split 4"
+SPLIT_SEGMENTS = None
+
+# Path of a directory on fast local storage to encode in. Inputs
+# are copied there ahead of time, one large sequential read at a
+# time, HandBrake reads and writes only local files, and finished
+# outputs are moved to the output directory in the background.
+# This helps when videos live on slow network storage. Set to None
+# to encode in place. On the command line, specify as
+# "--scratch-dir /mnt/scratch"
+SCRATCH_DIR = None
+
+# The number of videos to copy to the scratch directory before
+# they are needed, and the maximum number of bytes to use there.
+# Each video counts twice its input size while it is staged or
+# being converted, to leave room for the output. Videos too large
+# for the budget are converted in place. None means no limit.
+# On the command line, specify as "--stage-ahead 2" and
+# "--scratch-budget 100G"
+SCRATCH_STAGE_AHEAD = 2
+SCRATCH_BUDGET = None
+
+# Path of a file used to cache the results of scanning videos
+# across runs. Entries are keyed by the size, modification time
+# and sampled contents of the video as well as the version of
+# HandBrake, so renamed or moved files are not scanned again.
+# Set to None to disable the cache, or to "default" to store it
+# in the user cache directory. On the command line, specify as
+# "--scan-cache path/to/cache.db", or "--scan-cache default" to
+# use the default location.
+SCAN_CACHE_FILE = None
+
+# Path of a file used to remember the contents and modification
+# time of each input directory across runs. Directories that have
+# not changed are not listed again, and ones where every video was
+# already converted (with "--duplicate-action skip") are skipped
+# entirely while their output directory is also unchanged. Set to
+# None to disable the index, or to "default" to store it in the
+# user cache directory. On the command line, specify as
+# "--dir-index path/to/index.json", or "--dir-index default" to
+# use the default location.
+DIR_INDEX_FILE = None
+
 ###############################################################
 # End of configuration values, code begins here
 ###############################################################
@@ -140,11 +585,119 @@ try:
 except NameError:
     pass
 
+# Names of the languages that the native probe can identify,
+# keyed by iso639-2 code, as HandBrake would display them
+LANGUAGE_NAMES = {
+    "ara": "Arabic", "ces": "Czech", "chi": "Chinese", "dan": "Danish",
+    "deu": "German", "ell": "Greek", "eng": "English", "fin": "Finnish",
+    "fra": "French", "heb": "Hebrew", "hin": "Hindi", "hun": "Hungarian",
+    "ind": "Indonesian", "ita": "Italian", "jpn": "Japanese", "kor": "Korean",
+    "msa": "Malay", "nld": "Dutch", "nor": "Norwegian", "pol": "Polish",
+    "por": "Portuguese", "ron": "Romanian", "rus": "Russian", "spa": "Spanish",
+    "swe": "Swedish", "tha": "Thai", "tur": "Turkish", "ukr": "Ukrainian",
+    "vie": "Vietnamese", "zho": "Chinese", "und": "Unknown",
+}
+
+# Bibliographic iso639-2 codes that HandBrake reports using
+# the terminology code instead
+LANGUAGE_CODE_ALIASES = {
+    "chi": "zho", "cze": "ces", "dut": "nld", "fre": "fra",
+    "ger": "deu", "gre": "ell", "may": "msa", "rum": "ron",
+}
+
+# Audio and subtitle codecs that the native probe knows how
+# HandBrake will handle. Files with any other codec are scanned
+# using HandBrake instead.
+MATROSKA_AUDIO_CODECS = {
+    "A_AAC": "AAC", "A_AC3": "AC3", "A_EAC3": "E-AC3", "A_DTS": "DTS",
+    "A_FLAC": "FLAC", "A_OPUS": "Opus", "A_VORBIS": "Vorbis",
+    "A_MPEG/L3": "MP3", "A_TRUEHD": "TrueHD",
+}
+MATROSKA_SUBTITLE_CODECS = {
+    "S_TEXT/ASS": ("Text", "SSA"), "S_TEXT/SSA": ("Text", "SSA"),
+    "S_ASS": ("Text", "SSA"), "S_SSA": ("Text", "SSA"),
+    "S_TEXT/UTF8": ("Text", "UTF-8"), "S_VOBSUB": ("Bitmap", "VOBSUB"),
+    "S_HDMV/PGS": ("Bitmap", "PGS"),
+}
+MP4_AUDIO_CODECS = {
+    b"ac-3": "AC3", b"ec-3": "E-AC3", b"Opus": "Opus",
+    b"fLaC": "FLAC", b".mp3": "MP3",
+}
+MP4_AUDIO_OBJECT_TYPES = {
+    0x40: "AAC", 0x66: "AAC", 0x67: "AAC", 0x68: "AAC",
+    0x69: "MP3", 0x6B: "MP3",
+}
+MP4_SUBTITLE_CODECS = {
+    b"tx3g": ("Text", "TX3G"),
+}
+
+# Audio codec families, so that track layouts match whether the
+# codec was named by HandBrake ("AAC LC", "DTS-HD MA") or by the
+# native probe ("AAC", "DTS")
+AUDIO_CODEC_FAMILIES = [
+    "aac", "ac3", "alac", "dts", "eac3", "flac", "mp2", "mp3",
+    "opus", "pcm", "truehd", "vorbis",
+]
+
+# Video codecs in the same terms as the FFmpeg stream info printed
+# by HandBrake, used to tell apart encoding speeds in the history
+# kept for the run ETA
+MATROSKA_VIDEO_CODECS = {
+    "V_MPEG4/ISO/AVC": "h264", "V_MPEGH/ISO/HEVC": "hevc",
+    "V_MPEG4/ISO/ASP": "mpeg4", "V_MPEG2": "mpeg2video",
+    "V_VP8": "vp8", "V_VP9": "vp9", "V_AV1": "av1",
+}
+MP4_VIDEO_CODECS = {
+    b"avc1": "h264", b"avc3": "h264", b"hvc1": "hevc", b"hev1": "hevc",
+    b"mp4v": "mpeg4", b"vp09": "vp9", b"av01": "av1",
+}
+
+
+class VideoInfo(object):
+    def __init__(self, duration, width, height, codec=None, chapters=None):
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.codec = codec
+        self.chapters = chapters
+
+    @classmethod
+    def from_data(cls, data):
+        if not data:
+            return cls(None, None, None)
+        return cls(*data)
+
+    def to_data(self):
+        return [self.duration, self.width, self.height, self.codec, self.chapters]
+
+    def get_cost(self, order):
+        if self.duration is None:
+            return None
+        if order == "longest":
+            return self.duration
+        if self.width is None or self.height is None:
+            return None
+        return self.duration * self.width * self.height
+
 
 class TrackInfo(object):
-    def __init__(self, audio_track, subtitle_track):
+    def __init__(self, audio_track, subtitle_track, video_info=None):
         self.audio_track = audio_track
         self.subtitle_track = subtitle_track
+        self.video_info = video_info or VideoInfo(None, None, None)
+
+    @classmethod
+    def from_data(cls, data):
+        audio_data, subtitle_data = data
+        return cls(
+            HandBrakeAudioInfo.from_data(audio_data) if audio_data else None,
+            HandBrakeSubtitleInfo.from_data(subtitle_data) if subtitle_data else None)
+
+    def to_data(self):
+        return [
+            self.audio_track and self.audio_track.to_data(),
+            self.subtitle_track and self.subtitle_track.to_data()
+        ]
 
 
 class BatchInfo(object):
@@ -153,6 +706,275 @@ class BatchInfo(object):
         self.track_map = track_map
 
 
+class EncodeJob(object):
+    def __init__(self, job_id, input_path, output_path, temp_output_path,
+            simp_input_path, track_info, handbrake_args, segments=None):
+        self.job_id = job_id
+        self.input_path = input_path
+        self.output_path = output_path
+        self.temp_output_path = temp_output_path
+        self.simp_input_path = simp_input_path
+        self.track_info = track_info
+        self.handbrake_args = handbrake_args
+        self.segments = segments
+
+    def to_data(self, video_dimensions):
+        return {
+            "job_id": self.job_id,
+            "input_path": self.input_path,
+            "output_path": self.output_path,
+            "simp_input_path": self.simp_input_path,
+            "tracks": self.track_info.to_data(),
+            "video_dimensions": video_dimensions,
+        }
+
+
+class JobJournal(object):
+    def __init__(self, path, base_input_dir, resume):
+        self.path = path
+        self.failures_path = path and path + "-failed"
+        self.base_input_dir = base_input_dir
+        self.lock = threading.Lock()
+        self.entries = {}
+        # Lines written since the journal was last compacted, which
+        # is done whenever it doubles in size
+        self.line_count = 0
+        self.compact_size = 1024
+        # Without a path, entries are only kept in memory
+        self.file = None
+        if path:
+            if resume:
+                self.load()
+            self.file = open(path, "a" if resume else "w")
+
+    def load(self):
+        try:
+            f = open(self.path, "r")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete after a crash
+                    continue
+                self.entries[entry["input"]] = entry
+        logging.info("Loaded %d journal entries", len(self.entries))
+
+    def get_key(self, input_path):
+        return os.path.relpath(input_path, self.base_input_dir)
+
+    def get_state(self, input_path):
+        entry = self.entries.get(self.get_key(input_path))
+        return entry and entry["state"]
+
+    def get_track_info(self, input_path):
+        entry = self.entries.get(self.get_key(input_path))
+        if not entry or "audio" not in entry:
+            return None
+        return TrackInfo(
+            HandBrakeAudioInfo.from_data(entry["audio"]) if entry["audio"] else None,
+            HandBrakeSubtitleInfo.from_data(entry["subtitle"]) if entry["subtitle"] else None,
+            VideoInfo.from_data(entry.get("video")))
+
+    def record(self, input_paths, state, track_info=None):
+        with self.lock:
+            for input_path in input_paths:
+                entry = {"input": self.get_key(input_path), "state": state}
+                if track_info:
+                    audio_track = track_info.audio_track
+                    subtitle_track = track_info.subtitle_track
+                    entry["audio"] = audio_track and audio_track.to_data()
+                    entry["subtitle"] = subtitle_track and subtitle_track.to_data()
+                    entry["video"] = track_info.video_info.to_data()
+                else:
+                    previous_entry = self.entries.get(entry["input"], {})
+                    for key in ("audio", "subtitle", "video"):
+                        if key in previous_entry:
+                            entry[key] = previous_entry[key]
+                self.entries[entry["input"]] = entry
+                if self.file:
+                    self.file.write(json.dumps(entry) + "\n")
+            if self.file:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.line_count += len(input_paths)
+            if self.line_count >= self.compact_size:
+                self.compact()
+
+    def compact(self):
+        # Keep only the latest entry of each video that still exists,
+        # so that watching a directory for weeks does not keep every
+        # video ever converted
+        self.entries = {key: entry for key, entry in self.entries.items()
+            if os.path.exists(os.path.join(self.base_input_dir, key))}
+        self.line_count = len(self.entries)
+        self.compact_size = max(1024, 2 * self.line_count)
+        if not self.file:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        replace_file(temp_path, self.path)
+        self.file = open(self.path, "a")
+
+    def get_failures(self):
+        with self.lock:
+            return sorted(key for key, entry in self.entries.items() if entry["state"] == "failed")
+
+    def write_failures(self):
+        failures = self.get_failures()
+        if not failures:
+            try_delete_file(self.failures_path)
+            return
+        logging.warning("%d video(s) failed to convert, see '%s'", len(failures), self.failures_path)
+        try:
+            write_file_atomic(self.failures_path, "".join(
+                json.dumps({"input": key}) + "\n" for key in failures))
+        except (IOError, OSError) as e:
+            logging.warning("Cannot write list of failed videos: %s", e)
+
+    def close(self, completed):
+        if not self.file:
+            return
+        with self.lock:
+            self.file.close()
+        # A completed run leaves nothing to resume, videos that failed
+        # are converted again by the next run anyway
+        if completed:
+            self.write_failures()
+            try_delete_file(self.path)
+
+
+def get_encode_settings_hash(audio_track, subtitle_track, video_dimensions):
+    # Paths do not change the output, everything else might
+    arg_list = get_handbrake_args("", "", "", audio_track, subtitle_track, video_dimensions)
+    return hashlib.sha1(json.dumps(arg_list).encode("utf-8")).hexdigest()[:16]
+
+
+class OutputManifest(object):
+    def __init__(self, path, base_input_dir, base_output_dir, video_dimensions):
+        self.path = path
+        self.base_input_dir = base_input_dir
+        self.base_output_dir = base_output_dir
+        self.video_dimensions = video_dimensions
+        self.lock = threading.Lock()
+        self.entries = self.load()
+        # Entries that have not been written yet
+        self.pending = {}
+        self.last_write_time = time.time()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logging.error("Cannot read manifest '%s': %s", self.path, e)
+        except ValueError as e:
+            logging.error("Ignoring corrupt manifest '%s': %s", self.path, e)
+        return {}
+
+    def get_key(self, output_path):
+        return os.path.relpath(output_path, self.base_output_dir).replace(os.sep, "/")
+
+    def is_current(self, input_path, output_path):
+        entry = self.entries.get(self.get_key(output_path))
+        if entry is None:
+            return None
+        audio_track = entry["audio"] and HandBrakeAudioInfo.from_data(entry["audio"])
+        subtitle_track = entry["subtitle"] and HandBrakeSubtitleInfo.from_data(entry["subtitle"])
+        settings = get_encode_settings_hash(audio_track, subtitle_track, self.video_dimensions)
+        if settings != entry["settings"]:
+            return False
+        try:
+            stat = os.stat(input_path)
+            if stat.st_size != entry["size"]:
+                return False
+            if stat.st_mtime == entry["mtime"]:
+                return True
+            # Only read the file if it looks different, it may have
+            # just been copied or touched
+            fingerprint = ScanCache.get_fingerprint(input_path, stat.st_size)
+        except (IOError, OSError) as e:
+            # Converting it again will report the error, if it persists
+            logging.warning("Cannot check whether '%s' has changed: %s", input_path, e)
+            return False
+        if fingerprint != entry["fingerprint"]:
+            return False
+        self.update(self.get_key(output_path), dict(entry, mtime=stat.st_mtime))
+        return True
+
+    def record(self, job):
+        try:
+            stat = os.stat(job.input_path)
+            fingerprint = ScanCache.get_fingerprint(job.input_path, stat.st_size)
+        except (IOError, OSError) as e:
+            logging.warning("Cannot add '%s' to manifest: %s", job.simp_input_path, e)
+            return
+        audio_track = job.track_info.audio_track
+        subtitle_track = job.track_info.subtitle_track
+        self.update(self.get_key(job.output_path), {
+            "source": os.path.relpath(job.input_path, self.base_input_dir).replace(os.sep, "/"),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "fingerprint": fingerprint,
+            "audio": audio_track and audio_track.to_data(),
+            "subtitle": subtitle_track and subtitle_track.to_data(),
+            "settings": get_encode_settings_hash(audio_track, subtitle_track, self.video_dimensions),
+        })
+
+    def update(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.pending[key] = entry
+            if time.time() - self.last_write_time >= MANIFEST_WRITE_INTERVAL:
+                self.write()
+
+    def write(self):
+        # Called with the lock held
+        self.last_write_time = time.time()
+        if not self.pending:
+            return
+        try:
+            with self.lock_file():
+                # Other hosts may be converting into the same output
+                # directory, so keep what they wrote in the meantime
+                entries = self.load()
+                entries.update(self.pending)
+                write_file_atomic(self.path, json.dumps(entries, indent=2, sort_keys=True) + "\n")
+        except (IOError, OSError) as e:
+            logging.error("Cannot write manifest '%s': %s", self.path, e)
+            return
+        self.entries = entries
+        self.pending = {}
+
+    @contextlib.contextmanager
+    def lock_file(self):
+        if fcntl is None:
+            yield
+            return
+        # Not the manifest itself, which is replaced on every write,
+        # but the directory holding it, which leaves no file behind
+        fd = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self.lock:
+            self.write()
+
+
 class FFmpegStreamInfo(object):
     def __init__(self, stream_index, codec_type, codec_name, language_code, metadata):
         self.stream_index = stream_index
@@ -162,26 +984,54 @@ class FFmpegStreamInfo(object):
         self.metadata = metadata
 
 
+def get_audio_codec_family(codec):
+    name = re.sub(r"[^a-z0-9]", "", codec.lower())
+    for family in AUDIO_CODEC_FAMILIES:
+        if name.startswith(family):
+            return family
+    return name
+
+
 class HandBrakeAudioInfo(object):
     pattern1 = re.compile(r"(\d+), (.+) \(iso639-2: ([a-z]{3})\)")
-    pattern2 = re.compile(r"(\d+), (.+) \(iso639-2: ([a-z]{3})\), (\d+)Hz, (\d+)bps")
+    description_pattern = re.compile(r"\(([^()]+)\)")
+    # The native probe only knows the sample rate
+    pattern2 = re.compile(r"(\d+), (.+) \(iso639-2: ([a-z]{3})\), (\d+)Hz(?:, (\d+)bps)?")
 
     def __init__(self, info_str):
         match = self.pattern1.match(info_str)
         if not match:
             raise ValueError("Unknown audio track info format: " + repr(info_str))
+        self.info_str = info_str
         self.index = int(match.group(1))
         self.description = match.group(2)
         self.language_code = match.group(3)
+        # "Japanese (AAC LC) (2.0 ch)", maybe followed by other details
+        details = self.description_pattern.findall(self.description)
+        self.codec_family = get_audio_codec_family(details[0]) if details else None
+        self.channels = None
+        for detail in details[1:]:
+            if detail.endswith(" ch"):
+                self.channels = detail[:-len(" ch")]
+                break
         match = self.pattern2.match(info_str)
         if match:
             self.sample_rate = int(match.group(4))
-            self.bit_rate = int(match.group(5))
+            self.bit_rate = match.group(5) and int(match.group(5))
         else:
             self.sample_rate = None
             self.bit_rate = None
         self.title = None
 
+    @classmethod
+    def from_data(cls, data):
+        track = cls(data[0])
+        track.title = data[1]
+        return track
+
+    def to_data(self):
+        return [self.info_str, self.title]
+
     def __str__(self):
         format_str = (
             "Description: {description}\n"
@@ -193,27 +1043,23 @@ class HandBrakeAudioInfo(object):
             format_str += "\nBit rate: {bit_rate}bps"
         return format_str.format(**self.__dict__)
 
-    def __hash__(self):
-        return hash((
+    def get_layout_key(self):
+        # Only what both HandBrake and the native probe report the
+        # same way, so that a probed track matches the scanned one
+        return (
             self.index,
-            self.description,
-            self.language_code,
-            self.sample_rate,
             self.language_code,
-            self.title
-        ))
+            self.codec_family,
+            self.channels
+        )
+
+    def __hash__(self):
+        return hash(self.get_layout_key())
 
     def __eq__(self, other):
         if not isinstance(other, HandBrakeAudioInfo):
             return False
-        return (
-            self.index == other.index and
-            self.description == other.description and
-            self.language_code == other.language_code and
-            self.sample_rate == other.sample_rate and
-            self.language_code == other.language_code and
-            self.title == other.title
-        )
+        return self.get_layout_key() == other.get_layout_key()
 
 
 class HandBrakeSubtitleInfo(object):
@@ -223,6 +1069,7 @@ class HandBrakeSubtitleInfo(object):
         match = self.pattern.match(info_str)
         if not match:
             raise ValueError("Unknown subtitle track info format: " + repr(info_str))
+        self.info_str = info_str
         self.index = int(match.group(1))
         self.language = match.group(2)
         self.language_code = match.group(3)
@@ -230,6 +1077,15 @@ class HandBrakeSubtitleInfo(object):
         self.source = match.group(5)
         self.title = None
 
+    @classmethod
+    def from_data(cls, data):
+        track = cls(data[0])
+        track.title = data[1]
+        return track
+
+    def to_data(self):
+        return [self.info_str, self.title]
+
     def __str__(self):
         format_str = (
             "Language: {language}\n"
@@ -239,27 +1095,1067 @@ class HandBrakeSubtitleInfo(object):
         )
         return format_str.format(**self.__dict__)
 
-    def __hash__(self):
-        return hash((
+    def get_layout_key(self):
+        # Language names and titles may differ from the native probe
+        return (
             self.index,
-            self.language,
             self.language_code,
             self.format,
-            self.source,
-            self.title
-        ))
+            self.source
+        )
+
+    def __hash__(self):
+        return hash(self.get_layout_key())
 
     def __eq__(self, other):
         if not isinstance(other, HandBrakeSubtitleInfo):
             return False
-        return (
-            self.index == other.index and
-            self.language == other.language and
-            self.language_code == other.language_code and
-            self.format == other.format and
-            self.source == other.source and
-            self.title == other.title
-        )
+        return self.get_layout_key() == other.get_layout_key()
+
+
+class TrackDecisionNeeded(Exception):
+    pass
+
+
+class TrackDecisionStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.mtime = None
+        if path:
+            self.merge_file(path, False)
+            self.mtime = get_mtime(path)
+
+    def reload(self):
+        # Pick up decisions made by editing the file since it was read
+        if not self.path:
+            return
+        mtime = get_mtime(self.path)
+        if mtime != self.mtime:
+            self.merge_file(self.path, False)
+            self.mtime = mtime
+
+    def merge_file(self, path, required):
+        try:
+            with open(path, "r") as f:
+                entries = json.load(f)
+        except IOError as e:
+            if required or e.errno != errno.ENOENT:
+                logging.error("Cannot read track decisions '%s': %s", path, e)
+            return False
+        except ValueError as e:
+            logging.error("Ignoring corrupt track decisions '%s': %s", path, e)
+            return False
+        for fingerprint, entry in entries.items():
+            # Unresolved layouts do not replace known decisions
+            if "selected" in entry or fingerprint not in self.entries:
+                self.entries[fingerprint] = entry
+        return True
+
+    def import_file(self, path):
+        if self.merge_file(path, True):
+            logging.info("Imported track decisions from '%s'", path)
+            self.save()
+
+    def export_file(self, path):
+        try:
+            write_file_atomic(path, json.dumps(self.entries, indent=2, sort_keys=True) + "\n")
+        except (IOError, OSError) as e:
+            logging.error("Cannot write track decisions '%s': %s", path, e)
+            return
+        logging.info("Exported track decisions to '%s'", path)
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            try_create_directory(os.path.dirname(self.path))
+            write_file_atomic(self.path, json.dumps(self.entries, indent=2, sort_keys=True) + "\n")
+            self.mtime = get_mtime(self.path)
+        except (IOError, OSError) as e:
+            logging.error("Cannot write track decisions '%s': %s", self.path, e)
+
+    def get_fingerprint(self, track_list, track_type):
+        layout = [track_type] + [list(track.get_layout_key()) for track in track_list]
+        return hashlib.sha1(json.dumps(layout).encode("utf-8")).hexdigest()[:16]
+
+    def get_entry(self, track_list, track_type):
+        fingerprint = self.get_fingerprint(track_list, track_type)
+        entry = self.entries.get(fingerprint)
+        if entry is None:
+            entry = self.entries[fingerprint] = {
+                "type": track_type,
+                "tracks": [track.to_data() for track in track_list],
+            }
+        return entry
+
+    def get_selection(self, track_list, track_type):
+        entry = self.entries.get(self.get_fingerprint(track_list, track_type))
+        if entry is None or "selected" not in entry:
+            raise KeyError(track_type)
+        if entry["selected"] is None:
+            return None
+        return get_track_by_index(track_list, entry["selected"])
+
+    def record(self, track_list, track_type, track):
+        entry = self.get_entry(track_list, track_type)
+        entry["selected"] = track and track.index
+        entry.pop("unresolved", None)
+        self.save()
+
+    def add_unresolved(self, track_list, track_type, input_path):
+        entry = self.get_entry(track_list, track_type)
+        unresolved = entry.setdefault("unresolved", [])
+        if input_path not in unresolved:
+            unresolved.append(input_path)
+            self.save()
+
+    def get_unresolved_count(self):
+        return sum(len(entry.get("unresolved", ())) for entry in self.entries.values()
+            if "selected" not in entry)
+
+
+class ScanCache(object):
+    sample_size = 64 * 1024
+
+    def __init__(self, path, handbrake_version, max_entries):
+        self.path = path
+        self.handbrake_version = handbrake_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.last_commit_time = time.time()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS scan_cache (
+                fingerprint TEXT NOT NULL,
+                version TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                tracks TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (fingerprint, version)
+            );
+            CREATE INDEX IF NOT EXISTS scan_cache_path
+                ON scan_cache (path, version);
+        """)
+        # Results from other HandBrake versions can never be used again
+        self.connection.execute(
+            "DELETE FROM scan_cache WHERE version != ?",
+            (handbrake_version,))
+        self.connection.commit()
+
+    @classmethod
+    def get_fingerprint(cls, path, size):
+        digest = hashlib.sha1(str(size).encode("utf-8"))
+        with open(path, "rb") as f:
+            for offset in (0, size // 2, size - cls.sample_size):
+                f.seek(max(offset, 0))
+                digest.update(f.read(cls.sample_size))
+        return digest.hexdigest()
+
+    def lookup(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT fingerprint, tracks FROM scan_cache "
+                "WHERE path = ? AND version = ? AND size = ? AND mtime = ?",
+                (path, self.handbrake_version, stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            fingerprint, tracks = row
+        else:
+            fingerprint = self.get_fingerprint(path, stat.st_size)
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT tracks FROM scan_cache "
+                    "WHERE fingerprint = ? AND version = ?",
+                    (fingerprint, self.handbrake_version)).fetchone()
+            tracks = row[0] if row else None
+        with self.lock:
+            if tracks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.connection.execute(
+                    "UPDATE scan_cache SET path = ?, mtime = ?, last_used = ? "
+                    "WHERE fingerprint = ? AND version = ?",
+                    (path, stat.st_mtime, time.time(),
+                     fingerprint, self.handbrake_version))
+        return (fingerprint, stat, tracks and json.loads(tracks))
+
+    def store(self, path, fingerprint, stat, data):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO scan_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint, self.handbrake_version, path, stat.st_size,
+                 stat.st_mtime, json.dumps(data), time.time()))
+            now = time.time()
+            if now - self.last_commit_time >= SCAN_CACHE_COMMIT_INTERVAL:
+                self.connection.commit()
+                self.last_commit_time = now
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM scan_cache")
+            self.connection.commit()
+
+    def commit(self):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM scan_cache WHERE rowid IN ("
+                "SELECT rowid FROM scan_cache ORDER BY last_used DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.connection.commit()
+            self.last_commit_time = time.time()
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            self.connection.close()
+        logging.info("Scan cache: %d hit(s), %d miss(es)", self.hits, self.misses)
+
+
+class DirectoryIndex(object):
+    def __init__(self, path, root_dir):
+        self.path = path
+        self.root_dir = root_dir
+        self.entries = {}
+        self.visited = set()
+        self.changed = False
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logging.warning("Cannot read directory index '%s': %s", path, e)
+        except ValueError as e:
+            logging.warning("Ignoring corrupt directory index '%s': %s", path, e)
+
+    def get_listing(self, dir_path, mtime):
+        self.visited.add(dir_path)
+        entry = self.entries.get(dir_path)
+        if entry is None or entry["mtime"] != mtime:
+            return None
+        return (entry["subdirs"], entry["files"])
+
+    def set_listing(self, dir_path, mtime, subdir_names, file_names):
+        self.visited.add(dir_path)
+        self.entries[dir_path] = {"mtime": mtime, "subdirs": subdir_names, "files": file_names}
+        self.changed = True
+
+    def is_settled(self, dir_path, output_mtime):
+        entry = self.entries.get(dir_path)
+        return entry is not None and "settled" in entry and entry["settled"] == output_mtime
+
+    def set_settled(self, dir_path, output_mtime):
+        entry = self.entries.get(dir_path)
+        if entry is not None and entry.get("settled") != output_mtime:
+            entry["settled"] = output_mtime
+            self.changed = True
+
+    def close(self):
+        # Forget directories under the input directory that no longer
+        # exist, or were not reached by this run
+        root_prefix = os.path.join(self.root_dir, "")
+        for dir_path in list(self.entries):
+            if dir_path in self.visited:
+                continue
+            if dir_path == self.root_dir or dir_path.startswith(root_prefix):
+                del self.entries[dir_path]
+                self.changed = True
+        if not self.changed:
+            return
+        try:
+            try_create_directory(os.path.dirname(self.path))
+            write_file_atomic(self.path, json.dumps(self.entries, separators=(",", ":")))
+        except (IOError, OSError) as e:
+            logging.warning("Cannot write directory index '%s': %s", self.path, e)
+
+
+class EncodeProgress(object):
+    def __init__(self, percent, fps, avg_fps, eta):
+        self.percent = percent
+        self.fps = fps
+        self.avg_fps = avg_fps
+        self.eta = eta
+
+    def __str__(self):
+        message = "Progress: {0:.2f}% done".format(self.percent)
+        if self.fps is not None:
+            message += " (FPS: {0:.2f}, average FPS: {1:.2f}, ETA: {2})".format(
+                self.fps, self.avg_fps, self.eta)
+        return message
+
+
+class JobMetrics(object):
+    def __init__(self, input_path):
+        self.input_path = input_path
+        self.output_path = None
+        self.scan_seconds = None
+        self.encode_seconds = None
+        self.avg_fps = None
+        self.input_bytes = None
+        self.output_bytes = None
+        self.result = None
+
+    def to_data(self):
+        return dict(self.__dict__)
+
+
+class RunMetrics(object):
+    def __init__(self, json_path, prom_path):
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_write_time = 0
+        # Only the most recent jobs are kept, so that watching a
+        # directory for a long time does not use more and more memory
+        self.jobs = collections.OrderedDict()
+        self.running = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.scan_seconds = 0
+        self.encode_seconds = 0
+        self.fps_total = 0
+        self.fps_count = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        # Paths that could not be written, only reported once each
+        self.failed_paths = set()
+
+    def get_job(self, input_path):
+        job = self.jobs.pop(input_path, None)
+        if job is None:
+            job = JobMetrics(input_path)
+        self.jobs[input_path] = job
+        while len(self.jobs) > METRICS_MAX_JOBS:
+            self.jobs.popitem(False)
+        return job
+
+    def record_scan(self, input_path, seconds):
+        with self.lock:
+            self.get_job(input_path).scan_seconds = seconds
+            self.scan_seconds += seconds
+        self.write_prometheus(False)
+
+    def record_encode_start(self):
+        with self.lock:
+            self.running += 1
+
+    def record_encode(self, input_path, output_path, result, seconds, avg_fps):
+        with self.lock:
+            self.running -= 1
+            job = self.get_job(input_path)
+            job.output_path = output_path
+            job.result = result
+            job.encode_seconds = seconds
+            job.avg_fps = avg_fps
+            job.input_bytes = get_file_size(input_path)
+            self.encode_seconds += seconds or 0
+            if result == "done":
+                job.output_bytes = get_file_size(output_path)
+                self.files_done += 1
+                self.input_bytes += job.input_bytes or 0
+                self.output_bytes += job.output_bytes or 0
+                if avg_fps:
+                    self.fps_total += avg_fps
+                    self.fps_count += 1
+            elif result == "failed":
+                self.files_failed += 1
+        self.write_prometheus(False)
+
+    def get_summary(self):
+        with self.lock:
+            jobs = [job.to_data() for job in self.jobs.values()]
+            summary = {
+                "start_time": self.start_time,
+                "files_done": self.files_done,
+                "files_failed": self.files_failed,
+                "files_running": self.running,
+                "scan_seconds": self.scan_seconds,
+                "encode_seconds": self.encode_seconds,
+                "avg_fps": self.fps_total / self.fps_count if self.fps_count else None,
+                "input_bytes": self.input_bytes,
+                "output_bytes": self.output_bytes,
+                "bytes_saved": self.input_bytes - self.output_bytes,
+                "jobs": jobs,
+            }
+        elapsed = time.time() - self.start_time
+        summary["elapsed_seconds"] = elapsed
+        summary["files_per_hour"] = summary["files_done"] * 3600.0 / elapsed if elapsed else 0
+        return summary
+
+    def write_prometheus(self, force):
+        if not self.prom_path:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_write_time < METRICS_WRITE_INTERVAL:
+                return
+            self.last_write_time = now
+        summary = self.get_summary()
+        lines = []
+        metrics = [
+            ("files_total", "counter", "Videos processed, by result",
+                [('result="done"', summary["files_done"]),
+                 ('result="failed"', summary["files_failed"])]),
+            ("files_running", "gauge", "Videos currently being converted",
+                [(None, summary["files_running"])]),
+            ("files_per_hour", "gauge", "Videos converted per hour in this run",
+                [(None, summary["files_per_hour"])]),
+            ("scan_seconds_total", "counter", "Time spent scanning videos",
+                [(None, summary["scan_seconds"])]),
+            ("encode_seconds_total", "counter", "Time spent converting videos",
+                [(None, summary["encode_seconds"])]),
+            ("encode_fps_average", "gauge", "Average encoding FPS of converted videos",
+                [(None, summary["avg_fps"] or 0)]),
+            ("input_bytes_total", "counter", "Size of the converted input videos",
+                [(None, summary["input_bytes"])]),
+            ("output_bytes_total", "counter", "Size of the converted output videos",
+                [(None, summary["output_bytes"])]),
+            ("bytes_saved", "gauge", "Difference between input and output sizes",
+                [(None, summary["bytes_saved"])]),
+            ("run_start_time_seconds", "gauge", "Time the run started",
+                [(None, summary["start_time"])]),
+            ("last_update_time_seconds", "gauge", "Time this file was written",
+                [(None, now)]),
+        ]
+        for name, metric_type, help_text, samples in metrics:
+            name = "aniconvert_" + name
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            for labels, value in samples:
+                label_str = "{" + labels + "}" if labels else ""
+                lines.append("{0}{1} {2}".format(name, label_str, float(value)))
+        self.write_file(self.prom_path, "\n".join(lines) + "\n")
+
+    def write_file(self, path, text):
+        # Metrics are written from the scan and encode threads, and
+        # must never stop a conversion
+        try:
+            write_file_atomic(path, text)
+        except (IOError, OSError) as e:
+            with self.lock:
+                if path in self.failed_paths:
+                    return
+                self.failed_paths.add(path)
+            logging.warning("Cannot write metrics file '%s': %s", path, e)
+
+    def close(self):
+        self.write_prometheus(True)
+        summary = self.get_summary()
+        if self.json_path:
+            self.write_file(self.json_path, json.dumps(summary, indent=2, sort_keys=True) + "\n")
+        message_format = "Converted %d video(s) in %.1f seconds, %d failed, %d bytes saved"
+        logging.info(message_format, summary["files_done"], summary["elapsed_seconds"],
+            summary["files_failed"], summary["bytes_saved"])
+
+
+class Tracer(object):
+    # The tracer of the current run, if any
+    active = None
+
+    def __init__(self, trace_path, profile_path):
+        self.trace_path = trace_path
+        self.profile_path = profile_path
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.events = []
+        self.thread_ids = {}
+        self.profiles = []
+        self.main_profile = None
+
+    def attach(self):
+        Tracer.active = self
+        if self.profile_path:
+            self.main_profile = cProfile.Profile()
+            self.main_profile.enable()
+
+    def get_thread_id(self):
+        name = threading.current_thread().name
+        with self.lock:
+            thread_id = self.thread_ids.get(name)
+            if thread_id is None:
+                thread_id = self.thread_ids[name] = len(self.thread_ids) + 1
+                self.events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": thread_id,
+                    "args": {"name": name},
+                })
+        return thread_id
+
+    def add_span(self, name, start_time, end_time, span_args):
+        if not self.trace_path:
+            return
+        thread_id = self.get_thread_id()
+        event = {
+            "name": name,
+            "ph": "X",
+            "pid": 1,
+            "tid": thread_id,
+            "ts": int((start_time - self.start_time) * 1000000),
+            "dur": int((end_time - start_time) * 1000000),
+            "args": span_args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def add_profile(self, profile):
+        with self.lock:
+            self.profiles.append(profile)
+
+    def close(self):
+        Tracer.active = None
+        if self.main_profile:
+            self.main_profile.disable()
+            self.add_profile(self.main_profile)
+        if self.trace_path:
+            trace = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+            try:
+                write_file_atomic(self.trace_path, json.dumps(trace))
+            except (IOError, OSError) as e:
+                logging.error("Cannot write trace file '%s': %s", self.trace_path, e)
+        if self.profile_path and self.profiles:
+            try:
+                stats = pstats.Stats(*self.profiles)
+                stats.dump_stats(self.profile_path)
+            except (IOError, OSError) as e:
+                logging.error("Cannot write profile file '%s': %s", self.profile_path, e)
+
+
+class ResourceControl(object):
+    ioprio_classes = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+    def __init__(self, args, slot_count):
+        self.slot_count = slot_count
+        self.nice = args.nice
+        self.ionice = args.ionice
+        self.cpu_quota = args.cpu_quota
+        self.slot_cpus = None
+        self.cgroup_dirs = None
+        self.warnings = set()
+        if args.pin_cpus:
+            self.slot_cpus = get_cpu_partitions(slot_count)
+            for slot, cpus in enumerate(self.slot_cpus or []):
+                logging.debug("Job slot %d runs on CPUs %s", slot, cpus)
+        if args.cgroup:
+            self.cgroup_dirs = create_job_cgroups(args.cgroup, slot_count, args.cpu_quota)
+
+    def warn_once(self, message_format, *message_args):
+        if message_format in self.warnings:
+            return
+        self.warnings.add(message_format)
+        logging.warning(message_format, *message_args)
+
+    def get_thread_count(self, slot):
+        if self.slot_cpus:
+            return len(self.slot_cpus[slot])
+        if self.cpu_quota and self.cgroup_dirs:
+            return max(1, int(math.ceil(self.cpu_quota)))
+        return None
+
+    def get_handbrake_args(self, slot, arg_list):
+        thread_count = self.get_thread_count(slot)
+        if thread_count is None:
+            return arg_list
+        return set_encoder_threads(arg_list, thread_count)
+
+    def apply(self, slot, process):
+        if self.cgroup_dirs:
+            # Moving the process moves all of its threads with it
+            procs_path = os.path.join(self.cgroup_dirs[slot], "cgroup.procs")
+            try:
+                with open(procs_path, "w") as f:
+                    f.write(str(process.pid))
+            except (IOError, OSError) as e:
+                self.warn_once("Cannot move HandBrake into cgroup: %s", e)
+        # The remaining settings are per thread on Linux, and HandBrake
+        # may have started threads of its own already
+        for thread_id in get_process_threads(process.pid):
+            self.apply_thread(slot, thread_id)
+
+    def apply_thread(self, slot, thread_id):
+        if self.slot_cpus:
+            try:
+                os.sched_setaffinity(thread_id, self.slot_cpus[slot])
+            except OSError as e:
+                self.warn_once("Cannot set CPU affinity of HandBrake: %s", e)
+        if self.nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, thread_id, self.nice)
+            except (AttributeError, OSError) as e:
+                self.warn_once("Cannot set niceness of HandBrake: %s", e)
+        if self.ionice is not None:
+            try:
+                set_io_priority(thread_id, self.ioprio_classes[self.ionice[0]], self.ionice[1])
+            except OSError as e:
+                self.warn_once("Cannot set I/O priority of HandBrake: %s", e)
+
+    def close(self):
+        for cgroup_dir in self.cgroup_dirs or []:
+            try:
+                os.rmdir(cgroup_dir)
+            except OSError as e:
+                logging.debug("Cannot remove cgroup '%s': %s", cgroup_dir, e)
+
+
+class ConcurrencyController(object):
+    def __init__(self, max_level, display):
+        self.max_level = max_level
+        self.display = display
+        self.level = 1
+        self.condition = threading.Condition()
+        self.reporters = {}
+        self.samples = []
+        self.baseline = None
+        self.hold = 0
+        self.stopped = False
+        self.display.visible_slots = self.level
+
+    def wait_for_slot(self, slot, aborted, finished):
+        # Slots are enabled in order, so the slots in use are always
+        # the lowest numbered ones
+        with self.condition:
+            while slot >= self.level:
+                if aborted.is_set() or finished.is_set() or self.stopped:
+                    return False
+                self.condition.wait(0.5)
+        return not aborted.is_set()
+
+    def job_started(self, slot, reporter):
+        with self.condition:
+            self.reporters[slot] = reporter
+
+    def job_finished(self, slot):
+        with self.condition:
+            self.reporters.pop(slot, None)
+
+    def set_level(self, level, reason, *reason_args):
+        logging.info("Converting %d video(s) at once, " + reason, level, *reason_args)
+        with self.condition:
+            self.level = level
+            self.samples = []
+            self.display.visible_slots = level
+            self.condition.notify_all()
+
+    def sample(self):
+        with self.condition:
+            # Only measure while exactly the chosen number of videos
+            # is being converted
+            if len(self.reporters) != self.level:
+                return
+            total_fps = 0.0
+            for reporter in self.reporters.values():
+                progress = reporter.latest
+                if progress is None or progress.fps is None:
+                    return
+                total_fps += progress.fps
+            self.samples.append(total_fps)
+
+    def decide(self):
+        with self.condition:
+            samples = self.samples
+            self.samples = []
+        level = self.level
+        pressure = get_memory_pressure()
+        if pressure and level > 1:
+            self.baseline = None
+            self.hold = AUTO_JOBS_HOLD_INTERVALS
+            self.set_level(level - 1, "backing off, %s", pressure)
+            return
+        # Wait for a full interval of measurements
+        if len(samples) < AUTO_JOBS_INTERVAL // 2:
+            return
+        fps = sum(samples) / len(samples)
+        logging.debug("Total FPS with %d video(s) at once: %.1f", level, fps)
+        if self.hold > 0:
+            self.hold -= 1
+            return
+        if self.baseline is None:
+            if level < self.max_level and not pressure:
+                self.baseline = (level, fps)
+                self.set_level(level + 1, "trying more, %.1f FPS with %d", fps, level)
+            return
+        baseline_level, baseline_fps = self.baseline
+        if fps >= baseline_fps * (1 + AUTO_JOBS_MIN_GAIN):
+            self.baseline = None
+            if level < self.max_level and not pressure:
+                self.baseline = (level, fps)
+                self.set_level(level + 1, "total FPS rose from %.1f to %.1f",
+                    baseline_fps, fps)
+            return
+        self.baseline = None
+        self.hold = AUTO_JOBS_HOLD_INTERVALS
+        self.set_level(baseline_level, "total FPS was %.1f with %d and %.1f with %d",
+            baseline_fps, baseline_level, fps, level)
+
+    def run(self):
+        last_decision_time = time.time()
+        while True:
+            with self.condition:
+                self.condition.wait(1)
+                if self.stopped:
+                    return
+            self.sample()
+            if time.time() - last_decision_time >= AUTO_JOBS_INTERVAL:
+                last_decision_time = time.time()
+                self.decide()
+
+    def start(self):
+        logging.info("Converting 1 video at once, adjusting automatically up to %d", self.max_level)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class RunEstimator(object):
+    def __init__(self, path, settings_key, slot_count):
+        self.path = path
+        self.settings_key = settings_key
+        self.slot_count = slot_count
+        self.lock = threading.Lock()
+        self.history = {}
+        self.jobs = {}
+        self.start_times = {}
+        self.run_speeds = []
+        self.max_running = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.history = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logging.warning("Cannot read ETA history '%s': %s", self.path, e)
+        except ValueError as e:
+            logging.warning("Ignoring corrupt ETA history '%s': %s", self.path, e)
+
+    def get_key(self, video_info):
+        return "{0}x{1} {2} {3}".format(video_info.width, video_info.height,
+            video_info.codec, self.settings_key)
+
+    def get_speed(self, video_info):
+        entry = self.history.get(self.get_key(video_info))
+        if entry:
+            return entry["speed"]
+        if self.run_speeds:
+            return sum(self.run_speeds) / len(self.run_speeds)
+        return None
+
+    def add_job(self, job):
+        with self.lock:
+            self.jobs[job.job_id] = job
+
+    def job_started(self, job):
+        with self.lock:
+            self.start_times[job.job_id] = time.time()
+            self.max_running = max(self.max_running, len(self.start_times))
+
+    def job_finished(self, job, phase, encode_seconds):
+        with self.lock:
+            self.jobs.pop(job.job_id, None)
+            self.start_times.pop(job.job_id, None)
+            video_info = job.track_info.video_info
+            if phase != "done" or not video_info.duration or encode_seconds <= 0:
+                return
+            # Speed is kept in seconds of video per second of encoding,
+            # which does not depend on the frame rate
+            speed = video_info.duration / encode_seconds
+            self.run_speeds.append(speed)
+            key = self.get_key(video_info)
+            entry = self.history.get(key)
+            if entry:
+                speed = entry["speed"] + ETA_HISTORY_WEIGHT * (speed - entry["speed"])
+            self.history[key] = {"speed": speed, "count": entry["count"] + 1 if entry else 1}
+
+    def get_remaining_time(self):
+        with self.lock:
+            now = time.time()
+            total = 0.0
+            unknown = 0
+            for job in self.jobs.values():
+                video_info = job.track_info.video_info
+                speed = self.get_speed(video_info)
+                if not video_info.duration or not speed:
+                    unknown += 1
+                    continue
+                expected = video_info.duration / speed
+                start_time = self.start_times.get(job.job_id)
+                if start_time is not None:
+                    expected = max(expected - (now - start_time), 0)
+                total += expected
+            # Until jobs start, assume every slot will be busy
+            running = self.max_running or self.slot_count
+            return (total / max(running, 1), len(self.jobs), unknown)
+
+    def log_eta(self):
+        remaining, job_count, unknown = self.get_remaining_time()
+        if job_count == 0 or unknown == job_count:
+            return
+        finish_time = time.strftime("%H:%M", time.localtime(time.time() + remaining))
+        message_format = "Estimated time left: %s for %d video(s), done around %s"
+        if unknown:
+            message_format += " (%d video(s) without an estimate)" % unknown
+        logging.info(message_format, format_duration(remaining), job_count, finish_time)
+
+    def close(self):
+        try:
+            try_create_directory(os.path.dirname(self.path))
+            write_file_atomic(self.path, json.dumps(self.history, indent=2, sort_keys=True) + "\n")
+        except (IOError, OSError) as e:
+            logging.warning("Cannot write ETA history '%s': %s", self.path, e)
+
+
+def get_progress_event(phase, job_id=None, input_path=None, progress=None):
+    event = {"time": round(time.time(), 3), "phase": phase}
+    if job_id is not None:
+        event["job"] = job_id
+    if input_path is not None:
+        event["input"] = input_path
+    if progress is not None:
+        event["percent"] = progress.percent
+        event["fps"] = progress.fps
+        event["avg_fps"] = progress.avg_fps
+        event["eta"] = progress.eta
+    return event
+
+
+class ProgressEventWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, phase, job_id=None, input_path=None, progress=None):
+        event = get_progress_event(phase, job_id, input_path, progress)
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+
+
+class ProgressReporter(object):
+    def __init__(self, display, slot, label, events, job, interval):
+        self.display = display
+        self.slot = slot
+        self.label = label
+        self.events = events
+        self.job = job
+        self.interval = interval
+        self.last_report_time = 0
+        self.pending = None
+        self.latest = None
+
+    def __call__(self, progress):
+        # HandBrake reports progress many times per second, only
+        # pass on the latest update once per interval
+        self.pending = progress
+        self.latest = progress
+        now = time.time()
+        if now - self.last_report_time >= self.interval:
+            self.last_report_time = now
+            self.flush()
+
+    def flush(self):
+        progress = self.pending
+        if progress is None:
+            return
+        self.pending = None
+        self.display.update(self.slot, self.label + str(progress))
+        if self.events:
+            self.events.write("encode", self.job.job_id, self.job.simp_input_path, progress)
+
+
+class ProgressLogFilter(object):
+    def __init__(self, display, handler):
+        self.display = display
+        self.handler = handler
+
+    def filter(self, record):
+        return self.display.before_log(self.handler, record)
+
+
+class ProgressDisplay(object):
+    active = None
+
+    def __init__(self, slot_count, stream=None):
+        self.stream = stream or sys.stderr
+        self.lock = threading.Lock()
+        self.lines = [None] * slot_count
+        self.prev_message = ""
+        self.drawn = False
+        self.suspended = None
+        self.held_records = []
+        self.log_filters = []
+        # Stay quiet unless writing to a terminal. With more than one
+        # slot, redraw a block of lines in place if the terminal
+        # supports it, otherwise print one line per update so that
+        # the output is not garbled
+        self.enabled = self.stream.isatty()
+        self.multiline = slot_count > 1
+        self.visible_slots = slot_count
+        self.ansi = self.multiline and os.name != "nt" and self.enabled
+
+    def attach(self):
+        # Log messages must not be drawn over by the progress lines
+        for handler in logging.getLogger().handlers:
+            log_filter = ProgressLogFilter(self, handler)
+            handler.addFilter(log_filter)
+            self.log_filters.append(log_filter)
+        ProgressDisplay.active = self
+
+    def detach(self):
+        ProgressDisplay.active = None
+        self.close()
+        for log_filter in self.log_filters:
+            log_filter.handler.removeFilter(log_filter)
+        self.log_filters = []
+
+    def before_log(self, handler, record):
+        with self.lock:
+            if self.suspended:
+                # Hold back messages from the encoding threads while
+                # the user is being prompted for input
+                if record.thread != self.suspended:
+                    self.held_records.append((handler, record))
+                    return False
+                return True
+            self.erase()
+        return True
+
+    def suspend(self):
+        with self.lock:
+            self.erase()
+            self.suspended = threading.current_thread().ident
+
+    def resume(self):
+        with self.lock:
+            self.suspended = None
+            held_records = self.held_records
+            self.held_records = []
+        for handler, record in held_records:
+            handler.handle(record)
+
+    def write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def erase(self):
+        if not self.drawn:
+            return
+        if self.multiline:
+            self.write("\x1b[J")
+        else:
+            self.write("\r" + " " * len(self.prev_message) + "\r")
+        self.drawn = False
+
+    def redraw(self):
+        width = get_terminal_width() - 1
+        lines = []
+        for slot, line in enumerate(self.lines):
+            if line is None and slot >= self.visible_slots:
+                continue
+            line = line or "[{0}] Idle".format(slot + 1)
+            lines.append(line[:width])
+        text = "\x1b[J" + "\n".join(lines) + "\r"
+        if len(lines) > 1:
+            text += "\x1b[{0}A".format(len(lines) - 1)
+        self.write(text)
+        self.drawn = True
+
+    def update(self, slot, message):
+        if not self.enabled:
+            return
+        with self.lock:
+            if not self.multiline:
+                if not self.suspended:
+                    blank_count = max(len(self.prev_message) - len(message), 0)
+                    self.write(message + " " * blank_count + "\r")
+                    self.drawn = True
+                self.prev_message = message
+                return
+            line = "[{0}] {1}".format(slot + 1, message)
+            if self.ansi:
+                self.lines[slot] = line
+                if not self.suspended:
+                    self.redraw()
+            elif not self.suspended:
+                self.write(line + "\n")
+
+    def finish(self, slot):
+        if not self.enabled:
+            return
+        with self.lock:
+            if not self.multiline:
+                if self.drawn:
+                    self.write("\n")
+                    self.drawn = False
+                self.prev_message = ""
+            elif self.ansi:
+                self.lines[slot] = None
+                if not self.suspended:
+                    self.redraw()
+
+    def close(self):
+        with self.lock:
+            self.erase()
+
+
+@contextlib.contextmanager
+def suspend_progress_display():
+    display = ProgressDisplay.active
+    if display is None:
+        yield
+        return
+    display.suspend()
+    try:
+        yield
+    finally:
+        display.resume()
+
+
+@contextlib.contextmanager
+def trace_span(name, **span_args):
+    tracer = Tracer.active
+    if tracer is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        tracer.add_span(name, start_time, time.time(), span_args)
+
+
+@contextlib.contextmanager
+def trace_thread():
+    # cProfile only sees the thread it was enabled on, so every
+    # worker thread keeps its own profile
+    tracer = Tracer.active
+    if tracer is None or not tracer.profile_path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        tracer.add_profile(profile)
 
 
 def print_err(message="", end="\n", flush=False):
@@ -268,6 +2164,13 @@ def print_err(message="", end="\n", flush=False):
         sys.stderr.flush()
 
 
+def get_terminal_width():
+    try:
+        return shutil.get_terminal_size().columns
+    except AttributeError:
+        return 80
+
+
 def indent_text(text, prefix):
     if isinstance(prefix, int):
         prefix = " " * prefix
@@ -275,25 +2178,372 @@ def indent_text(text, prefix):
     return "\n".join(prefix + line for line in lines)
 
 
+class DeferredResult(object):
+    def __init__(self, func, arg, run_inline):
+        self.func = func
+        self.arg = arg
+        self.run_inline = run_inline
+        self.value = None
+        self.error = None
+        self.event = threading.Event()
+
+    def run(self):
+        try:
+            self.value = self.func(self.arg)
+        except Exception as e:
+            self.error = e
+        self.event.set()
+
+    def get(self):
+        if self.run_inline and not self.event.is_set():
+            self.run()
+        # Wait with a timeout so that Ctrl-C is not ignored on Python 2
+        while not self.event.wait(0.5):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def map_parallel(func, items, thread_count):
+    if thread_count <= 1:
+        for item in items:
+            yield (item, DeferredResult(func, item, True))
+        return
+    results = [DeferredResult(func, item, False) for item in items]
+    task_queue = collections.deque(results)
+    task_lock = threading.Lock()
+    # Limit how far the workers can get ahead of the consumer
+    lookahead = threading.Semaphore(thread_count * 2)
+    stopped = threading.Event()
+
+    def worker():
+        with trace_thread():
+            while True:
+                lookahead.acquire()
+                if stopped.is_set():
+                    return
+                with task_lock:
+                    if not task_queue:
+                        return
+                    result = task_queue.popleft()
+                result.run()
+
+    for index in range(min(thread_count, len(results))):
+        thread = threading.Thread(target=worker, name="scan-{0}".format(index))
+        thread.daemon = True
+        thread.start()
+    try:
+        for item, result in zip(items, results):
+            yield (item, result)
+            lookahead.release()
+    finally:
+        stopped.set()
+        for _ in range(thread_count):
+            lookahead.release()
+
+
 def on_walk_error(exception):
     logging.error("Cannot read directory: '%s'", exception.filename)
 
 
-def get_files_in_dir(path, extensions, recursive):
+def iter_dir_entries(path):
+    # Use the file type returned with the directory listing where
+    # possible, instead of a stat() call for each entry
+    if scandir is None:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            yield (name, os.path.isdir(entry_path), os.path.islink(entry_path))
+        return
+    for entry in scandir(path):
+        yield (entry.name, entry.is_dir(), entry.is_symlink())
+
+
+def list_dir(path):
+    subdir_names = []
+    file_names = []
+    for name, is_dir, is_link in iter_dir_entries(path):
+        if not is_dir:
+            file_names.append(name)
+        elif not is_link:
+            # Like os.walk(), do not follow symbolic links to directories
+            subdir_names.append(name)
+    return (subdir_names, file_names)
+
+
+def read_dir_listing(dir_path, dir_index):
+    try:
+        if dir_index is None:
+            return list_dir(dir_path)
+        mtime = os.stat(dir_path).st_mtime
+        listing = dir_index.get_listing(dir_path, mtime)
+        if listing is None:
+            listing = list_dir(dir_path)
+            dir_index.set_listing(dir_path, mtime, *listing)
+        return listing
+    except OSError as e:
+        on_walk_error(e)
+        return None
+
+
+def get_files_in_dir(path, extensions, recursive, dir_index=None):
     extensions = {e.lower() for e in extensions}
-    for (dir_path, subdir_names, file_names) in os.walk(path, onerror=on_walk_error):
+    pending_dirs = [path]
+    while pending_dirs:
+        dir_path = pending_dirs.pop()
+        start_time = time.time()
+        listing = read_dir_listing(dir_path, dir_index)
+        if listing is None:
+            continue
+        subdir_names, file_names = listing
         filtered_files = []
         for file_name in file_names:
             extension = os.path.splitext(file_name)[1][1:]
             if extension.lower() in extensions:
                 filtered_files.append(file_name)
+        if Tracer.active:
+            Tracer.active.add_span("get_files_in_dir", start_time, time.time(), {"path": dir_path})
         if len(filtered_files) > 0:
             filtered_files.sort()
             yield (dir_path, filtered_files)
         if recursive:
-            subdir_names.sort()
-        else:
-            del subdir_names[:]
+            # Walk subdirectories in sorted order, depth first
+            for subdir_name in sorted(subdir_names, reverse=True):
+                pending_dirs.append(os.path.join(dir_path, subdir_name))
+
+
+class InotifyWatcher(object):
+    event_header = struct.Struct("iIII")
+    watch_mask = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+
+    def __init__(self, path, recursive):
+        self.path = path
+        self.recursive = recursive
+        self.watches = {}
+        self.fd = None
+        if ctypes is None or not hasattr(os, "uname") or os.uname()[0] != "Linux":
+            raise OSError(errno.ENOSYS, "inotify is not supported on this platform")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_error()
+
+    def raise_error(self):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+    def add_tree(self, path):
+        # Watch each directory before listing it, so that files
+        # created in between are reported by both and not by neither
+        file_paths = []
+        pending_dirs = [path]
+        while pending_dirs:
+            dir_path = pending_dirs.pop()
+            encoded_path = dir_path if isinstance(dir_path, bytes) else os.fsencode(dir_path)
+            watch = self.libc.inotify_add_watch(self.fd, encoded_path, self.watch_mask)
+            if watch < 0:
+                self.raise_error()
+            self.watches[watch] = dir_path
+            try:
+                subdir_names, file_names = list_dir(dir_path)
+            except OSError as e:
+                on_walk_error(e)
+                continue
+            file_paths.extend(os.path.join(dir_path, name) for name in file_names)
+            if self.recursive:
+                pending_dirs.extend(os.path.join(dir_path, name) for name in subdir_names)
+        return file_paths
+
+    def start(self):
+        return self.add_tree(self.path)
+
+    def wait(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return ([], None)
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return ([], None)
+            raise
+        file_paths = []
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, name_length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(watch, None)
+                continue
+            dir_path = self.watches.get(watch)
+            if dir_path is None or not name:
+                continue
+            if not isinstance(dir_path, bytes):
+                name = os.fsdecode(name)
+            entry_path = os.path.join(dir_path, name)
+            if not mask & IN_ISDIR:
+                file_paths.append(entry_path)
+            elif self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                file_paths.extend(self.add_tree(entry_path))
+        if overflow:
+            # Some events were lost, so look at everything again
+            logging.warning("Too many changes in the input directory, listing it again")
+            return (file_paths, self.start())
+        return (file_paths, None)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+
+class PollingWatcher(object):
+    def __init__(self, path, extensions, recursive):
+        self.path = path
+        self.extensions = extensions
+        self.recursive = recursive
+        self.next_poll_time = 0
+
+    def list_files(self):
+        self.next_poll_time = time.time() + WATCH_POLL_INTERVAL
+        file_paths = []
+        for dir_path, file_names in get_files_in_dir(self.path, self.extensions, self.recursive):
+            file_paths.extend(os.path.join(dir_path, name) for name in file_names)
+        return file_paths
+
+    def start(self):
+        return self.list_files()
+
+    def wait(self, timeout):
+        time.sleep(max(min(timeout, self.next_poll_time - time.time()), 0))
+        if time.time() < self.next_poll_time:
+            return ([], None)
+        return ([], self.list_files())
+
+    def close(self):
+        pass
+
+
+def open_dir_watcher(path, extensions, recursive):
+    try:
+        return InotifyWatcher(path, recursive)
+    except OSError as e:
+        logging.info("Cannot use inotify (%s), checking for new videos every %d seconds",
+            e, WATCH_POLL_INTERVAL)
+        return PollingWatcher(path, extensions, recursive)
+
+
+class SettleTracker(object):
+    def __init__(self, extensions, ignored_dir):
+        self.extensions = {e.lower() for e in extensions}
+        self.ignored_prefix = os.path.join(ignored_dir, "")
+        # Maps each file that has not settled yet to its last seen
+        # (size, mtime) and when that was first seen
+        self.candidates = {}
+        # Files that have been passed on for conversion, so that
+        # listing the directory again does not convert them twice
+        self.handled = set()
+        self.prune_size = 1024
+
+    def add(self, path, changed):
+        if path.startswith(self.ignored_prefix):
+            return
+        extension = os.path.splitext(path)[1][1:]
+        if extension.lower() not in self.extensions:
+            return
+        if changed:
+            self.handled.discard(path)
+        elif path in self.handled:
+            return
+        if path not in self.candidates:
+            self.candidates[path] = (None, 0)
+
+    def set_listing(self, paths):
+        self.handled.intersection_update(paths)
+        for path in paths:
+            self.add(path, False)
+
+    def get_settled(self):
+        now = time.time()
+        settled = []
+        for path, (last_stat, since) in list(self.candidates.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Deleted or moved away before it settled
+                del self.candidates[path]
+                continue
+            current_stat = (st.st_size, st.st_mtime)
+            if current_stat != last_stat:
+                # Files that have not been touched for a while, such
+                # as the ones already there at startup, settle at once
+                since = min(now, st.st_mtime) if last_stat is None else now
+                self.candidates[path] = (current_stat, since)
+            if now - since >= WATCH_SETTLE_TIME:
+                del self.candidates[path]
+                self.handled.add(path)
+                settled.append(path)
+        if len(self.handled) >= self.prune_size:
+            self.prune()
+        return settled
+
+    def prune(self):
+        # Forget files that have been moved or deleted since. Waiting
+        # for the set to double in size keeps this cheap.
+        self.handled = {path for path in self.handled if os.path.exists(path)}
+        self.prune_size = max(1024, 2 * len(self.handled))
+
+
+def iter_watched_dirs(args):
+    watcher = open_dir_watcher(args.input_dir, args.input_formats, args.recursive_search)
+    tracker = SettleTracker(args.input_formats, args.output_dir)
+    try:
+        tracker.set_listing(watcher.start())
+        logging.info("Watching '%s' for new videos", args.input_dir)
+        while not args.shutdown.is_set():
+            dir_map = collections.defaultdict(list)
+            for path in tracker.get_settled():
+                dir_path, file_name = os.path.split(path)
+                dir_map[dir_path].append(file_name)
+            # Convert everything that settled in a directory at once,
+            # so that it shares track selections like a normal run
+            for dir_path in sorted(dir_map):
+                yield (dir_path, sorted(dir_map[dir_path]))
+                if args.shutdown.is_set():
+                    return
+            changed_paths, listing = watcher.wait(WATCH_CHECK_INTERVAL)
+            for path in changed_paths:
+                tracker.add(path, True)
+            if listing is not None:
+                tracker.set_listing(listing)
+    finally:
+        watcher.close()
+
+
+def get_output_dir_entries(output_dir):
+    # Read the output directory once instead of checking for each
+    # output file separately. Maps names to whether they are
+    # directories; the output directory may not exist yet.
+    try:
+        return {os.path.normcase(name): is_dir
+            for name, is_dir, _ in iter_dir_entries(output_dir)}
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return {}
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
 
 
 def get_output_dir(base_output_dir, base_input_dir, dir_path):
@@ -321,6 +2571,9 @@ def get_output_path(base_output_dir, base_input_dir, input_path, output_format):
 
 
 def try_create_directory(path):
+    # The parent of a bare file name is the current directory
+    if not path:
+        return
     try:
         os.makedirs(path, 0o755)
     except OSError as e:
@@ -336,69 +2589,211 @@ def try_delete_file(path):
             raise
 
 
-def run_handbrake_scan(handbrake_path, input_path):
-    output = subprocess.check_output([
-        handbrake_path,
-        "-i", input_path,
-        "--scan"
-    ], stderr=subprocess.STDOUT)
-    return output.decode("utf-8")
+def replace_file(source_path, dest_path):
+    if hasattr(os, "replace"):
+        os.replace(source_path, dest_path)
+        return
+    if os.name == "nt":
+        try_delete_file(dest_path)
+    os.rename(source_path, dest_path)
 
 
-def parse_handbrake_track_info(output_lines, start_index, info_cls):
-    prefix = "    + "
-    prefix_len = len(prefix)
-    tracks = []
-    i = start_index + 1
-    while i < len(output_lines) and output_lines[i].startswith(prefix):
-        info_str = output_lines[i][prefix_len:]
-        info = info_cls(info_str)
-        tracks.append(info)
-        i += 1
-    return (i, tracks)
-
-
-def parse_ffmpeg_stream_metadata(output_lines, start_index, metadata_pattern):
-    metadata = {}
-    i = start_index + 1
-    while i < len(output_lines):
-        match = metadata_pattern.match(output_lines[i])
-        if not match:
-            break
-        metadata[match.group(1)] = match.group(2)
-        i += 1
-    return (i, metadata)
-
-
-def parse_ffmpeg_stream_info(output_lines, start_index):
-    stream_pattern = re.compile(r"\s{4}Stream #0\.(\d+)(\(([a-z]{3})\))?: (\S+): (\S+?)")
-    metadata_pattern = re.compile(r"\s{6}(\S+)\s*: (.+)")
-    audio_streams = []
-    subtitle_streams = []
-    i = start_index + 1
-    while i < len(output_lines) and output_lines[i].startswith("  "):
-        match = stream_pattern.match(output_lines[i])
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def write_file_atomic(path, text):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+    replace_file(temp_path, path)
+
+
+def get_temp_output_path(output_path, tag=None):
+    dir_path, file_name = os.path.split(output_path)
+    base_name, extension = os.path.splitext(file_name)
+    if tag is not None:
+        base_name += "." + str(tag)
+    return os.path.join(dir_path, "." + base_name + ".part" + extension)
+
+
+class HandBrakeScanParser(object):
+    ff_stream_pattern = re.compile(r"\s{4}Stream #0\.(\d+)(\(([a-z]{3})\))?: (\S+): (\S+?)")
+    ff_metadata_pattern = re.compile(r"\s{6}(\S+)\s*: (.+)")
+    ff_video_pattern = re.compile(r"\s{4}Stream #0\.\d+.*?: Video: ([^\s,]+)")
+    hb_duration_pattern = re.compile(r"  \+ duration: (\d+):(\d+):(\d+)")
+    hb_size_pattern = re.compile(r"  \+ size: (\d+)x(\d+)")
+    hb_chapter_pattern = re.compile(r"    \+ \d+: .*duration (\d+):(\d+):(\d+)")
+    hb_track_prefix = "    + "
+
+    def __init__(self):
+        self.hb_audio_tracks = None
+        self.hb_subtitle_tracks = None
+        self.ff_audio_streams = None
+        self.ff_subtitle_streams = None
+        self.section = None
+        self.ff_stream = None
+        self.in_ff_metadata = False
+        self.video_info = VideoInfo(None, None, None)
+
+    @property
+    def complete(self):
+        # HandBrake prints the FFmpeg stream info while scanning, and
+        # the track lists at the very end, so nothing else is needed
+        # once both track lists have been read
+        return (
+            self.section is None and
+            self.hb_audio_tracks is not None and
+            self.hb_subtitle_tracks is not None
+        )
+
+    def feed(self, line):
+        if self.section == "ffmpeg":
+            if line.startswith("  "):
+                self.feed_ffmpeg_line(line)
+                return
+            message_format = "FFmpeg: %d audio track(s), %d subtitle track(s)"
+            logging.debug(message_format, len(self.ff_audio_streams), len(self.ff_subtitle_streams))
+            self.section = None
+            self.ff_stream = None
+            self.in_ff_metadata = False
+        elif self.section is not None:
+            if line.startswith(self.hb_track_prefix):
+                self.feed_handbrake_line(line)
+                return
+            if self.section is HandBrakeAudioInfo:
+                logging.debug("HandBrake: %d audio track(s)", len(self.hb_audio_tracks))
+            else:
+                logging.debug("HandBrake: %d subtitle track(s)", len(self.hb_subtitle_tracks))
+            self.section = None
+        if line.startswith("Input #0, ") and self.ff_audio_streams is None:
+            logging.debug("Found FFmpeg stream info")
+            self.section = "ffmpeg"
+            self.ff_audio_streams = []
+            self.ff_subtitle_streams = []
+        elif line == "  + audio tracks:" and self.hb_audio_tracks is None:
+            logging.debug("Found HandBrake audio track info")
+            self.section = HandBrakeAudioInfo
+            self.hb_audio_tracks = []
+        elif line == "  + subtitle tracks:" and self.hb_subtitle_tracks is None:
+            logging.debug("Found HandBrake subtitle track info")
+            self.section = HandBrakeSubtitleInfo
+            self.hb_subtitle_tracks = []
+        elif line.startswith("  + ") and self.hb_audio_tracks is None:
+            self.feed_title_line(line)
+        elif line.startswith(self.hb_track_prefix) and self.hb_audio_tracks is None:
+            self.feed_chapter_line(line)
+
+    def feed_title_line(self, line):
+        match = self.hb_duration_pattern.match(line)
+        if match and self.video_info.duration is None:
+            hours, minutes, seconds = (int(group) for group in match.groups())
+            self.video_info.duration = hours * 3600 + minutes * 60 + seconds
+            return
+        match = self.hb_size_pattern.match(line)
+        if match and self.video_info.width is None:
+            self.video_info.width = int(match.group(1))
+            self.video_info.height = int(match.group(2))
+
+    def feed_chapter_line(self, line):
+        match = self.hb_chapter_pattern.match(line)
+        if match:
+            hours, minutes, seconds = (int(group) for group in match.groups())
+            if self.video_info.chapters is None:
+                self.video_info.chapters = []
+            self.video_info.chapters.append(hours * 3600 + minutes * 60 + seconds)
+
+    def feed_ffmpeg_line(self, line):
+        if self.ff_stream is not None:
+            if not self.in_ff_metadata and line.startswith("    Metadata:"):
+                self.in_ff_metadata = True
+                return
+            if self.in_ff_metadata:
+                match = self.ff_metadata_pattern.match(line)
+                if match:
+                    self.ff_stream.metadata[match.group(1)] = match.group(2)
+                    return
+            self.ff_stream = None
+            self.in_ff_metadata = False
+        match = self.ff_stream_pattern.match(line)
         if not match:
-            i += 1
-            continue
+            return
+        if match.group(4) == "Video" and self.video_info.codec is None:
+            video_match = self.ff_video_pattern.match(line)
+            self.video_info.codec = video_match and video_match.group(1)
+            return
         stream_index = match.group(1)
         language_code = match.group(3) or "und"
         codec_type = match.group(4)
         codec_name = match.group(5)
-        i += 1
         if codec_type == "Audio":
-            current_stream = audio_streams
+            current_stream = self.ff_audio_streams
         elif codec_type == "Subtitle":
-            current_stream = subtitle_streams
+            current_stream = self.ff_subtitle_streams
         else:
-            continue
-        if output_lines[i].startswith("    Metadata:"):
-            i, metadata = parse_ffmpeg_stream_metadata(output_lines, i, metadata_pattern)
+            return
+        self.ff_stream = FFmpegStreamInfo(stream_index, codec_type, codec_name, language_code, {})
+        current_stream.append(self.ff_stream)
+
+    def feed_handbrake_line(self, line):
+        info = self.section(line[len(self.hb_track_prefix):])
+        if self.section is HandBrakeAudioInfo:
+            self.hb_audio_tracks.append(info)
         else:
-            metadata = {}
-        info = FFmpegStreamInfo(stream_index, codec_type, codec_name, language_code, metadata)
-        current_stream.append(info)
-    return (i, audio_streams, subtitle_streams)
+            self.hb_subtitle_tracks.append(info)
+
+    def get_result(self):
+        # Flush out a section that ended with the output
+        self.feed("")
+        merge_track_titles(self.hb_audio_tracks, self.ff_audio_streams)
+        merge_track_titles(self.hb_subtitle_tracks, self.ff_subtitle_streams)
+        return (self.hb_audio_tracks, self.hb_subtitle_tracks, self.video_info)
+
+
+def get_handbrake_scan_args(handbrake_path, input_path):
+    return [
+        handbrake_path,
+        "-i", input_path,
+        "--scan",
+        # Decode as few previews as possible and do not save them
+        "--previews", "1:0"
+    ]
+
+
+def run_handbrake_scan(handbrake_path, input_path):
+    arg_list = get_handbrake_scan_args(handbrake_path, input_path)
+    process = subprocess.Popen(
+        arg_list,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    parser = HandBrakeScanParser()
+    with trace_span("run_handbrake_scan", path=input_path):
+        try:
+            for line in iter(process.stdout.readline, b""):
+                parser.feed(line.decode("utf-8", "replace").rstrip("\r\n"))
+                if parser.complete:
+                    # HandBrake may keep working for a while after printing
+                    # the track lists, but we have everything we need
+                    logging.debug("Scan output complete, stopping HandBrake")
+                    process.kill()
+                    break
+        except:
+            process.kill()
+            process.wait()
+            raise
+        retcode = process.wait()
+    if retcode != 0 and not parser.complete:
+        raise subprocess.CalledProcessError(retcode, arg_list)
+    with trace_span("parse_handbrake_scan_output", path=input_path):
+        return parser.get_result()
 
 
 def merge_track_titles(hb_tracks, ff_streams):
@@ -411,76 +2806,440 @@ def merge_track_titles(hb_tracks, ff_streams):
 
 
 def parse_handbrake_scan_output(output):
-    lines = output.splitlines()
-    hb_audio_tracks = None
-    hb_subtitle_tracks = None
-    ff_audio_streams = None
-    ff_subtitle_streams = None
-    i = 0
-    while i < len(lines):
-        if lines[i].startswith("Input #0, "):
-            logging.debug("Found FFmpeg stream info")
-            i, ff_audio_streams, ff_subtitle_streams = parse_ffmpeg_stream_info(lines, i)
-            message_format = "FFmpeg: %d audio track(s), %d subtitle track(s)"
-            logging.debug(message_format, len(ff_audio_streams), len(ff_subtitle_streams))
-            continue
-        if lines[i] == "  + audio tracks:":
-            logging.debug("Found HandBrake audio track info")
-            i, hb_audio_tracks = parse_handbrake_track_info(lines, i, HandBrakeAudioInfo)
-            logging.debug("HandBrake: %d audio track(s)", len(hb_audio_tracks))
-            continue
-        if lines[i] == "  + subtitle tracks:":
-            logging.debug("Found HandBrake subtitle track info")
-            i, hb_subtitle_tracks = parse_handbrake_track_info(lines, i, HandBrakeSubtitleInfo)
-            logging.debug("HandBrake: %d subtitle track(s)", len(hb_subtitle_tracks))
-            continue
-        i += 1
-    merge_track_titles(hb_audio_tracks, ff_audio_streams)
-    merge_track_titles(hb_subtitle_tracks, ff_subtitle_streams)
-    return (hb_audio_tracks, hb_subtitle_tracks)
+    with trace_span("parse_handbrake_scan_output"):
+        parser = HandBrakeScanParser()
+        for line in output.splitlines():
+            parser.feed(line)
+        return parser.get_result()
 
 
 def get_track_info(handbrake_path, input_path):
-    scan_output = run_handbrake_scan(handbrake_path, input_path)
-    return parse_handbrake_scan_output(scan_output)
+    return run_handbrake_scan(handbrake_path, input_path)
+
+
+def read_ebml_vint(data, pos, keep_marker):
+    first = ord(data[pos:pos + 1])
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ValueError("Invalid EBML variable size integer")
+    value = first if keep_marker else first & (mask - 1)
+    all_ones = value == mask - 1
+    for byte in bytearray(data[pos + 1:pos + length]):
+        value = (value << 8) | byte
+        all_ones = all_ones and byte == 0xFF
+    if all_ones and not keep_marker:
+        # Unknown size, extends to the end of the parent
+        value = None
+    return (value, pos + length)
+
+
+def iter_ebml_elements(data, start, end):
+    pos = start
+    while pos < end:
+        element_id, pos = read_ebml_vint(data, pos, True)
+        size, pos = read_ebml_vint(data, pos, False)
+        element_end = end if size is None else min(pos + size, end)
+        yield (element_id, pos, element_end)
+        pos = element_end
+
+
+def read_ebml_uint(data, start, end):
+    value = 0
+    for byte in bytearray(data[start:end]):
+        value = (value << 8) | byte
+    return value
 
 
-def get_track_by_index(track_list, track_index):
-    for track in track_list:
-        if track.index == track_index:
-            return track
-    raise IndexError("Invalid track index: " + str(track_index))
+def read_ebml_string(data, start, end):
+    return data[start:end].rstrip(b"\0").decode("utf-8", "replace")
+
+
+def read_ebml_float(data, start, end):
+    if end - start == 4:
+        return struct.unpack(">f", data[start:end])[0]
+    return struct.unpack(">d", data[start:end])[0]
+
+
+def parse_matroska_track_entry(data, start, end):
+    track = {"language": "eng"}
+    for element_id, pos, element_end in iter_ebml_elements(data, start, end):
+        if element_id == 0x83:
+            track["type"] = read_ebml_uint(data, pos, element_end)
+        elif element_id == 0x86:
+            track["codec"] = read_ebml_string(data, pos, element_end)
+        elif element_id == 0x536E:
+            track["title"] = read_ebml_string(data, pos, element_end)
+        elif element_id == 0x22B59C:
+            track["language"] = read_ebml_string(data, pos, element_end)
+        elif element_id == 0x22B59D:
+            track["language_bcp47"] = read_ebml_string(data, pos, element_end)
+        elif element_id == 0xE1:
+            for sub_id, sub_pos, sub_end in iter_ebml_elements(data, pos, element_end):
+                if sub_id == 0xB5:
+                    track.setdefault("sample_rate", int(read_ebml_float(data, sub_pos, sub_end)))
+                elif sub_id == 0x78B5:
+                    # Set for HE-AAC, whose decoder reports this rate instead
+                    track["sample_rate"] = int(read_ebml_float(data, sub_pos, sub_end))
+                elif sub_id == 0x9F:
+                    track["channels"] = read_ebml_uint(data, sub_pos, sub_end)
+        elif element_id == 0xE0:
+            for sub_id, sub_pos, sub_end in iter_ebml_elements(data, pos, element_end):
+                if sub_id == 0xB0:
+                    track["width"] = read_ebml_uint(data, sub_pos, sub_end)
+                elif sub_id == 0xBA:
+                    track["height"] = read_ebml_uint(data, sub_pos, sub_end)
+    if "language_bcp47" in track:
+        # HandBrake may map this differently than we would
+        return None
+    return track
 
 
-def filter_tracks_by_language(track_list, preferred_languages, manual_und):
-    for preferred_language_code in preferred_languages:
-        preferred_language_code = preferred_language_code.lower()
-        if preferred_language_code == "none":
+def read_matroska_duration(data, start, end):
+    duration = None
+    timecode_scale = 1000000
+    for element_id, pos, element_end in iter_ebml_elements(data, start, end):
+        if element_id == 0x4489:
+            duration = read_ebml_float(data, pos, element_end)
+        elif element_id == 0x2AD7B1:
+            timecode_scale = read_ebml_uint(data, pos, element_end)
+    if duration is None:
+        return None
+    return int(duration * timecode_scale / 1000000000)
+
+
+def probe_matroska_tracks(data):
+    element_id, pos, end = next(iter_ebml_elements(data, 0, len(data)))
+    if element_id != 0x1A45DFA3:
+        return None
+    element_id, segment_start, segment_end = next(iter_ebml_elements(data, end, len(data)))
+    if element_id != 0x18538067:
+        return None
+    tracks_range = None
+    tracks_pos = None
+    duration = None
+    for element_id, pos, end in iter_ebml_elements(data, segment_start, segment_end):
+        if element_id == 0x1549A966:
+            duration = read_matroska_duration(data, pos, end)
+        elif element_id == 0x114D9B74:
+            # SeekHead, remember where the Tracks element is in case
+            # it comes after the first Cluster
+            for seek_id, seek_pos, seek_end in iter_ebml_elements(data, pos, end):
+                entry = dict(
+                    (sub_id, data[sub_pos:sub_end])
+                    for sub_id, sub_pos, sub_end in iter_ebml_elements(data, seek_pos, seek_end))
+                if entry.get(0x53AB) == b"\x16\x54\xAE\x6B" and 0x53AC in entry:
+                    position = read_ebml_uint(entry[0x53AC], 0, len(entry[0x53AC]))
+                    tracks_pos = segment_start + position
+        elif element_id == 0x1654AE6B:
+            tracks_range = (pos, end)
+            break
+        elif element_id == 0x1F43B675:
+            break
+    if tracks_range is None:
+        if tracks_pos is None:
             return None
-        und_count = 0
-        filtered_tracks = []
-        for track in track_list:
-            if track.language_code == preferred_language_code:
-                filtered_tracks.append(track)
-            elif track.language_code == "und":
-                und_count += 1
-                filtered_tracks.append(track)
-        if len(filtered_tracks) - und_count >= 1:
-            return filtered_tracks
-        elif len(track_list) == und_count:
-            if und_count == 1 and not manual_und:
-                return track_list
-            return []
-    return []
+        element_id, pos, end = next(iter_ebml_elements(data, tracks_pos, segment_end))
+        if element_id != 0x1654AE6B:
+            return None
+        tracks_range = (pos, end)
+    tracks = []
+    for element_id, entry_pos, entry_end in iter_ebml_elements(data, *tracks_range):
+        if element_id != 0xAE:
+            continue
+        track = parse_matroska_track_entry(data, entry_pos, entry_end)
+        if track is None:
+            return None
+        track["type"] = {1: "video", 2: "audio", 0x11: "subtitle"}.get(track.get("type"))
+        codec = track.get("codec", "")
+        if track["type"] == "video":
+            track["codec"] = MATROSKA_VIDEO_CODECS.get(codec)
+        elif track["type"] == "audio":
+            if codec.startswith("A_AAC"):
+                codec = "A_AAC"
+            track["codec"] = MATROSKA_AUDIO_CODECS.get(codec)
+        elif track["type"] == "subtitle":
+            track["codec"] = MATROSKA_SUBTITLE_CODECS.get(codec)
+        tracks.append(track)
+    return (tracks, duration)
+
+
+def iter_mp4_boxes(data, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size:
+            raise ValueError("Invalid MP4 box size")
+        yield (box_type, pos + header_size, min(pos + size, end))
+        pos += size
+
+
+def find_mp4_box(data, start, end, box_path):
+    for box_type in box_path:
+        for child_type, child_start, child_end in iter_mp4_boxes(data, start, end):
+            if child_type == box_type:
+                start, end = child_start, child_end
+                break
+        else:
+            return None
+    return (start, end)
+
+
+def read_mp4_descriptor(data, pos):
+    tag = ord(data[pos:pos + 1])
+    pos += 1
+    size = 0
+    for _ in range(4):
+        byte = ord(data[pos:pos + 1])
+        pos += 1
+        size = (size << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return (tag, pos, pos + size)
 
 
-def print_track_list(track_list, file_name, track_type):
-    track_type = track_type.capitalize()
-    print_err("+ Video: '{0}'".format(file_name))
-    for track in track_list:
-        message_format = "   + [{1}] {0} track: {2}"
-        print_err(message_format.format(track_type, track.index, track.title or ""))
-        print_err(indent_text(str(track), "      + "))
+def read_mp4_audio_object_type(data, start, end):
+    # Skip the full box header, then find the DecoderConfigDescriptor
+    # inside the ES_Descriptor
+    tag, pos, _ = read_mp4_descriptor(data, start + 4)
+    if tag != 0x03:
+        return None
+    flags = ord(data[pos + 2:pos + 3])
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + ord(data[pos:pos + 1])
+    if flags & 0x20:
+        pos += 2
+    tag, pos, _ = read_mp4_descriptor(data, pos)
+    if tag != 0x04:
+        return None
+    return ord(data[pos:pos + 1])
+
+
+def read_mp4_language(packed):
+    packed &= 0x7FFF
+    if packed == 0 or packed == 0x7FFF:
+        return "und"
+    return "".join(chr(((packed >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+
+
+def parse_mp4_track(data, start, end):
+    mdia = find_mp4_box(data, start, end, [b"mdia"])
+    hdlr = mdia and find_mp4_box(data, mdia[0], mdia[1], [b"hdlr"])
+    mdhd = mdia and find_mp4_box(data, mdia[0], mdia[1], [b"mdhd"])
+    stsd = mdia and find_mp4_box(data, mdia[0], mdia[1], [b"minf", b"stbl", b"stsd"])
+    if not hdlr or not mdhd or not stsd:
+        return None
+    handler = data[hdlr[0] + 8:hdlr[0] + 12]
+    if handler == b"text":
+        # Possibly a chapter track, which HandBrake does not list
+        return None
+    track = {"type": {b"vide": "video", b"soun": "audio", b"sbtl": "subtitle",
+                      b"subt": "subtitle"}.get(handler)}
+    language_pos = mdhd[0] + (32 if ord(data[mdhd[0]:mdhd[0] + 1]) == 1 else 20)
+    track["language"] = read_mp4_language(struct.unpack(">H", data[language_pos:language_pos + 2])[0])
+    name = find_mp4_box(data, start, end, [b"udta", b"name"])
+    if name:
+        track["title"] = data[name[0]:name[1]].rstrip(b"\0").decode("utf-8", "replace")
+    entry_type, entry_start, entry_end = next(iter_mp4_boxes(data, stsd[0] + 8, stsd[1]))
+    if track["type"] == "audio":
+        version = struct.unpack(">H", data[entry_start + 8:entry_start + 10])[0]
+        if version > 1:
+            return None
+        track["channels"] = struct.unpack(">H", data[entry_start + 16:entry_start + 18])[0]
+        track["sample_rate"] = struct.unpack(">H", data[entry_start + 24:entry_start + 26])[0]
+        if entry_type == b"mp4a":
+            children_start = entry_start + (44 if version == 1 else 28)
+            esds = find_mp4_box(data, children_start, entry_end, [b"esds"])
+            object_type = esds and read_mp4_audio_object_type(data, esds[0], esds[1])
+            track["codec"] = MP4_AUDIO_OBJECT_TYPES.get(object_type)
+        else:
+            track["codec"] = MP4_AUDIO_CODECS.get(entry_type)
+    elif track["type"] == "subtitle":
+        track["codec"] = MP4_SUBTITLE_CODECS.get(entry_type)
+    elif track["type"] == "video":
+        track["codec"] = MP4_VIDEO_CODECS.get(entry_type)
+        track["width"], track["height"] = struct.unpack(
+            ">HH", data[entry_start + 24:entry_start + 28])
+    return track
+
+
+def read_mp4_duration(data, start, end):
+    mvhd = find_mp4_box(data, start, end, [b"mvhd"])
+    if not mvhd:
+        return None
+    if ord(data[mvhd[0]:mvhd[0] + 1]) == 1:
+        timescale, duration = struct.unpack(">IQ", data[mvhd[0] + 20:mvhd[0] + 32])
+    else:
+        timescale, duration = struct.unpack(">II", data[mvhd[0] + 12:mvhd[0] + 20])
+    if not timescale:
+        return None
+    return duration // timescale
+
+
+def probe_mp4_tracks(data):
+    moov = find_mp4_box(data, 0, len(data), [b"moov"])
+    if not moov:
+        return None
+    tracks = []
+    for box_type, start, end in iter_mp4_boxes(data, moov[0], moov[1]):
+        if box_type != b"trak":
+            continue
+        track = parse_mp4_track(data, start, end)
+        if track is None:
+            return None
+        tracks.append(track)
+    return (tracks, read_mp4_duration(data, moov[0], moov[1]))
+
+
+def create_probed_track_info(tracks, duration):
+    audio_tracks = []
+    subtitle_tracks = []
+    video_info = VideoInfo(duration, None, None)
+    for track in tracks:
+        if track["type"] == "video" and video_info.width is None:
+            video_info.width = track.get("width")
+            video_info.height = track.get("height")
+            video_info.codec = track.get("codec")
+        if track["type"] not in ("audio", "subtitle"):
+            continue
+        language_code = track["language"].lower()
+        language_code = LANGUAGE_CODE_ALIASES.get(language_code, language_code)
+        language = LANGUAGE_NAMES.get(language_code)
+        if track["codec"] is None or language is None:
+            return None
+        if track["type"] == "audio":
+            description = "{0} ({1})".format(language, track["codec"])
+            channels = track.get("channels")
+            if channels:
+                layout = {1: "1.0", 2: "2.0", 6: "5.1", 8: "7.1"}.get(channels, str(channels))
+                description += " ({0} ch)".format(layout)
+            info_str = "{0}, {1} (iso639-2: {2})".format(
+                len(audio_tracks) + 1, description, language_code)
+            if track.get("sample_rate"):
+                info_str += ", {0}Hz".format(track["sample_rate"])
+            info = HandBrakeAudioInfo(info_str)
+            audio_tracks.append(info)
+        else:
+            info_str = "{0}, {1} (iso639-2: {2}) ({3})({4})".format(
+                len(subtitle_tracks) + 1, language, language_code,
+                track["codec"][0], track["codec"][1])
+            info = HandBrakeSubtitleInfo(info_str)
+            subtitle_tracks.append(info)
+        info.title = track.get("title")
+    return (audio_tracks, subtitle_tracks, video_info)
+
+
+def probe_container_tracks(input_path):
+    try:
+        with open(input_path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        if data[:4] == b"\x1a\x45\xdf\xa3":
+            result = probe_matroska_tracks(data)
+        elif data[4:8] == b"ftyp":
+            result = probe_mp4_tracks(data)
+        else:
+            result = None
+    except (ValueError, TypeError, IndexError, StopIteration, struct.error):
+        result = None
+    finally:
+        data.close()
+    if result is None:
+        return None
+    return create_probed_track_info(*result)
+
+
+def tracks_to_data(track_list):
+    if track_list is None:
+        return None
+    return [track.to_data() for track in track_list]
+
+
+def tracks_from_data(data, info_cls):
+    if data is None:
+        return None
+    return [info_cls.from_data(item) for item in data]
+
+
+def get_track_info_cached(handbrake_path, input_path, scan_cache):
+    if not scan_cache:
+        return get_track_info(handbrake_path, input_path)
+    fingerprint, stat, data = scan_cache.lookup(input_path)
+    if data is not None:
+        logging.debug("Using cached scan results for '%s'", input_path)
+        return (tracks_from_data(data["audio"], HandBrakeAudioInfo),
+                tracks_from_data(data["subtitle"], HandBrakeSubtitleInfo),
+                VideoInfo.from_data(data.get("video")))
+    audio_tracks, subtitle_tracks, video_info = get_track_info(handbrake_path, input_path)
+    scan_cache.store(input_path, fingerprint, stat, {
+        "audio": tracks_to_data(audio_tracks),
+        "subtitle": tracks_to_data(subtitle_tracks),
+        "video": video_info.to_data()
+    })
+    return (audio_tracks, subtitle_tracks, video_info)
+
+
+def probe_track_info(args, input_path):
+    if args.native_probe:
+        with trace_span("probe_container_tracks", path=input_path):
+            track_info = probe_container_tracks(input_path)
+        if track_info:
+            logging.debug("Read tracks of '%s' from container header", input_path)
+            return track_info
+        logging.debug("Cannot read tracks of '%s' from container header", input_path)
+    return get_track_info_cached(args.handbrake_path, input_path, args.scan_cache)
+
+
+def get_track_by_index(track_list, track_index):
+    for track in track_list:
+        if track.index == track_index:
+            return track
+    raise IndexError("Invalid track index: " + str(track_index))
+
+
+def filter_tracks_by_language(track_list, preferred_languages, manual_und):
+    for preferred_language_code in preferred_languages:
+        preferred_language_code = preferred_language_code.lower()
+        if preferred_language_code == "none":
+            return None
+        und_count = 0
+        filtered_tracks = []
+        for track in track_list:
+            if track.language_code == preferred_language_code:
+                filtered_tracks.append(track)
+            elif track.language_code == "und":
+                und_count += 1
+                filtered_tracks.append(track)
+        if len(filtered_tracks) - und_count >= 1:
+            return filtered_tracks
+        elif len(track_list) == und_count:
+            if und_count == 1 and not manual_und:
+                return track_list
+            return []
+    return []
+
+
+def print_track_list(track_list, file_name, track_type):
+    track_type = track_type.capitalize()
+    print_err("+ Video: '{0}'".format(file_name))
+    for track in track_list:
+        message_format = "   + [{1}] {0} track: {2}"
+        print_err(message_format.format(track_type, track.index, track.title or ""))
+        print_err(indent_text(str(track), "      + "))
 
 
 def prompt_select_track(track_list, filtered_track_list, file_name, track_type):
@@ -532,7 +3291,7 @@ def prompt_overwrite_file(file_name):
 
 
 def select_best_track(track_list, preferred_languages, manual_und,
-        file_name, track_type):
+        file_name, track_type, decisions=None, interactive=True):
     if len(track_list) == 0:
         logging.info("No %s tracks found", track_type)
         return None
@@ -553,23 +3312,41 @@ def select_best_track(track_list, preferred_languages, manual_und,
         else:
             message_format = "More than one %s track matches language list: %s"
         logging.info(message_format, track_type, preferred_languages)
-        track = prompt_select_track(track_list, filtered_tracks, file_name, track_type)
+        if decisions:
+            try:
+                track = decisions.get_selection(track_list, track_type)
+            except (KeyError, IndexError):
+                pass
+            else:
+                if track:
+                    message_format = "Previously selected %s track #%d with language '%s'"
+                    logging.info(message_format, track_type, track.index, track.language_code)
+                else:
+                    logging.info("Previously discarded %s track", track_type)
+                return track
+        if not interactive:
+            raise TrackDecisionNeeded(track_type)
+        with suspend_progress_display(), trace_span("prompt_select_track", file=file_name):
+            track = prompt_select_track(track_list, filtered_tracks, file_name, track_type)
         if track:
             message_format = "User selected %s track #%d with language '%s'"
             logging.info(message_format, track_type, track.index, track.language_code)
         else:
             logging.info("User discarded %s track", track_type)
+        if decisions:
+            decisions.record(track_list, track_type, track)
         return track
 
 
 def select_best_track_cached(selected_track_map, track_list,
-        preferred_languages, manual_und, file_name, track_type):
+        preferred_languages, manual_und, file_name, track_type,
+        decisions=None, interactive=True):
     track_set = tuple(track_list)
     try:
         track = selected_track_map[track_set]
     except KeyError:
         track = select_best_track(track_list, preferred_languages,
-            manual_und, file_name, track_type)
+            manual_und, file_name, track_type, decisions, interactive)
         selected_track_map[track_set] = track
     else:
         track_type = track_type.capitalize()
@@ -583,56 +3360,55 @@ def select_best_track_cached(selected_track_map, track_list,
     return track
 
 
-def process_handbrake_output(process):
-    pattern1 = re.compile(r"Encoding: task \d+ of \d+, (\d+\.\d\d) %")
-    pattern2 = re.compile(
-        r"Encoding: task \d+ of \d+, (\d+\.\d\d) % "
-        r"\((\d+\.\d\d) fps, avg (\d+\.\d\d) fps, ETA (\d\dh\d\dm\d\ds)\)")
-    percent_complete = None
-    current_fps = None
-    average_fps = None
-    estimated_time = None
-    prev_message = ""
-    format_str = "Progress: {percent:.2f}% done"
-    long_format_str = format_str + " (FPS: {fps:.2f}, average FPS: {avg_fps:.2f}, ETA: {eta})"
-    try:
-        while True:
-            output = process.stdout.readline()
-            if len(output) == 0:
-                break
-            output = output.rstrip()
-            match = pattern1.match(output)
-            if not match:
-                continue
-            percent_complete = float(match.group(1))
-            match = pattern2.match(output)
-            if match:
-                format_str = long_format_str
-                current_fps = float(match.group(2))
-                average_fps = float(match.group(3))
-                estimated_time = match.group(4)
-            message = format_str.format(
-                percent=percent_complete,
-                fps=current_fps,
-                avg_fps=average_fps,
-                eta=estimated_time)
-            print_err(message, end="")
-            blank_count = max(len(prev_message) - len(message), 0)
-            print_err(" " * blank_count, end="\r")
-            prev_message = message
-    finally:
-        print_err(flush=True)
+HANDBRAKE_PROGRESS_PATTERN = re.compile(
+    r"Encoding: task \d+ of \d+, (\d+\.\d\d) %"
+    r"(?: \((\d+\.\d\d) fps, avg (\d+\.\d\d) fps, ETA (\d\dh\d\dm\d\ds)\))?")
+
 
+class HandBrakeProgressParser(object):
+    def __init__(self):
+        # Early updates do not include the speed, keep showing the
+        # last known one until the next update that does
+        self.current_fps = None
+        self.average_fps = None
+        self.estimated_time = None
 
-def run_handbrake(arg_list):
+    def feed(self, line):
+        if not line.startswith("Encoding: "):
+            return None
+        match = HANDBRAKE_PROGRESS_PATTERN.match(line)
+        if not match:
+            return None
+        if match.group(2):
+            self.current_fps = float(match.group(2))
+            self.average_fps = float(match.group(3))
+            self.estimated_time = match.group(4)
+        return EncodeProgress(float(match.group(1)),
+            self.current_fps, self.average_fps, self.estimated_time)
+
+
+def process_handbrake_output(process, report_progress):
+    parser = HandBrakeProgressParser()
+    while True:
+        output = process.stdout.readline()
+        if len(output) == 0:
+            break
+        progress = parser.feed(output)
+        if progress:
+            report_progress(progress)
+
+
+def run_handbrake(arg_list, report_progress, on_start=None):
     logging.debug("HandBrake args: '%s'", subprocess.list2cmdline(arg_list))
     process = subprocess.Popen(
         arg_list,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         universal_newlines=True)
+    if on_start:
+        on_start(process)
     try:
-        process_handbrake_output(process)
+        process_handbrake_output(process, report_progress)
     except:
         process.kill()
         process.wait()
@@ -659,6 +3435,458 @@ def get_handbrake_args(handbrake_path, input_path, output_path,
     return [handbrake_path] + args
 
 
+def get_segments(video_info, segment_count):
+    duration = video_info.duration
+    if not duration or duration < SPLIT_MIN_DURATION:
+        return None
+    chapters = video_info.chapters or []
+    if len(chapters) < segment_count:
+        segment_count = min(segment_count, int(duration // SPLIT_MIN_SEGMENT_DURATION))
+        if segment_count < 2:
+            return None
+        # Split into equal lengths of time, with the last segment
+        # running to the end so nothing is lost to rounding
+        starts = [int(duration) * i // segment_count for i in range(segment_count)]
+        segments = []
+        for i, start in enumerate(starts):
+            range_args = ["--start-at", "seconds:{0}".format(start)]
+            if i < segment_count - 1:
+                length = starts[i + 1] - start
+                range_args += ["--stop-at", "seconds:{0}".format(length)]
+            else:
+                length = duration - start
+            segments.append((range_args, length))
+        return segments
+    # Group consecutive chapters into segments of similar length
+    total = float(sum(chapters)) or 1.0
+    segments = []
+    first_chapter = 1
+    segment_duration = 0
+    elapsed = 0
+    for chapter, chapter_duration in enumerate(chapters, 1):
+        segment_duration += chapter_duration
+        elapsed += chapter_duration
+        segments_left = segment_count - len(segments) - 1
+        is_boundary = elapsed >= total * (len(segments) + 1) / segment_count
+        chapters_left = len(chapters) - chapter
+        # Cut early rather than run out of chapters for the rest
+        if chapter == len(chapters) or (segments_left > 0 and
+                (is_boundary and chapters_left >= segments_left or
+                 chapters_left == segments_left)):
+            range_args = ["--chapters", "{0}-{1}".format(first_chapter, chapter)]
+            segments.append((range_args, segment_duration))
+            first_chapter = chapter + 1
+            segment_duration = 0
+    if len(segments) < 2:
+        return None
+    return segments
+
+
+def get_segment_path(output_path, segment_index):
+    base_path, extension = os.path.splitext(output_path)
+    return "{0}.segment{1}{2}".format(base_path, segment_index, extension)
+
+
+def get_segment_args(arg_list, range_args, segment_path):
+    arg_list = list(arg_list)
+    arg_list[arg_list.index("-o") + 1] = segment_path
+    return arg_list + range_args
+
+
+class SegmentProgress(object):
+    def __init__(self, segments, report_progress):
+        self.weights = [duration for _, duration in segments]
+        self.total_weight = float(sum(self.weights)) or 1.0
+        self.report_progress = report_progress
+        self.lock = threading.Lock()
+        self.progress = [None] * len(segments)
+
+    def get_reporter(self, segment_index):
+        return lambda progress: self.update(segment_index, progress)
+
+    def update(self, segment_index, progress):
+        with self.lock:
+            self.progress[segment_index] = progress
+            percent = 0.0
+            fps = None
+            avg_fps = None
+            eta = None
+            for weight, segment_progress in zip(self.weights, self.progress):
+                if segment_progress is None:
+                    continue
+                percent += segment_progress.percent * weight / self.total_weight
+                if segment_progress.fps is not None:
+                    fps = (fps or 0) + segment_progress.fps
+                    avg_fps = (avg_fps or 0) + segment_progress.avg_fps
+                    # Segments run at the same time, so the slowest one
+                    # decides when the whole video is done
+                    eta = max(eta or "", segment_progress.eta)
+            self.report_progress(EncodeProgress(percent, fps, avg_fps, eta))
+
+
+def run_handbrake_segments(arg_lists, progress, on_start=None):
+    processes = {}
+    errors = []
+    lock = threading.Lock()
+
+    def start_segment(segment_index, process):
+        with lock:
+            processes[segment_index] = process
+            failed = bool(errors)
+        if failed:
+            # Another segment failed while this one was starting
+            process.kill()
+        elif on_start:
+            on_start(segment_index, process)
+
+    def encode_segment(segment_index, arg_list):
+        try:
+            run_handbrake(arg_list, progress.get_reporter(segment_index),
+                lambda process: start_segment(segment_index, process))
+        except Exception:
+            with lock:
+                errors.append(sys.exc_info()[1])
+                # There is no point finishing the other segments
+                for process in processes.values():
+                    try:
+                        process.kill()
+                    except OSError:
+                        pass
+
+    threads = []
+    for segment_index, arg_list in enumerate(arg_lists):
+        threads.append(start_thread(encode_segment, (segment_index, arg_list),
+            "{0}-segment-{1}".format(threading.current_thread().name, segment_index)))
+    wait_for_threads(threads)
+    if errors:
+        raise errors[0]
+
+
+def find_segment_joiner(output_format):
+    ffmpeg_path = find_executable_in_path("ffmpeg")
+    if ffmpeg_path:
+        return ("ffmpeg", ffmpeg_path)
+    mkvmerge_path = find_executable_in_path("mkvmerge")
+    if mkvmerge_path and output_format == "mkv":
+        return ("mkvmerge", mkvmerge_path)
+    return None
+
+
+def join_segments(joiner, segment_paths, output_path, on_start=None):
+    joiner_name, joiner_path = joiner
+    list_path = None
+    if joiner_name == "mkvmerge":
+        arg_list = [joiner_path, "-q", "-o", output_path, segment_paths[0]]
+        for segment_path in segment_paths[1:]:
+            arg_list += ["+", segment_path]
+        # mkvmerge exits with 1 when it only had warnings
+        max_retcode = 1
+    else:
+        list_path = output_path + ".txt"
+        with open(list_path, "w") as f:
+            for segment_path in segment_paths:
+                f.write("file '{0}'\n".format(segment_path.replace("'", "'\\''")))
+        arg_list = [joiner_path, "-nostdin", "-v", "error", "-y", "-f", "concat",
+            "-safe", "0", "-i", list_path, "-map", "0", "-c", "copy", output_path]
+        max_retcode = 0
+    logging.debug("Join args: '%s'", subprocess.list2cmdline(arg_list))
+    try:
+        process = subprocess.Popen(arg_list,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if on_start:
+            on_start(process)
+        output = process.communicate()[0]
+        if process.returncode < 0 or process.returncode > max_retcode:
+            logging.error("%s: %s", joiner_name, output.strip())
+            raise subprocess.CalledProcessError(process.returncode, arg_list)
+    finally:
+        if list_path:
+            try_delete_file(list_path)
+
+
+def set_encoder_threads(arg_list, thread_count):
+    encoder = None
+    for i, arg in enumerate(arg_list[:-1]):
+        if arg in ("-e", "--encoder"):
+            encoder = arg_list[i + 1]
+    if encoder is None or not encoder.startswith(("x264", "x265")):
+        return arg_list
+    option = "{0}={1}".format("threads" if encoder.startswith("x264") else "pools", thread_count)
+    arg_list = list(arg_list)
+    for i, arg in enumerate(arg_list[:-1]):
+        if arg in ("-x", "--encopts"):
+            arg_list[i + 1] += ":" + option
+            return arg_list
+    return arg_list + ["--encopts", option]
+
+
+def parse_cpu_list(value):
+    cpus = []
+    for part in value.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def get_numa_nodes():
+    node_dir = "/sys/devices/system/node"
+    nodes = []
+    try:
+        node_names = os.listdir(node_dir)
+    except OSError:
+        return nodes
+    for node_name in sorted(node_names):
+        if not re.match(r"node\d+$", node_name):
+            continue
+        try:
+            with open(os.path.join(node_dir, node_name, "cpulist")) as f:
+                nodes.append(parse_cpu_list(f.read()))
+        except (IOError, OSError, ValueError):
+            continue
+    return nodes
+
+
+def get_cpu_partitions(slot_count):
+    if not hasattr(os, "sched_getaffinity"):
+        logging.warning("CPU pinning is not supported on this platform")
+        return None
+    available = os.sched_getaffinity(0)
+    nodes = [[cpu for cpu in node if cpu in available] for node in get_numa_nodes()]
+    nodes = [node for node in nodes if node]
+    if not nodes:
+        nodes = [sorted(available)]
+    # Give every node a number of slots proportional to its number
+    # of cores, rounding so that the totals add up
+    total = sum(len(node) for node in nodes)
+    shares = [float(slot_count) * len(node) / total for node in nodes]
+    node_slots = [int(share) for share in shares]
+    by_remainder = sorted(range(len(nodes)), key=lambda i: node_slots[i] - shares[i])
+    for i in by_remainder[:slot_count - sum(node_slots)]:
+        node_slots[i] += 1
+    partitions = []
+    for node, count in zip(nodes, node_slots):
+        for i in range(count):
+            if count > len(node):
+                # More jobs than cores on this node, so they must share
+                cpus = [node[i % len(node)]]
+            else:
+                cpus = node[i * len(node) // count:(i + 1) * len(node) // count]
+            partitions.append(set(cpus))
+    return partitions
+
+
+def get_cpu_count():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def get_memory_pressure():
+    try:
+        with open("/proc/pressure/memory") as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == "some":
+                    stall = float(fields[1].partition("=")[2])
+                    if stall > AUTO_JOBS_MEMORY_PRESSURE:
+                        return "memory stall time at {0:.1f}%".format(stall)
+                    return None
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        meminfo = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                meminfo[name] = int(value.split()[0])
+        used = 100.0 * (1 - float(meminfo["MemAvailable"]) / meminfo["MemTotal"])
+    except (IOError, OSError, ValueError, IndexError, KeyError, ZeroDivisionError):
+        return None
+    if used > AUTO_JOBS_MEMORY_USED:
+        return "memory {0:.1f}% in use".format(used)
+    return None
+
+
+def get_process_threads(pid):
+    try:
+        return [int(thread_id) for thread_id in os.listdir("/proc/{0}/task".format(pid))]
+    except (OSError, ValueError):
+        return [pid]
+
+
+def set_io_priority(thread_id, ioprio_class, level):
+    syscall_number = IOPRIO_SET_SYSCALLS.get(os.uname()[4])
+    if ctypes is None or syscall_number is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is not supported on this platform")
+    libc = ctypes.CDLL(None, use_errno=True)
+    ioprio_who_process = 1
+    ioprio = (ioprio_class << 13) | level
+    if libc.syscall(syscall_number, ioprio_who_process, thread_id, ioprio) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def create_job_cgroups(base_dir, slot_count, cpu_quota):
+    if cpu_quota:
+        try:
+            with open(os.path.join(base_dir, "cgroup.subtree_control"), "w") as f:
+                f.write("+cpu")
+        except (IOError, OSError) as e:
+            logging.warning("Cannot enable the cpu controller in '%s': %s", base_dir, e)
+    cgroup_dirs = []
+    for slot in range(slot_count):
+        cgroup_dir = os.path.join(base_dir, "aniconvert-{0}-{1}".format(os.getpid(), slot))
+        try:
+            try_create_directory(cgroup_dir)
+            if cpu_quota:
+                period = 100000
+                with open(os.path.join(cgroup_dir, "cpu.max"), "w") as f:
+                    f.write("{0} {1}".format(int(cpu_quota * period), period))
+        except (IOError, OSError) as e:
+            logging.warning("Cannot set up cgroup '%s', not using cgroups: %s", cgroup_dir, e)
+            for created_dir in cgroup_dirs + [cgroup_dir]:
+                try:
+                    os.rmdir(created_dir)
+                except OSError:
+                    pass
+            return None
+        cgroup_dirs.append(cgroup_dir)
+    return cgroup_dirs
+
+
+def get_handbrake_version(handbrake_path):
+    process = subprocess.Popen(
+        [handbrake_path, "--version"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode("utf-8", "replace")
+    match = re.search(r"HandBrake (\S+)", output)
+    if match:
+        return match.group(1)
+    # Fall back to identifying the binary itself
+    stat = os.stat(handbrake_path)
+    return "unknown-{0}-{1}".format(stat.st_size, int(stat.st_mtime))
+
+
+def get_default_cache_dir():
+    if os.name == "nt":
+        base_dir = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base_dir, "aniconvert")
+
+
+def open_scan_cache(args):
+    if not args.scan_cache:
+        return None
+    if sqlite3 is None:
+        logging.error("Scan cache requires the sqlite3 module")
+        return None
+    if args.scan_cache == "default":
+        cache_dir = get_default_cache_dir()
+        try_create_directory(cache_dir)
+        args.scan_cache = os.path.join(cache_dir, "scan-cache.db")
+    handbrake_version = get_handbrake_version(args.handbrake_path)
+    logging.debug("HandBrake version: %s", handbrake_version)
+    try:
+        scan_cache = ScanCache(args.scan_cache, handbrake_version, SCAN_CACHE_MAX_ENTRIES)
+    except sqlite3.Error as e:
+        logging.error("Cannot open scan cache '%s': %s", args.scan_cache, e)
+        return None
+    if args.clear_scan_cache:
+        logging.info("Clearing scan cache")
+        scan_cache.clear()
+    return scan_cache
+
+
+def open_run_estimator(args):
+    if not args.eta_history or args.eta_history.lower() == "none":
+        return None
+    if args.eta_history == "default":
+        args.eta_history = os.path.join(get_default_cache_dir(), "eta-history.json")
+    settings = "{0} {1} {2}".format(HANDBRAKE_ARGS, args.output_format, args.output_dimensions)
+    settings_key = hashlib.sha1(settings.encode("utf-8")).hexdigest()[:12]
+    return RunEstimator(args.eta_history, settings_key, args.jobs)
+
+
+def open_resource_control(args):
+    if not (args.pin_cpus or args.nice is not None or args.ionice or args.cgroup):
+        return None
+    return ResourceControl(args, args.jobs)
+
+
+def open_dir_index(args):
+    if not args.dir_index:
+        return None
+    if args.dir_index == "default":
+        args.dir_index = os.path.join(get_default_cache_dir(), "dir-index.json")
+    return DirectoryIndex(args.dir_index, args.input_dir)
+
+
+def open_track_decisions(args):
+    if not (args.decisions or args.import_decisions or args.export_decisions):
+        return None
+    if args.decisions == "default":
+        args.decisions = os.path.join(get_default_cache_dir(), "decisions.json")
+    decisions = TrackDecisionStore(args.decisions)
+    if args.import_decisions:
+        decisions.import_file(args.import_decisions)
+    return decisions
+
+
+def close_track_decisions(args):
+    if args.export_decisions:
+        args.decisions.export_file(args.export_decisions)
+    unresolved_count = args.decisions.get_unresolved_count()
+    if unresolved_count and args.decisions.path:
+        logging.warning("%d video(s) are waiting for a track decision in '%s'",
+            unresolved_count, args.decisions.path)
+
+
+def get_journal_path(args):
+    journal_name = JOURNAL_FILE_NAME
+    # Hosts converting slices of a plan may share an output directory
+    if args.shard:
+        journal_name += "-{0}-of-{1}".format(*args.shard)
+    return os.path.join(args.output_dir, journal_name)
+
+
+def open_job_journal(args):
+    try_create_directory(args.output_dir)
+    journal_path = get_journal_path(args)
+    if args.resume and not os.path.exists(journal_path):
+        logging.info("No interrupted run to resume in '%s'", args.output_dir)
+    elif not args.resume and os.path.exists(journal_path):
+        old_journal_path = journal_path + ".old"
+        logging.warning("Found the journal of an unfinished run in '%s', moving it to '%s' "
+            "(use --resume to continue it instead)", args.output_dir, old_journal_path)
+        replace_file(journal_path, old_journal_path)
+    return JobJournal(journal_path, args.input_dir, args.resume)
+
+
+def open_output_manifest(args):
+    if not args.write_manifest:
+        return None
+    manifest_path = os.path.join(args.output_dir, MANIFEST_FILE_NAME)
+    return OutputManifest(manifest_path, args.input_dir, args.output_dir, args.output_dimensions)
+
+
+def open_progress_events(args):
+    if not args.progress_events:
+        return None
+    try:
+        if args.progress_events.startswith("fd:"):
+            stream = os.fdopen(int(args.progress_events[3:]), "w")
+        else:
+            stream = open(args.progress_events, "a")
+    except (IOError, OSError, ValueError) as e:
+        logging.error("Cannot open progress event file '%s': %s", args.progress_events, e)
+        return None
+    return ProgressEventWriter(stream)
+
+
 def check_handbrake_executable(file_path):
     if not os.path.isfile(file_path):
         return False
@@ -684,6 +3912,16 @@ def find_handbrake_executable_in_path(name):
     return None
 
 
+def find_executable_in_path(name):
+    if os.name == "nt" and not name.lower().endswith(".exe"):
+        name += ".exe"
+    for dir_path in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        file_path = os.path.join(dir_path, name)
+        if os.path.isfile(file_path) and os.access(file_path, os.X_OK):
+            return file_path
+    return None
+
+
 def find_handbrake_executable():
     name = HANDBRAKE_EXE
     if os.path.dirname(name):
@@ -698,118 +3936,1708 @@ def find_handbrake_executable():
     return None
 
 
-def check_output_path(args, output_path):
+def is_output_current(args, input_path, output_path):
+    current = None
+    if args.manifest:
+        current = args.manifest.is_current(input_path, output_path)
+    if current is None:
+        # Not converted with a manifest, fall back to comparing times
+        current = get_mtime(output_path) >= get_mtime(input_path)
+    return current
+
+
+def check_output_path(args, input_path, output_path, output_entries):
     simp_output_path = get_simplified_path(args.output_dir, output_path)
-    if not os.path.exists(output_path):
+    output_is_dir = output_entries.get(os.path.normcase(os.path.basename(output_path)))
+    if output_is_dir is None:
         return True
-    if os.path.isdir(output_path):
+    if output_is_dir:
         logging.error("Output path '%s' is a directory, skipping file", simp_output_path)
         return False
+    if args.duplicate_action == "prompt" and args.non_interactive:
+        logging.warning("Destination file '%s' already exists, skipping", simp_output_path)
+        return False
     if args.duplicate_action == "prompt":
-        return prompt_overwrite_file(simp_output_path)
+        with suspend_progress_display(), trace_span("prompt_overwrite_file", file=simp_output_path):
+            return prompt_overwrite_file(simp_output_path)
     elif args.duplicate_action == "skip":
         logging.info("Destination file '%s' already exists, skipping", simp_output_path)
         return False
     elif args.duplicate_action == "overwrite":
         logging.info("Destination file '%s' already exists, overwriting", simp_output_path)
         return True
+    elif args.duplicate_action == "changed":
+        if is_output_current(args, input_path, output_path):
+            logging.info("Destination file '%s' is up to date, skipping", simp_output_path)
+            return False
+        logging.info("Destination file '%s' is out of date, overwriting", simp_output_path)
+        return True
 
 
 def filter_convertible_files(args, dir_path, file_names):
+    # Output directories are created when a video is converted
     output_dir = get_output_dir(args.output_dir, args.input_dir, dir_path)
     try:
-        try_create_directory(output_dir)
+        output_mtime = None
+        if args.dir_index:
+            output_mtime = get_mtime(output_dir)
+            if output_mtime is not None and args.dir_index.is_settled(dir_path, output_mtime):
+                logging.info("Nothing has changed since the last run, skipping")
+                return []
+        output_entries = get_output_dir_entries(output_dir)
     except OSError as e:
-        logging.error("Cannot create output directory: '%s'", output_dir)
+        logging.error("Cannot read output directory: '%s'", output_dir)
         return []
     convertible_files = []
     for file_name in file_names:
         output_file_name = replace_extension(file_name, args.output_format)
         output_path = os.path.join(output_dir, output_file_name)
-        if not check_output_path(args, output_path):
+        if args.resume and args.journal.get_state(os.path.join(dir_path, file_name)) == "done":
+            if output_entries.get(os.path.normcase(output_file_name)) is False:
+                logging.info("Video '%s' was already converted, skipping", file_name)
+                continue
+        if not check_output_path(args, os.path.join(dir_path, file_name), output_path, output_entries):
             continue
         convertible_files.append(file_name)
+    # Other duplicate actions may give a different answer next time
+    if args.dir_index and not convertible_files and args.duplicate_action == "skip":
+        args.dir_index.set_settled(dir_path, output_mtime)
+    input_paths = [os.path.join(dir_path, file_name) for file_name in convertible_files]
+    args.journal.record(
+        [p for p in input_paths if not args.journal.get_state(p)], "pending")
     return convertible_files
 
 
-def get_track_map(args, dir_path, file_names):
+def iter_track_map(args, dir_path, file_names):
     selected_audio_track_map = {}
     selected_subtitle_track_map = {}
-    track_map = collections.OrderedDict()
-    for file_name in file_names:
-        logging.info("Scanning '%s'", file_name)
+
+    def get_resumed_track_info(file_name):
+        if not args.resume:
+            return None
+        return args.journal.get_track_info(os.path.join(dir_path, file_name))
+
+    def scan_file(file_name):
+        if get_resumed_track_info(file_name):
+            return None
         file_path = os.path.join(dir_path, file_name)
+        start_time = time.time()
+        result = probe_track_info(args, file_path)
+        args.metrics.record_scan(file_path, time.time() - start_time)
+        return result
+
+    for file_name, result in map_parallel(scan_file, file_names, args.scan_jobs):
+        track_info = get_resumed_track_info(file_name)
+        if track_info:
+            logging.info("Using previously selected tracks for '%s'", file_name)
+            yield (file_name, track_info)
+            continue
+        logging.info("Scanning '%s'", file_name)
+        if args.progress_events:
+            simp_input_path = get_simplified_path(args.input_dir, os.path.join(dir_path, file_name))
+            args.progress_events.write("scan", input_path=simp_input_path)
         try:
-            audio_tracks, subtitle_tracks = get_track_info(
-                args.handbrake_path, file_path)
+            audio_tracks, subtitle_tracks, video_info = result.get()
         except subprocess.CalledProcessError as e:
             logging.error("Error occurred while scanning '%s': %s", file_name, e)
             continue
-        selected_audio_track = select_best_track_cached(
-            selected_audio_track_map, audio_tracks,
-            args.audio_languages, args.manual_und,
-            file_name, "audio")
-        selected_subtitle_track = select_best_track_cached(
-            selected_subtitle_track_map, subtitle_tracks,
-            args.subtitle_languages, args.manual_und,
-            file_name, "subtitle")
-        track_map[file_name] = TrackInfo(
-            selected_audio_track, selected_subtitle_track)
-    return track_map
+        interactive = not args.non_interactive
+        try:
+            selected_audio_track = select_best_track_cached(
+                selected_audio_track_map, audio_tracks,
+                args.audio_languages, args.manual_und,
+                file_name, "audio", args.decisions, interactive)
+            selected_subtitle_track = select_best_track_cached(
+                selected_subtitle_track_map, subtitle_tracks,
+                args.subtitle_languages, args.manual_und,
+                file_name, "subtitle", args.decisions, interactive)
+        except TrackDecisionNeeded as e:
+            track_type = str(e)
+            logging.warning("No %s track decision for '%s', skipping", track_type, file_name)
+            if args.decisions:
+                track_list = audio_tracks if track_type == "audio" else subtitle_tracks
+                args.decisions.add_unresolved(track_list, track_type, os.path.join(dir_path, file_name))
+            continue
+        track_info = TrackInfo(selected_audio_track, selected_subtitle_track, video_info)
+        args.journal.record([os.path.join(dir_path, file_name)], "scanned", track_info)
+        yield (file_name, track_info)
 
 
-def generate_batch(args, dir_path, file_names):
+def get_track_map(args, dir_path, file_names):
+    return collections.OrderedDict(iter_track_map(args, dir_path, file_names))
+
+
+def iter_batch_tracks(args, dir_path, file_names):
     simp_dir_path = get_simplified_path(args.input_dir, dir_path)
     logging.info("Scanning videos in '%s'", simp_dir_path)
-    convertible_files = filter_convertible_files(args, dir_path, file_names)
-    track_map = get_track_map(args, dir_path, convertible_files)
-    if len(track_map) == 0:
+    with trace_span("filter_convertible_files", path=dir_path, count=len(file_names)):
+        convertible_files = filter_convertible_files(args, dir_path, file_names)
+    found = False
+    for file_name, track_info in iter_track_map(args, dir_path, convertible_files):
+        found = True
+        yield (file_name, track_info)
+    if not found:
         logging.warning("No videos in '%s' can be converted", simp_dir_path)
-        return None
-    return BatchInfo(dir_path, track_map)
 
 
-def generate_batches(args):
-    dir_list = get_files_in_dir(args.input_dir, args.input_formats, args.recursive_search)
-    batch_list = []
+def iter_input_dirs(args):
+    if args.input_file:
+        dir_list = [(args.input_dir, [args.input_file])]
+    else:
+        dir_list = get_files_in_dir(args.input_dir, args.input_formats,
+            args.recursive_search, args.dir_index)
     found = False
     for dir_path, file_names in dir_list:
         found = True
-        batch = generate_batch(args, dir_path, file_names)
-        if batch:
-            batch_list.append(batch)
+        yield (dir_path, file_names)
     if not found:
         message = "No videos found in input directory"
         if not args.recursive_search:
             message += ", for recursive search specify '-r'"
         logging.info(message)
+
+
+def generate_batch(args, dir_path, file_names):
+    track_map = collections.OrderedDict(iter_batch_tracks(args, dir_path, file_names))
+    if len(track_map) == 0:
+        return None
+    return BatchInfo(dir_path, track_map)
+
+
+def generate_batches(args):
+    batch_list = []
+    for dir_path, file_names in iter_input_dirs(args):
+        batch = generate_batch(args, dir_path, file_names)
+        if batch:
+            batch_list.append(batch)
     return batch_list
 
 
-def execute_batch(args, batch):
-    output_dir = get_output_dir(args.output_dir, args.input_dir, batch.dir_path)
-    try_create_directory(output_dir)
-    for file_name, track_info in batch.track_map.items():
-        output_file_name = replace_extension(file_name, args.output_format)
-        input_path = os.path.join(batch.dir_path, file_name)
-        output_path = os.path.join(output_dir, output_file_name)
-        simp_input_path = get_simplified_path(args.input_dir, input_path)
-        handbrake_args = get_handbrake_args(args.handbrake_path,
-            input_path, output_path, track_info.audio_track,
-            track_info.subtitle_track, args.output_dimensions)
-        logging.info("Converting '%s'", simp_input_path)
+def create_encode_job(args, job_id, dir_path, file_name, track_info):
+    output_dir = get_output_dir(args.output_dir, args.input_dir, dir_path)
+    output_file_name = replace_extension(file_name, args.output_format)
+    input_path = os.path.join(dir_path, file_name)
+    output_path = os.path.join(output_dir, output_file_name)
+    temp_output_path = get_temp_output_path(output_path)
+    simp_input_path = get_simplified_path(args.input_dir, input_path)
+    handbrake_args = get_handbrake_args(args.handbrake_path,
+        input_path, temp_output_path, track_info.audio_track,
+        track_info.subtitle_track, args.output_dimensions)
+    segments = None
+    if args.split:
+        segments = get_segments(track_info.video_info, args.split)
+    return EncodeJob(job_id, input_path, output_path, temp_output_path,
+        simp_input_path, track_info, handbrake_args, segments)
+
+
+def create_remote_job(handbrake_path, lease_id, data):
+    track_info = TrackInfo.from_data(data["tracks"])
+    video_dimensions = data["video_dimensions"]
+    if video_dimensions != "auto":
+        video_dimensions = tuple(video_dimensions)
+    # A requeued job may still be running on a worker that went
+    # quiet, so each lease writes to its own temporary file
+    temp_output_path = get_temp_output_path(data["output_path"], lease_id)
+    handbrake_args = get_handbrake_args(handbrake_path,
+        data["input_path"], temp_output_path, track_info.audio_track,
+        track_info.subtitle_track, video_dimensions)
+    return EncodeJob(data["job_id"], data["input_path"], data["output_path"],
+        temp_output_path, data["simp_input_path"], track_info, handbrake_args)
+
+
+def iter_jobs(args):
+    job_id = 1
+    if args.watch:
+        dir_list = iter_watched_dirs(args)
+    else:
+        dir_list = iter_input_dirs(args)
+    for dir_path, file_names in dir_list:
+        for file_name, track_info in iter_batch_tracks(args, dir_path, file_names):
+            yield create_encode_job(args, job_id, dir_path, file_name, track_info)
+            job_id += 1
+
+
+def sort_jobs(jobs, order):
+    def get_sort_key(job):
+        cost = job.track_info.video_info.get_cost(order)
+        # Videos of unknown length go first, in case they are long
+        if cost is None:
+            return (0, 0, job.job_id)
+        return (1, -cost, job.job_id)
+    return sorted(jobs, key=get_sort_key)
+
+
+def get_plan_path(base_dir, path):
+    # Plans may be shared between hosts, so paths are stored relative
+    # to the input and output directories with forward slashes
+    return os.path.relpath(path, base_dir).replace(os.sep, "/")
+
+
+def write_job_plan(args, jobs):
+    entries = []
+    for job in jobs:
+        audio_track = job.track_info.audio_track
+        subtitle_track = job.track_info.subtitle_track
+        video_info = job.track_info.video_info
+        entries.append({
+            "input": get_plan_path(args.input_dir, job.input_path),
+            "output": get_plan_path(args.output_dir, job.output_path),
+            "audio": audio_track and audio_track.to_data(),
+            "subtitle": subtitle_track and subtitle_track.to_data(),
+            "video": video_info.to_data(),
+            "cost": video_info.get_cost("cost"),
+        })
+    plan = {
+        "input_dir": args.input_dir,
+        "output_dir": args.output_dir,
+        "output_format": args.output_format,
+        "output_dimensions": args.output_dimensions,
+        "jobs": entries,
+    }
+    try:
+        write_file_atomic(args.plan, json.dumps(plan, indent=2, sort_keys=True) + "\n")
+    except (IOError, OSError) as e:
+        logging.error("Cannot write plan '%s': %s", args.plan, e)
+        return
+    logging.info("Wrote %d video(s) to plan '%s'", len(entries), args.plan)
+
+
+def load_job_plan(args):
+    try:
+        with open(args.execute_plan, "r") as f:
+            plan = json.load(f)
+        input_dir = plan["input_dir"]
+        output_dir = plan["output_dir"]
+        output_format = plan["output_format"]
+        output_dimensions = plan["output_dimensions"]
+        jobs = plan["jobs"]
+    except IOError as e:
+        logging.error("Cannot read plan '%s': %s", args.execute_plan, e)
+        return False
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error("Invalid plan '%s': %s", args.execute_plan, e)
+        return False
+    if output_dimensions != "auto":
+        output_dimensions = tuple(output_dimensions)
+    args.input_dir = args.input_dir or input_dir
+    args.output_dir = args.output_dir or output_dir
+    args.output_format = output_format
+    args.output_dimensions = output_dimensions
+    args.plan_jobs = jobs
+    return True
+
+
+def get_plan_shard(entries, shard_index, shard_count):
+    # Videos of unknown cost count as an average one
+    known_costs = [entry["cost"] for entry in entries if entry["cost"] is not None]
+    default_cost = float(sum(known_costs)) / len(known_costs) if known_costs else 1.0
+
+    def get_cost(entry):
+        return default_cost if entry["cost"] is None else entry["cost"]
+
+    # Hand out the most expensive videos first, each to the slice with
+    # the least work so far. Every host sorts the same plan the same
+    # way, so the slices never overlap and always cover the whole plan.
+    loads = [0] * shard_count
+    selected = set()
+    for i in sorted(range(len(entries)), key=lambda i: (-get_cost(entries[i]), entries[i]["input"])):
+        target = loads.index(min(loads))
+        loads[target] += get_cost(entries[i])
+        if target == shard_index - 1:
+            selected.add(i)
+    shard_cost = loads[shard_index - 1]
+    total_cost = sum(loads)
+    return ([entry for i, entry in enumerate(entries) if i in selected],
+        shard_cost / total_cost if total_cost else 0)
+
+
+def iter_plan_jobs(args):
+    entries = args.plan_jobs
+    if args.shard:
+        shard_index, shard_count = args.shard
+        entries, cost_share = get_plan_shard(entries, shard_index, shard_count)
+        logging.info("Converting slice %d/%d of the plan: %d of %d video(s), %.0f%% of the work",
+            shard_index, shard_count, len(entries), len(args.plan_jobs), 100 * cost_share)
+    job_id = 1
+    # Maps output directories to their entries, read once each
+    output_dir_entries = {}
+    for entry in entries:
+        input_path = os.path.join(args.input_dir, *entry["input"].split("/"))
+        dir_path, file_name = os.path.split(input_path)
+        if not os.path.isfile(input_path):
+            logging.error("Video in plan not found: '%s'", input_path)
+            continue
+        if args.resume and args.journal.get_state(input_path) == "done":
+            logging.info("Video '%s' was already converted, skipping", entry["input"])
+            continue
+        track_info = TrackInfo(
+            HandBrakeAudioInfo.from_data(entry["audio"]) if entry["audio"] else None,
+            HandBrakeSubtitleInfo.from_data(entry["subtitle"]) if entry["subtitle"] else None,
+            VideoInfo.from_data(entry["video"]))
+        # The output path follows from the input path and the output
+        # directory and format of the plan, as it did when planning
+        job = create_encode_job(args, job_id, dir_path, file_name, track_info)
+        output_dir = os.path.dirname(job.output_path)
+        if output_dir not in output_dir_entries:
+            try:
+                output_dir_entries[output_dir] = get_output_dir_entries(output_dir)
+            except OSError as e:
+                logging.error("Cannot read output directory: '%s'", output_dir)
+                output_dir_entries[output_dir] = None
+        if output_dir_entries[output_dir] is None:
+            continue
+        # Outputs may have appeared since the plan was written
+        if not check_output_path(args, input_path, job.output_path, output_dir_entries[output_dir]):
+            continue
+        yield job
+        job_id += 1
+
+
+def generate_jobs(args):
+    if args.execute_plan:
+        jobs = iter_plan_jobs(args)
+    else:
+        jobs = iter_jobs(args)
+    # The order cannot change how long a single job slot takes, so
+    # keep converting while scanning in that case
+    if args.order == "input" or (args.jobs == 1 and not args.serve) or args.watch:
+        return jobs
+    jobs = sort_jobs(jobs, args.order)
+    logging.info("Converting %d video(s), %s first", len(jobs),
+        "longest" if args.order == "longest" else "most expensive")
+    return jobs
+
+
+def copy_file_sequential(source_path, dest_path, aborted):
+    with open(source_path, "rb") as source, open(dest_path, "wb") as dest:
+        # Tell the OS to read ahead aggressively, and not to keep the
+        # source in the page cache afterwards
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while not aborted.is_set():
+            data = source.read(SCRATCH_COPY_BUFFER_SIZE)
+            if not data:
+                break
+            dest.write(data)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return not aborted.is_set()
+
+
+class StagedJob(object):
+    def __init__(self, job, input_path, output_path, reserved_bytes):
+        self.job = job
+        self.input_path = input_path
+        self.output_path = output_path
+        self.reserved_bytes = reserved_bytes
+
+
+class ScratchStager(object):
+    def __init__(self, scratch_dir, stage_ahead, budget):
+        self.scratch_dir = os.path.join(scratch_dir, "aniconvert-{0}".format(os.getpid()))
+        self.stage_ahead = stage_ahead
+        self.budget = budget
+        self.condition = threading.Condition()
+        self.aborted = threading.Event()
+        self.stopped = threading.Event()
+        self.pending = collections.deque()
+        # Maps job IDs to their StagedJob, or None if the input could
+        # not be staged and is converted in place
+        self.staged = {}
+        self.used_bytes = 0
+        self.moves = collections.deque()
+        self.threads = []
+        try_create_directory(self.scratch_dir)
+
+    def start(self):
+        self.threads = [
+            start_thread(self.run_stager, (), "stager"),
+            start_thread(self.run_mover, (), "mover"),
+        ]
+
+    def add_job(self, job):
+        with self.condition:
+            self.pending.append(job)
+            self.condition.notify_all()
+
+    def can_stage(self, reserved_bytes):
+        if len(self.staged) >= self.stage_ahead:
+            return False
+        return self.budget is None or self.used_bytes + reserved_bytes <= self.budget
+
+    def run_stager(self):
+        while True:
+            with self.condition:
+                while not self.stopped.is_set():
+                    if self.pending:
+                        job = self.pending[0]
+                        reserved_bytes = 2 * (get_file_size(job.input_path) or 0)
+                        if self.budget is not None and reserved_bytes > self.budget:
+                            break
+                        if self.can_stage(reserved_bytes):
+                            break
+                    # Wait with a timeout so that Ctrl-C is not ignored on Python 2
+                    self.condition.wait(0.5)
+                if self.stopped.is_set():
+                    return
+                self.pending.popleft()
+                if self.budget is not None and reserved_bytes > self.budget:
+                    logging.info("'%s' does not fit in the scratch budget, converting in place",
+                        job.simp_input_path)
+                    self.staged[job.job_id] = None
+                    self.condition.notify_all()
+                    continue
+                self.used_bytes += reserved_bytes
+            staged_job = self.stage_input(job, reserved_bytes)
+            with self.condition:
+                if staged_job is None:
+                    self.used_bytes -= reserved_bytes
+                self.staged[job.job_id] = staged_job
+                self.condition.notify_all()
+
+    def stage_input(self, job, reserved_bytes):
+        extension = os.path.splitext(job.input_path)[1]
+        input_path = os.path.join(self.scratch_dir, "{0}-input{1}".format(job.job_id, extension))
+        output_path = os.path.join(self.scratch_dir, "{0}-output{1}".format(
+            job.job_id, os.path.splitext(job.output_path)[1]))
+        logging.debug("Copying '%s' to scratch directory", job.simp_input_path)
+        start_time = time.time()
+        try:
+            with trace_span("stage_input", job=job.job_id, path=job.simp_input_path):
+                copied = copy_file_sequential(job.input_path, input_path, self.stopped)
+        except (IOError, OSError) as e:
+            logging.warning("Cannot copy '%s' to scratch directory, converting in place: %s",
+                job.simp_input_path, e)
+            copied = False
+        if not copied:
+            try_delete_file(input_path)
+            return None
+        logging.debug("Copied '%s' to scratch directory in %.1f seconds",
+            job.simp_input_path, time.time() - start_time)
+        return StagedJob(job, input_path, output_path, reserved_bytes)
+
+    def start_job(self, job, handbrake_args):
+        with self.condition:
+            while job.job_id not in self.staged and not self.stopped.is_set():
+                self.condition.wait(0.5)
+            staged_job = self.staged.pop(job.job_id, None)
+            self.condition.notify_all()
+        if staged_job is None:
+            return (None, handbrake_args)
+        handbrake_args = list(handbrake_args)
+        handbrake_args[handbrake_args.index("-i") + 1] = staged_job.input_path
+        handbrake_args[handbrake_args.index("-o") + 1] = staged_job.output_path
+        return (staged_job, handbrake_args)
+
+    def finish_job(self, staged_job, on_moved=None):
+        # The staged input is no longer needed either way; the output
+        # keeps its share of the budget until it has been moved
+        try_delete_file(staged_job.input_path)
+        with self.condition:
+            if on_moved is None:
+                try_delete_file(staged_job.output_path)
+                self.used_bytes -= staged_job.reserved_bytes
+            else:
+                self.used_bytes -= staged_job.reserved_bytes // 2
+                staged_job.reserved_bytes -= staged_job.reserved_bytes // 2
+                self.moves.append((staged_job, on_moved))
+            self.condition.notify_all()
+
+    def run_mover(self):
+        while True:
+            with self.condition:
+                # Outputs that are already converted are still moved
+                # when stopping, but not when aborting
+                while not self.moves and not self.stopped.is_set():
+                    self.condition.wait(0.5)
+                if self.aborted.is_set() or not self.moves:
+                    return
+                staged_job, on_moved = self.moves[0]
+            job = staged_job.job
+            try:
+                with trace_span("move_output", job=job.job_id, path=job.simp_input_path):
+                    # Move next to the destination first, so that it is only
+                    # replaced once the output is complete
+                    shutil.move(staged_job.output_path, job.temp_output_path)
+                    replace_file(job.temp_output_path, job.output_path)
+            except (IOError, OSError) as e:
+                logging.error("Cannot move '%s' to output directory: %s", job.simp_input_path, e)
+                try_delete_file(staged_job.output_path)
+                try_delete_file(job.temp_output_path)
+                on_moved(False)
+            else:
+                on_moved(True)
+            with self.condition:
+                self.moves.popleft()
+                self.used_bytes -= staged_job.reserved_bytes
+                self.condition.notify_all()
+
+    def abort(self):
+        self.aborted.set()
+        self.stopped.set()
+
+    def close(self):
+        # Called once no more jobs will be started, so anything not yet
+        # converted is left behind
+        self.stopped.set()
+        wait_for_threads(self.threads)
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+
+def start_thread(target, args, name):
+    stopped = threading.Event()
+
+    def run():
+        try:
+            target(*args)
+        finally:
+            stopped.set()
+
+    thread = threading.Thread(target=run, name=name)
+    thread.daemon = True
+    thread.start()
+    return stopped
+
+
+def wait_for_threads(stopped_events):
+    for stopped in stopped_events:
+        # Wait with a timeout so that Ctrl-C is not ignored on Python 2.
+        # Thread.join() is avoided because on some versions of Python 3,
+        # interrupting it with Ctrl-C leaves the thread marked as stopped
+        # while it is still running.
+        while not stopped.is_set():
+            stopped.wait(0.5)
+
+
+class ProcessSet(object):
+    def __init__(self, resources):
+        self.resources = resources
+        self.controller = None
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.aborted = threading.Event()
+        self.finished = threading.Event()
+
+    def wait_for_slot(self, slot):
+        if self.controller is None:
+            return not self.aborted.is_set()
+        return self.controller.wait_for_slot(slot, self.aborted, self.finished)
+
+    def job_started(self, slot, reporter):
+        if self.controller is not None:
+            self.controller.job_started(slot, reporter)
+
+    def job_finished(self, slot):
+        if self.controller is not None:
+            self.controller.job_finished(slot)
+
+    def start_controller(self):
+        if self.controller is not None:
+            self.controller.start()
+
+    def stop_controller(self):
+        if self.controller is not None:
+            self.controller.stop()
+
+    def get_handbrake_args(self, slot, job):
+        if self.resources is None:
+            return job.handbrake_args
+        return self.resources.get_handbrake_args(slot, job.handbrake_args)
+
+    def register_process(self, slot, process, segment_index=None):
+        if self.resources is not None:
+            self.resources.apply(slot, process)
+        with self.lock:
+            if segment_index is None:
+                self.processes[slot] = process
+            else:
+                self.processes[(slot, segment_index)] = process
+            if not self.aborted.is_set():
+                return
+        # Aborted while the process was starting
+        process.kill()
+
+    def unregister_process(self, slot, segment_count=0):
+        with self.lock:
+            self.processes.pop(slot, None)
+            for segment_index in range(segment_count):
+                self.processes.pop((slot, segment_index), None)
+
+    def kill_process(self, slot):
+        with self.lock:
+            process = self.processes.get(slot)
+        if process:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+    def kill_processes(self):
+        with self.lock:
+            for process in self.processes.values():
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+
+    def abort(self):
+        self.aborted.set()
+        self.kill_processes()
+
+
+class EncodeScheduler(ProcessSet):
+    def __init__(self, args):
+        ProcessSet.__init__(self, args.resources)
+        self.job_count = args.jobs
+        self.journal = args.journal
+        self.manifest = args.manifest
+        self.events = args.progress_events
+        self.metrics = args.metrics
+        self.estimator = args.estimator
+        self.shutdown = args.shutdown
+        self.segment_joiner = args.segment_joiner
+        self.stager = None
+        if args.scratch_dir:
+            self.stager = ScratchStager(args.scratch_dir, args.stage_ahead, args.scratch_budget)
+        self.progress_interval = args.progress_interval
+        self.display = ProgressDisplay(self.job_count)
+        if args.auto_jobs:
+            self.controller = ConcurrencyController(self.job_count, self.display)
+        # Only let scanning get a little ahead of encoding
+        self.job_queue = queue.Queue(self.job_count)
+        self.error = None
+
+    def execute_job(self, slot, job):
+        try_create_directory(os.path.dirname(job.output_path))
+        logging.info("Converting '%s'", job.simp_input_path)
+        label = ""
+        if self.job_count > 1:
+            label = os.path.basename(job.input_path) + ": "
+        reporter = ProgressReporter(self.display, slot, label,
+            self.events, job, self.progress_interval)
+        on_start = lambda process: self.register_process(slot, process)
+        self.job_started(slot, reporter)
+        if self.estimator:
+            self.estimator.job_started(job)
+        if self.journal:
+            self.journal.record([job.input_path], "running")
+        self.metrics.record_encode_start()
+        start_time = time.time()
+        phase = "aborted"
+        staged_job = None
+        try:
+            handbrake_args = self.get_handbrake_args(slot, job)
+            if self.stager:
+                staged_job, handbrake_args = self.stager.start_job(job, handbrake_args)
+            with trace_span("run_handbrake", job=job.job_id, slot=slot, path=job.simp_input_path):
+                if job.segments:
+                    self.run_segments(slot, job, handbrake_args, reporter)
+                else:
+                    run_handbrake(handbrake_args, reporter, on_start)
+            if staged_job is None:
+                # Only replace the destination once the output is complete
+                replace_file(job.temp_output_path, job.output_path)
+        except subprocess.CalledProcessError as e:
+            try_delete_file(job.temp_output_path)
+            if not self.aborted.is_set():
+                logging.error("Error occurred while converting '%s': %s", job.simp_input_path, e)
+                phase = "failed"
+        except:
+            try_delete_file(job.temp_output_path)
+            raise
+        else:
+            phase = "done"
+        finally:
+            self.unregister_process(slot, len(job.segments or ()))
+            self.job_finished(slot)
+            reporter.flush()
+            self.display.finish(slot)
+            encode_seconds = time.time() - start_time
+            avg_fps = reporter.latest and reporter.latest.avg_fps
+            if staged_job is not None and phase == "done":
+                # Free the slot for the next video while the output is
+                # moved to the output directory
+                self.stager.finish_job(staged_job, lambda moved: self.report_job(
+                    job, "done" if moved else "failed", encode_seconds, avg_fps))
+            else:
+                if staged_job is not None:
+                    self.stager.finish_job(staged_job)
+                self.report_job(job, phase, encode_seconds, avg_fps)
+
+    def report_job(self, job, phase, encode_seconds, avg_fps):
+        if self.journal and phase != "aborted":
+            self.journal.record([job.input_path], phase)
+        if self.manifest and phase == "done":
+            self.manifest.record(job)
+        if self.events:
+            self.events.write(phase, job.job_id, job.simp_input_path)
+        self.metrics.record_encode(job.input_path, job.output_path, phase, encode_seconds, avg_fps)
+        if self.estimator:
+            self.estimator.job_finished(job, phase, encode_seconds)
+            if phase != "aborted":
+                self.estimator.log_eta()
+
+    def run_segments(self, slot, job, handbrake_args, reporter):
+        logging.info("Encoding '%s' in %d segments", job.simp_input_path, len(job.segments))
+        output_path = handbrake_args[handbrake_args.index("-o") + 1]
+        segment_paths = [get_segment_path(output_path, i) for i in range(len(job.segments))]
+        arg_lists = [get_segment_args(handbrake_args, range_args, segment_path)
+            for (range_args, _), segment_path in zip(job.segments, segment_paths)]
+        on_start = lambda segment_index, process: self.register_process(slot, process, segment_index)
+        try:
+            run_handbrake_segments(arg_lists, SegmentProgress(job.segments, reporter), on_start)
+            with trace_span("join_segments", job=job.job_id, slot=slot):
+                join_segments(self.segment_joiner, segment_paths, output_path,
+                    lambda process: self.register_process(slot, process))
+        finally:
+            for segment_path in segment_paths:
+                try_delete_file(segment_path)
+
+    def put_job(self, job):
+        if self.estimator:
+            self.estimator.add_job(job)
+        if self.stager:
+            self.stager.add_job(job)
+        # The workers stop taking jobs when asked to shut down, so do
+        # not wait for room in the queue forever
+        while not self.aborted.is_set() and not self.shutdown.is_set():
+            try:
+                self.job_queue.put(job, True, 0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get_job(self):
+        # Leave queued videos alone when asked to shut down
+        while not self.aborted.is_set() and not self.shutdown.is_set():
+            try:
+                return self.job_queue.get(True, 0.5)
+            except queue.Empty:
+                if self.finished.is_set():
+                    return None
+        return None
+
+    def worker(self, slot):
+        try:
+            with trace_thread():
+                while self.wait_for_slot(slot):
+                    job = self.get_job()
+                    if job is None:
+                        return
+                    self.execute_job(slot, job)
+        except Exception:
+            # Unexpected errors stop the whole run, like they would
+            # if the jobs were executed one at a time
+            with self.lock:
+                if self.error is None:
+                    self.error = sys.exc_info()[1]
+            self.abort()
+
+    def abort(self):
+        ProcessSet.abort(self)
+        if self.stager:
+            self.stager.abort()
+
+    def run(self, jobs):
+        threads = []
+        # Sorted jobs are all known up front, so estimate the whole run
+        # instead of just what has been queued
+        if self.estimator and isinstance(jobs, list):
+            for job in jobs:
+                self.estimator.add_job(job)
+            self.estimator.log_eta()
+        self.display.attach()
+        self.start_controller()
+        if self.stager:
+            self.stager.start()
+        try:
+            for slot in range(self.job_count):
+                threads.append(start_thread(self.worker, (slot,), "encode-{0}".format(slot)))
+            # Jobs are produced on this thread as soon as their tracks
+            # have been selected, blocking while the queue is full
+            for job in jobs:
+                if not self.put_job(job) or self.aborted.is_set():
+                    # Stop scanning (or watching) for more videos
+                    if hasattr(jobs, "close"):
+                        jobs.close()
+                    break
+            self.finished.set()
+            if self.estimator:
+                self.estimator.log_eta()
+            wait_for_threads(threads)
+        except:
+            logging.info("Conversion aborted, cleaning up temporary files")
+            self.abort()
+            wait_for_threads(threads)
+            raise
+        finally:
+            if self.stager:
+                # Finishes moving outputs unless the run was aborted
+                self.stager.close()
+            self.stop_controller()
+            self.display.detach()
+        if self.error is not None:
+            logging.info("Conversion aborted, cleaning up temporary files")
+            raise self.error
+
+
+class MessageConnection(object):
+    def __init__(self, sock, timeout):
+        sock.settimeout(timeout)
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        self.lock = threading.Lock()
+        self.name = None
+        self.lease = None
+        self.outbox = None
+        self.closed = False
+
+    def start_sender(self, max_pending):
+        # Send from a thread of our own, so that a peer that stops
+        # reading cannot block the threads sending to it
+        self.outbox = queue.Queue(max_pending)
+        start_thread(self.run_sender, (), "sender")
+
+    def run_sender(self):
+        while True:
+            data = self.outbox.get()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except (IOError, OSError):
+                self.close()
+                return
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        if self.outbox is None:
+            with self.lock:
+                self.sock.sendall(data)
+            return
+        if self.closed:
+            raise IOError(errno.EPIPE, "Connection closed")
+        try:
+            self.outbox.put_nowait(data)
+        except queue.Full:
+            self.close()
+            raise IOError(errno.ENOBUFS, "Too many unread messages")
+
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            return None
+        return json.loads(line.decode("utf-8"))
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self.sock.close()
+        if self.outbox is not None:
+            try:
+                self.outbox.put_nowait(None)
+            except queue.Full:
+                # The sender is stuck in sendall(), which now fails
+                pass
+
+
+def create_handshake_nonce():
+    return binascii.hexlify(os.urandom(16)).decode("ascii")
+
+
+def get_handshake_digest(secret, role, nonce):
+    # The role keeps either side from replaying the other's digest
+    message = "{0}:{1}".format(role, nonce).encode("utf-8")
+    return hmac.new(secret or b"", message, hashlib.sha256).hexdigest()
+
+
+def check_handshake_digest(secret, role, nonce, auth):
+    if not isinstance(auth, type(u"")):
+        return False
+    expected = get_handshake_digest(secret, role, nonce)
+    return hmac.compare_digest(expected.encode("ascii"), auth.encode("utf-8"))
+
+
+class JobLease(object):
+    def __init__(self, lease_id, job, connection):
+        self.lease_id = lease_id
+        self.job = job
+        self.connection = connection
+        self.start_time = time.time()
+        self.expire_time = self.start_time + LEASE_TIMEOUT
+        self.progress = None
+
+
+class JobCoordinator(object):
+    def __init__(self, args):
+        self.address = args.serve
+        self.secret = args.secret
+        self.video_dimensions = args.output_dimensions
+        self.journal = args.journal
+        self.manifest = args.manifest
+        self.events = args.progress_events
+        self.metrics = args.metrics
+        self.estimator = args.estimator
+        self.shutdown = args.shutdown
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.leases = {}
+        self.attempts = collections.Counter()
+        self.connections = set()
+        self.next_lease_id = 1
+        self.finished = False
+        self.stopped = False
+        self.server = None
+
+    def is_complete(self):
+        return self.finished and not self.pending and not self.leases
+
+    def add_job(self, job):
+        if self.estimator:
+            self.estimator.add_job(job)
+        with self.condition:
+            self.pending.append(job)
+            self.condition.notify_all()
+
+    def end_lease(self, lease, phase):
+        del self.leases[lease.lease_id]
+        lease.connection.lease = None
+        job = lease.job
+        if phase != "requeued":
+            self.journal.record([job.input_path], phase)
+        if self.manifest and phase == "done":
+            self.manifest.record(job)
+        self.metrics.record_encode(job.input_path, job.output_path, phase,
+            time.time() - lease.start_time, lease.progress and lease.progress.avg_fps)
+        if self.events:
+            self.events.write(phase, job.job_id, job.simp_input_path)
+        if self.estimator:
+            self.estimator.job_finished(job, phase, time.time() - lease.start_time)
+            if phase == "requeued":
+                self.estimator.add_job(job)
+            else:
+                self.estimator.log_eta()
+        self.condition.notify_all()
+
+    def requeue_lease(self, lease, reason):
+        job = lease.job
+        if self.attempts[job.job_id] >= LEASE_MAX_ATTEMPTS:
+            logging.error("Giving up on '%s' after %d attempts: %s",
+                job.simp_input_path, self.attempts[job.job_id], reason)
+            self.end_lease(lease, "failed")
+            return
+        logging.warning("Requeueing '%s': %s", job.simp_input_path, reason)
+        self.end_lease(lease, "requeued")
+        self.pending.appendleft(job)
+
+    def expire_leases(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                now = time.time()
+                for lease in list(self.leases.values()):
+                    if lease.expire_time < now:
+                        reason = "worker '{0}' stopped responding".format(lease.connection.name)
+                        self.requeue_lease(lease, reason)
+                        # Closing the connection tells the worker to stop
+                        lease.connection.close()
+                self.condition.wait(1)
+
+    def handle_lease(self, connection):
+        deadline = time.time() + HEARTBEAT_INTERVAL
+        with self.condition:
+            while not self.pending and not self.is_complete() and not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if self.pending and not self.shutdown.is_set():
+                job = self.pending.popleft()
+                lease = JobLease(self.next_lease_id, job, connection)
+                self.next_lease_id += 1
+                self.leases[lease.lease_id] = lease
+                self.attempts[job.job_id] += 1
+                connection.lease = lease
+            elif self.is_complete() or self.stopped:
+                lease = None
+                reply = {"type": "done"}
+            else:
+                lease = None
+                reply = {"type": "wait"}
+        if lease is None:
+            connection.send(reply)
+            return
+        logging.info("Converting '%s' on worker '%s'", job.simp_input_path, connection.name)
+        if self.estimator:
+            self.estimator.job_started(job)
+        self.journal.record([job.input_path], "running")
+        self.metrics.record_encode_start()
+        connection.send({
+            "type": "job",
+            "lease": lease.lease_id,
+            "job": job.to_data(self.video_dimensions),
+        })
+
+    def handle_heartbeat(self, connection, message):
+        with self.condition:
+            lease = connection.lease
+            if lease is None or lease.lease_id != message.get("lease"):
+                lease = None
+            else:
+                lease.expire_time = time.time() + LEASE_TIMEOUT
+                progress = message.get("progress")
+                if progress:
+                    lease.progress = EncodeProgress(progress["percent"],
+                        progress["fps"], progress["avg_fps"], progress["eta"])
+        if lease is None:
+            connection.send({"type": "cancel"})
+            return
+        connection.send({"type": "ok"})
+        if self.events and lease.progress:
+            self.events.write("encode", lease.job.job_id, lease.job.simp_input_path, lease.progress)
+
+    def handle_result(self, connection, message):
+        with self.condition:
+            lease = connection.lease
+            if lease is None or lease.lease_id != message.get("lease"):
+                return
+            job = lease.job
+            if message.get("status") == "done":
+                self.end_lease(lease, "done")
+            else:
+                logging.error("Error occurred while converting '%s' on worker '%s': %s",
+                    job.simp_input_path, connection.name, message.get("error"))
+                self.end_lease(lease, "failed")
+
+    def authenticate(self, connection):
+        # Returns the hello message of the worker if it knows the secret
+        nonce = create_handshake_nonce()
+        connection.send({"type": "challenge", "nonce": nonce})
+        message = connection.receive()
+        if not message or message.get("type") != "hello":
+            return None
+        if not check_handshake_digest(self.secret, "worker", nonce, message.get("auth")):
+            return None
+        if not isinstance(message.get("nonce"), type(u"")):
+            return None
+        return message
+
+    def handle_connection(self, connection, address):
+        try:
+            message = self.authenticate(connection)
+            if not message:
+                logging.warning("Worker at %s failed to authenticate", address[0])
+                connection.send({"type": "error", "error": "wrong secret"})
+                return
+            # Workers write wherever the coordinator tells them to, so
+            # they check that it knows the secret too
+            connection.send({
+                "type": "ok",
+                "auth": get_handshake_digest(self.secret, "coordinator", message["nonce"]),
+            })
+            connection.name = message.get("name")
+            logging.info("Worker '%s' connected", connection.name)
+            while not self.stopped:
+                message = connection.receive()
+                if message is None:
+                    break
+                message_type = message.get("type")
+                if message_type == "lease":
+                    self.handle_lease(connection)
+                elif message_type == "heartbeat":
+                    self.handle_heartbeat(connection, message)
+                elif message_type == "result":
+                    self.handle_result(connection, message)
+        except (IOError, OSError, ValueError) as e:
+            logging.debug("Connection to worker '%s' failed: %s", connection.name, e)
+        finally:
+            connection.close()
+            with self.condition:
+                self.connections.discard(connection)
+                if connection.lease and not self.stopped:
+                    reason = "lost connection to worker '{0}'".format(connection.name)
+                    self.requeue_lease(connection.lease, reason)
+            if connection.name:
+                logging.info("Worker '%s' disconnected", connection.name)
+
+    def accept_connections(self):
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except (IOError, OSError):
+                return
+            # Workers ask for a job or send a heartbeat at least every
+            # HEARTBEAT_INTERVAL, so a silent connection is a dead one
+            connection = MessageConnection(sock, LEASE_TIMEOUT)
+            with self.condition:
+                if self.stopped:
+                    connection.close()
+                    return
+                self.connections.add(connection)
+            thread = threading.Thread(target=self.handle_connection, args=(connection, address))
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        host, port = self.address
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(16)
+        logging.info("Waiting for workers on %s:%d", host, self.server.getsockname()[1])
+        for target in (self.accept_connections, self.expire_leases):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            connections = list(self.connections)
+            self.condition.notify_all()
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self.server.close()
+        for connection in connections:
+            connection.close()
+
+    def run(self, jobs):
+        self.start()
         try:
-            run_handbrake(handbrake_args)
+            for job in jobs:
+                self.add_job(job)
+            if self.estimator:
+                self.estimator.log_eta()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+                # Wait with a timeout so that Ctrl-C is not ignored on Python 2
+                while not self.is_complete():
+                    if self.shutdown.is_set():
+                        # Leave queued videos alone when asked to shut down
+                        self.pending.clear()
+                    self.condition.wait(0.5)
+                # Give idle workers a moment to hear that we are done
+                self.condition.notify_all()
+            time.sleep(0.5)
+        except:
+            logging.info("Conversion aborted, stopping workers")
+            raise
+        finally:
+            self.stop()
+
+
+class WorkerClient(ProcessSet):
+    def __init__(self, args):
+        ProcessSet.__init__(self, args.resources)
+        self.address = args.worker
+        self.secret = args.secret
+        self.handbrake_path = args.handbrake_path
+        self.slot_count = args.jobs
+        self.progress_interval = args.progress_interval
+        self.display = ProgressDisplay(self.slot_count)
+        if args.auto_jobs:
+            self.controller = ConcurrencyController(self.slot_count, self.display)
+        self.name = "{0}-{1}".format(socket.gethostname(), os.getpid())
+        self.connections = {}
+
+    def send_heartbeats(self, slot, connection, lease_id, reporter, stopped, lost):
+        try:
+            while not stopped.wait(HEARTBEAT_INTERVAL):
+                progress = reporter.latest
+                connection.send({
+                    "type": "heartbeat",
+                    "lease": lease_id,
+                    "progress": progress and progress.__dict__,
+                })
+                reply = connection.receive()
+                if reply is None or reply.get("type") != "ok":
+                    break
+            else:
+                return
+        except (IOError, OSError, ValueError) as e:
+            logging.debug("Heartbeat failed: %s", e)
+        # The coordinator has given the job to someone else
+        lost.set()
+        self.kill_process(slot)
+
+    def execute_job(self, slot, connection, lease_id, data):
+        job = create_remote_job(self.handbrake_path, lease_id, data)
+        try_create_directory(os.path.dirname(job.output_path))
+        logging.info("Converting '%s'", job.simp_input_path)
+        label = ""
+        if self.slot_count > 1:
+            label = os.path.basename(job.input_path) + ": "
+        reporter = ProgressReporter(self.display, slot, label, None, job, self.progress_interval)
+        on_start = lambda process: self.register_process(slot, process)
+        self.job_started(slot, reporter)
+        stopped = threading.Event()
+        lost = threading.Event()
+        heartbeat_thread = threading.Thread(target=self.send_heartbeats,
+            args=(slot, connection, lease_id, reporter, stopped, lost))
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+        result = {"type": "result", "lease": lease_id, "status": "done"}
+        try:
+            run_handbrake(self.get_handbrake_args(slot, job), reporter, on_start)
+            replace_file(job.temp_output_path, job.output_path)
         except subprocess.CalledProcessError as e:
-            logging.error("Error occurred while converting '%s': %s", simp_input_path, e)
-            try_delete_file(output_path)
+            try_delete_file(job.temp_output_path)
+            if self.aborted.is_set():
+                raise
+            if lost.is_set():
+                logging.warning("Coordinator took back '%s'", job.simp_input_path)
+                return False
+            logging.error("Error occurred while converting '%s': %s", job.simp_input_path, e)
+            result["status"] = "failed"
+            result["error"] = str(e)
+        except:
+            try_delete_file(job.temp_output_path)
+            raise
+        finally:
+            stopped.set()
+            while heartbeat_thread.is_alive():
+                heartbeat_thread.join(0.5)
+            self.unregister_process(slot)
+            self.job_finished(slot)
+            reporter.flush()
+            self.display.finish(slot)
+        connection.send(result)
+        return True
+
+    def connect(self, slot):
+        try:
+            sock = socket.create_connection(self.address)
+        except (IOError, OSError) as e:
+            logging.error("Cannot connect to coordinator at %s:%d: %s",
+                self.address[0], self.address[1], e)
+            return None
+        connection = MessageConnection(sock, LEASE_TIMEOUT)
+        with self.lock:
+            self.connections[slot] = connection
+        try:
+            message = connection.receive()
+            nonce = message and message.get("type") == "challenge" and message.get("nonce")
+            if not isinstance(nonce, type(u"")):
+                raise ValueError("Unexpected reply from coordinator")
+            worker_nonce = create_handshake_nonce()
+            connection.send({
+                "type": "hello",
+                "name": "{0}/{1}".format(self.name, slot),
+                "auth": get_handshake_digest(self.secret, "worker", nonce),
+                "nonce": worker_nonce,
+            })
+            message = connection.receive()
+        except:
+            connection.close()
+            raise
+        if message is None or message.get("type") != "ok":
+            logging.error("Coordinator refused connection: %s",
+                message and message.get("error") or "no reply")
+            connection.close()
+            return None
+        if not check_handshake_digest(self.secret, "coordinator", worker_nonce, message.get("auth")):
+            logging.error("Coordinator at %s:%d failed to authenticate",
+                self.address[0], self.address[1])
+            connection.close()
+            return None
+        return connection
+
+    def is_slot_paused(self, slot):
+        return self.controller is not None and slot >= self.controller.level
+
+    def worker(self, slot):
+        connection = None
+        try:
+            while self.wait_for_slot(slot):
+                if connection is None:
+                    connection = self.connect(slot)
+                    if connection is None:
+                        return
+                connection.send({"type": "lease"})
+                message = connection.receive()
+                if message is None or message.get("type") == "done":
+                    self.finished.set()
+                    return
+                if message.get("type") == "job":
+                    if not self.execute_job(slot, connection, message["lease"], message["job"]):
+                        return
+                # Idle connections are dropped by the coordinator, so
+                # do not keep one open while the slot is not in use
+                if self.is_slot_paused(slot):
+                    connection.close()
+                    connection = None
+        except subprocess.CalledProcessError:
+            pass
+        except (IOError, OSError, ValueError) as e:
+            if not self.aborted.is_set():
+                logging.error("Lost connection to coordinator: %s", e)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def abort(self):
+        ProcessSet.abort(self)
+        with self.lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            connection.close()
+
+    def run(self):
+        threads = []
+        self.display.attach()
+        self.start_controller()
+        try:
+            for slot in range(self.slot_count):
+                threads.append(start_thread(self.worker, (slot,), "encode-{0}".format(slot)))
+            wait_for_threads(threads)
         except:
             logging.info("Conversion aborted, cleaning up temporary files")
-            try_delete_file(output_path)
+            self.abort()
+            wait_for_threads(threads)
             raise
+        finally:
+            self.stop_controller()
+            self.display.detach()
+
+
+class DaemonRequest(object):
+    def __init__(self, request_id, args, connection, events):
+        self.request_id = request_id
+        self.args = args
+        self.connection = connection
+        self.events = events
+        # Maps job IDs to the last phase reported for the video
+        self.jobs = collections.OrderedDict()
+        self.job_outputs = {}
+        self.scanning = True
+
+    def send(self, message):
+        connection = self.connection
+        if connection is None:
+            return
+        message["request"] = self.request_id
+        try:
+            connection.send(message)
+        except (IOError, OSError):
+            # Videos are still converted after the client goes away
+            self.connection = None
+
+    def write(self, phase, job_id=None, input_path=None, progress=None):
+        if self.events:
+            self.events.write(phase, job_id, input_path, progress)
+        message = get_progress_event(phase, job_id, input_path, progress)
+        message["type"] = "status"
+        self.send(message)
+
+    def is_finished(self):
+        return not self.scanning and all(phase in ("done", "failed", "aborted")
+            for phase in self.jobs.values())
+
+    def to_data(self):
+        return {
+            "request": self.request_id,
+            "path": os.path.join(self.args.input_dir, self.args.input_file or ""),
+            "scanning": self.scanning,
+            "jobs": [{"job": job_id, "phase": phase} for job_id, phase in self.jobs.items()],
+        }
+
+
+class ConversionDaemon(object):
+    def __init__(self, args):
+        self.path = args.daemon
+        self.args = args
+        self.events = args.progress_events
+        self.lock = threading.Lock()
+        # Scanning and track selection share the caches, so requests
+        # take turns while their videos are converted together
+        self.scan_lock = threading.Lock()
+        self.job_queue = queue.Queue()
+        self.requests = {}
+        self.job_requests = {}
+        self.output_paths = set()
+        self.connections = set()
+        self.next_request_id = 1
+        self.next_job_id = 1
+        self.stopped = False
+        self.server = None
+        self.scheduler = EncodeScheduler(args)
+        # Status updates from the scheduler are passed on to the
+        # clients that asked for the videos
+        self.scheduler.events = self
+
+    def write(self, phase, job_id=None, input_path=None, progress=None):
+        with self.lock:
+            request = self.job_requests.get(job_id)
+            if request is None:
+                return
+            request.jobs[job_id] = phase
+            if phase in ("done", "failed", "aborted"):
+                del self.job_requests[job_id]
+                self.output_paths.discard(request.job_outputs.pop(job_id))
+        request.write(phase, job_id, input_path, progress)
+        self.finish_request(request)
+
+    def finish_request(self, request):
+        with self.lock:
+            if not request.is_finished() or request.request_id not in self.requests:
+                return
+            del self.requests[request.request_id]
+        phases = list(request.jobs.values())
+        logging.info("Finished request %d", request.request_id)
+        request.send({"type": "finished",
+            "done": phases.count("done"), "failed": phases.count("failed")})
+
+    def parse_request(self, message):
+        request_args = argparse.Namespace(**vars(self.args))
+        request_args.output_dir = None
+        parsers = {
+            "output_dir": None,
+            "recursive_search": None,
+            "input_formats": parse_input_formats,
+            "duplicate_action": parse_duplicate_action,
+            "output_dimensions": parse_output_dimensions,
+            "audio_languages": parse_language_list,
+            "subtitle_languages": parse_language_list,
+        }
+        options = message.get("options") or {}
+        if not isinstance(options, dict):
+            raise ValueError("Options must be an object")
+        for name, value in options.items():
+            if name not in parsers:
+                raise ValueError("Unknown option: " + repr(name))
+            # Values come straight from the client
+            value_type = bool if name == "recursive_search" else type(u"")
+            if not isinstance(value, value_type):
+                raise ValueError("Invalid value for option {0}: {1!r}".format(name, value))
+            if parsers[name]:
+                try:
+                    value = parsers[name](value)
+                except argparse.ArgumentTypeError as e:
+                    raise ValueError(str(e))
+            setattr(request_args, name, value)
+        path = message.get("path")
+        if not path:
+            raise ValueError("Missing path")
+        if not isinstance(path, type(u"")):
+            raise ValueError("Invalid path: {0!r}".format(path))
+        path = os.path.abspath(path)
+        request_args.input_dir = path
+        request_args.input_file = None
+        if os.path.isfile(path):
+            request_args.input_dir, request_args.input_file = os.path.split(path)
+        if not sanitize_input_output_dirs(request_args):
+            raise ValueError("Cannot convert '{0}', see the server log".format(path))
+        request_args.journal = JobJournal(None, request_args.input_dir, False)
+        return request_args
+
+    def handle_convert(self, connection, message):
+        try:
+            request_args = self.parse_request(message)
+        except ValueError as e:
+            connection.send({"type": "error", "message": str(e)})
+            return
+        with self.lock:
+            request = DaemonRequest(self.next_request_id, request_args, connection, self.events)
+            self.next_request_id += 1
+            self.requests[request.request_id] = request
+        logging.info("Accepted request %d for '%s'", request.request_id, message["path"])
+        request.send({"type": "accepted"})
+        request_args.progress_events = request
+        try:
+            with self.scan_lock:
+                if request_args.decisions:
+                    request_args.decisions.reload()
+                for dir_path, file_names in iter_input_dirs(request_args):
+                    for file_name, track_info in iter_batch_tracks(request_args, dir_path, file_names):
+                        if self.stopped or self.args.shutdown.is_set():
+                            return
+                        self.add_job(request, dir_path, file_name, track_info)
+                if request_args.scan_cache:
+                    request_args.scan_cache.commit()
+        finally:
+            with self.lock:
+                request.scanning = False
+            self.finish_request(request)
+
+    def add_job(self, request, dir_path, file_name, track_info):
+        with self.lock:
+            job = create_encode_job(request.args, self.next_job_id, dir_path, file_name, track_info)
+            if job.output_path in self.output_paths:
+                logging.warning("'%s' is already being converted, skipping", job.simp_input_path)
+                return
+            self.next_job_id += 1
+            self.output_paths.add(job.output_path)
+            self.job_requests[job.job_id] = request
+            request.job_outputs[job.job_id] = job.output_path
+            request.jobs[job.job_id] = "queued"
+        request.send({"type": "job", "job": job.job_id, "input": job.simp_input_path,
+            "output": job.output_path})
+        self.job_queue.put(job)
+
+    def handle_list(self, connection):
+        with self.lock:
+            requests = [request.to_data() for request in self.requests.values()]
+        connection.send({"type": "requests", "requests": requests})
+
+    def handle_connection(self, connection):
+        try:
+            while not self.stopped:
+                try:
+                    message = connection.receive()
+                except ValueError:
+                    connection.send({"type": "error", "message": "Invalid request"})
+                    continue
+                if message is None:
+                    break
+                message_type = message.get("type") if isinstance(message, dict) else None
+                if self.args.shutdown.is_set():
+                    connection.send({"type": "error", "message": "Server is shutting down"})
+                elif message_type == "convert":
+                    self.handle_convert(connection, message)
+                elif message_type == "list":
+                    self.handle_list(connection)
+                else:
+                    connection.send({"type": "error",
+                        "message": "Unknown request type: " + repr(message_type)})
+        except (IOError, OSError, ValueError) as e:
+            logging.debug("Connection to client failed: %s", e)
+        finally:
+            connection.close()
+            with self.lock:
+                self.connections.discard(connection)
+
+    def accept_connections(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except (IOError, OSError):
+                return
+            # Clients may stay quiet while they wait for their videos,
+            # but are dropped when they do not read what we send
+            connection = MessageConnection(sock, None)
+            connection.start_sender(DAEMON_MAX_PENDING_MESSAGES)
+            with self.lock:
+                if self.stopped:
+                    connection.close()
+                    return
+                self.connections.add(connection)
+            start_thread(self.handle_connection, (connection,), "client")
+
+    def iter_jobs(self):
+        # Runs until the server is asked to stop
+        while not self.args.shutdown.is_set():
+            try:
+                yield self.job_queue.get(True, 0.5)
+            except queue.Empty:
+                pass
+
+    def start(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except (IOError, OSError):
+                # Left behind by a server that did not stop cleanly
+                try_delete_file(self.path)
+            else:
+                logging.error("Another server is already listening on '%s'", self.path)
+                return False
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.server.bind(self.path)
+        except (IOError, OSError) as e:
+            logging.error("Cannot listen on '%s': %s", self.path, e)
+            return False
+        self.server.listen(16)
+        logging.info("Waiting for requests on '%s'", self.path)
+        start_thread(self.accept_connections, (), "accept")
+        return True
+
+    def run(self):
+        if not self.start():
+            return
+        try:
+            self.scheduler.run(self.iter_jobs())
+        finally:
+            self.stop()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            connections = list(self.connections)
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self.server.close()
+        try_delete_file(self.path)
+        for connection in connections:
+            connection.close()
 
 
 def sanitize_and_validate_args(args):
+    if not sanitize_secret(args):
+        return False
+    if args.worker:
+        return sanitize_handbrake_path(args)
+    if args.execute_plan and not load_job_plan(args):
+        return False
+    args.input_file = None
+    # The server takes input and output directories with each request
+    if not args.daemon and not sanitize_input_output_dirs(args):
+        return False
+    args.segment_joiner = None
+    if args.split:
+        args.segment_joiner = find_segment_joiner(args.output_format)
+        if not args.segment_joiner:
+            logging.warning("Cannot find ffmpeg%s to join segments, not splitting videos",
+                " or mkvmerge" if args.output_format == "mkv" else "")
+            args.split = None
+    if args.scratch_dir:
+        args.scratch_dir = os.path.abspath(args.scratch_dir)
+        if not os.path.isdir(args.scratch_dir):
+            logging.error("Scratch directory does not exist: '%s'", args.scratch_dir)
+            return False
+        if not os.access(args.scratch_dir, os.W_OK | os.X_OK):
+            logging.error("Cannot write to scratch directory: '%s'", args.scratch_dir)
+            return False
+    return sanitize_handbrake_path(args)
+
+
+def is_loopback_host(host):
+    return host == "localhost" or host == "::1" or host.startswith("127.")
+
+
+def sanitize_secret(args):
+    args.secret = None
+    if args.secret_file:
+        try:
+            with open(args.secret_file, "rb") as f:
+                args.secret = f.read().strip()
+        except IOError as e:
+            logging.error("Cannot read secret file '%s': %s", args.secret_file, e)
+            return False
+        if not args.secret:
+            logging.error("Secret file is empty: '%s'", args.secret_file)
+            return False
+    elif args.serve and not is_loopback_host(args.serve[0]):
+        logging.error("Listening on '%s' requires a shared secret, use --secret-file",
+            args.serve[0])
+        return False
+    return True
+
+
+def sanitize_input_output_dirs(args):
     args.input_dir = os.path.abspath(args.input_dir)
     if not args.output_dir:
         args.output_dir = args.input_dir + DEFAULT_OUTPUT_SUFFIX
@@ -832,6 +5660,10 @@ def sanitize_and_validate_args(args):
     if args.input_dir == args.output_dir:
         logging.error("Input and output directories are the same: '%s'", args.input_dir)
         return False
+    return True
+
+
+def sanitize_handbrake_path(args):
     if args.handbrake_path:
         args.handbrake_path = os.path.abspath(args.handbrake_path)
         if not os.path.isfile(args.handbrake_path):
@@ -869,11 +5701,18 @@ def parse_output_dimensions(value):
 
 def parse_duplicate_action(value):
     value_lower = value.lower()
-    if value_lower not in {"prompt", "skip", "overwrite"}:
+    if value_lower not in {"prompt", "skip", "overwrite", "changed"}:
         arg_error("Invalid duplicate action: " + repr(value))
     return value_lower
 
 
+def parse_job_order(value):
+    value_lower = value.lower()
+    if value_lower not in {"input", "longest", "cost"}:
+        arg_error("Invalid job order: " + repr(value))
+    return value_lower
+
+
 def parse_language_list(value):
     language_list = value.split(",")
     for language in language_list:
@@ -887,6 +5726,124 @@ def parse_language_list(value):
     return language_list
 
 
+def parse_job_count(value):
+    try:
+        job_count = int(value)
+    except ValueError:
+        job_count = 0
+    if job_count < 1:
+        arg_error("Invalid job count: " + repr(value))
+    return job_count
+
+
+def parse_segment_count(value):
+    try:
+        segment_count = int(value)
+    except ValueError:
+        segment_count = 0
+    if segment_count < 2:
+        arg_error("Invalid segment count: " + repr(value))
+    return segment_count
+
+
+def parse_size(value):
+    number = value
+    multiplier = 1
+    suffix = value[-1:].upper()
+    if suffix and suffix in "KMGT":
+        number = value[:-1]
+        multiplier = 1024 ** ("KMGT".index(suffix) + 1)
+    try:
+        size = int(float(number) * multiplier)
+    except ValueError:
+        size = 0
+    if size <= 0:
+        arg_error("Invalid size: " + repr(value))
+    return size
+
+
+def parse_encode_job_count(value):
+    if value.lower() == "auto":
+        return "auto"
+    return parse_job_count(value)
+
+
+def parse_interval(value):
+    try:
+        interval = float(value)
+    except ValueError:
+        interval = -1
+    if interval < 0:
+        arg_error("Invalid interval: " + repr(value))
+    return interval
+
+
+def parse_address(value, default_host=None):
+    host, _, port = value.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        port = -1
+    if not 0 <= port <= 65535:
+        arg_error("Invalid port: " + repr(value))
+    if not host:
+        if default_host is None:
+            arg_error("Missing host name: " + repr(value))
+        host = default_host
+    return (host, port)
+
+
+def parse_serve_address(value):
+    return parse_address(value, "127.0.0.1")
+
+
+def parse_shard(value):
+    index, _, count = value.partition("/")
+    try:
+        index = int(index)
+        count = int(count)
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        arg_error("Invalid shard (must be i/n with 1 <= i <= n): " + repr(value))
+    return (index, count)
+
+
+def parse_nice_level(value):
+    try:
+        level = int(value)
+    except ValueError:
+        level = None
+    if level is None or not -20 <= level <= 19:
+        arg_error("Invalid nice level (must be between -20 and 19): " + repr(value))
+    return level
+
+
+def parse_ionice_class(value):
+    ioprio_class, _, level = value.partition(":")
+    if ioprio_class not in ResourceControl.ioprio_classes:
+        arg_error("Invalid I/O scheduling class: " + repr(value))
+    try:
+        level = int(level or "4")
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 7:
+        arg_error("Invalid I/O priority level (must be between 0 and 7): " + repr(value))
+    if ioprio_class == "idle":
+        level = 0
+    return (ioprio_class, level)
+
+
+def parse_cpu_quota(value):
+    try:
+        quota = float(value)
+    except ValueError:
+        quota = 0
+    if quota <= 0:
+        arg_error("Invalid CPU quota: " + repr(value))
+    return quota
+
+
 def parse_logging_level(value):
     level = getattr(logging, value.upper(), None)
     if level is None:
@@ -912,9 +5869,9 @@ def parse_output_format(value):
     return value
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("input_dir")
+    parser.add_argument("input_dir", nargs="?")
     parser.add_argument("-o", "--output-dir")
     parser.add_argument("-x", "--handbrake-path")
     parser.add_argument("-r", "--recursive-search",
@@ -935,22 +5892,206 @@ def parse_args():
         type=parse_language_list, default=AUDIO_LANGUAGES)
     parser.add_argument("-s", "--subtitle-languages",
         type=parse_language_list, default=SUBTITLE_LANGUAGES)
-    return parser.parse_args()
+    parser.add_argument("--decisions", default=DECISIONS_FILE)
+    parser.add_argument("--import-decisions")
+    parser.add_argument("--export-decisions")
+    parser.add_argument("--non-interactive",
+        action="store_true", default=NON_INTERACTIVE)
+    parser.add_argument("--native-probe",
+        action="store_true", default=NATIVE_PROBE)
+    parser.add_argument("--resume",
+        action="store_true", default=RESUME)
+    parser.add_argument("--no-manifest", dest="write_manifest",
+        action="store_false", default=WRITE_MANIFEST)
+    parser.add_argument("--progress-interval",
+        type=parse_interval, default=PROGRESS_INTERVAL)
+    parser.add_argument("--progress-events", default=PROGRESS_EVENTS_FILE)
+    parser.add_argument("--watch",
+        action="store_true", default=WATCH_INPUT_DIR)
+    parser.add_argument("--eta-history", default=ETA_HISTORY_FILE)
+    parser.add_argument("--trace", default=TRACE_FILE)
+    parser.add_argument("--profile", default=PROFILE_FILE)
+    parser.add_argument("--metrics-json", default=METRICS_JSON_FILE)
+    parser.add_argument("--metrics-prom", default=METRICS_PROM_FILE)
+    parser.add_argument("--jobs",
+        type=parse_encode_job_count, default=ENCODE_JOBS)
+    parser.add_argument("--order",
+        type=parse_job_order, default=JOB_ORDER)
+    parser.add_argument("--split",
+        type=parse_segment_count, default=SPLIT_SEGMENTS)
+    parser.add_argument("--scratch-dir", default=SCRATCH_DIR)
+    parser.add_argument("--stage-ahead",
+        type=parse_job_count, default=SCRATCH_STAGE_AHEAD)
+    parser.add_argument("--scratch-budget",
+        type=parse_size, default=SCRATCH_BUDGET)
+    parser.add_argument("--scan-jobs",
+        type=parse_job_count, default=SCAN_JOBS)
+    parser.add_argument("--scan-cache", default=SCAN_CACHE_FILE)
+    parser.add_argument("--clear-scan-cache", action="store_true")
+    parser.add_argument("--dir-index", default=DIR_INDEX_FILE)
+    parser.add_argument("--pin-cpus",
+        action="store_true", default=PIN_CPUS)
+    parser.add_argument("--nice",
+        type=parse_nice_level, default=NICE_LEVEL)
+    parser.add_argument("--ionice",
+        type=parse_ionice_class, default=IONICE_CLASS)
+    parser.add_argument("--cgroup", default=CGROUP_DIR)
+    parser.add_argument("--cpu-quota",
+        type=parse_cpu_quota, default=CPU_QUOTA)
+    parser.add_argument("--serve",
+        type=parse_serve_address, default=SERVE_ADDRESS)
+    parser.add_argument("--worker",
+        type=parse_address, default=WORKER_ADDRESS)
+    parser.add_argument("--secret-file", default=SECRET_FILE)
+    parser.add_argument("--daemon", default=DAEMON_SOCKET)
+    parser.add_argument("--plan", default=PLAN_FILE)
+    parser.add_argument("--execute-plan", default=EXECUTE_PLAN_FILE)
+    parser.add_argument("--shard",
+        type=parse_shard, default=PLAN_SHARD)
+    args = parser.parse_args(argv)
+    if args.worker and args.serve:
+        parser.error("--serve and --worker cannot be used together")
+    if args.plan and args.execute_plan:
+        parser.error("--plan and --execute-plan cannot be used together")
+    if (args.plan or args.execute_plan) and (args.worker or args.watch):
+        parser.error("plans cannot be used with --worker or --watch")
+    if args.plan and args.serve:
+        parser.error("--plan and --serve cannot be used together")
+    if args.shard and not args.execute_plan:
+        parser.error("--shard requires --execute-plan")
+    if args.daemon and (args.serve or args.worker or args.watch or args.plan or args.execute_plan):
+        parser.error("--daemon cannot be used with --serve, --worker, --watch or plans")
+    if args.daemon and not hasattr(socket, "AF_UNIX"):
+        parser.error("--daemon requires Unix domain sockets")
+    if args.daemon and args.input_dir:
+        parser.error("--daemon takes input directories with each request")
+    if not args.input_dir and not (args.worker or args.execute_plan or args.daemon):
+        parser.error("the input directory is required")
+    if args.cpu_quota and not args.cgroup:
+        parser.error("--cpu-quota requires --cgroup")
+    args.auto_jobs = args.jobs == "auto"
+    if args.auto_jobs:
+        if args.pin_cpus:
+            parser.error("--pin-cpus cannot be used with --jobs auto")
+        args.jobs = get_cpu_count()
+    return args
+
+
+def handle_shutdown_signal(args):
+    def on_signal(signum, frame):
+        if args.shutdown.is_set():
+            raise KeyboardInterrupt()
+        logging.info("Stopping once the videos being converted are done")
+        args.shutdown.set()
+    signal.signal(signal.SIGTERM, on_signal)
+
+
+def run_daemon(args):
+    args.shutdown = threading.Event()
+    handle_shutdown_signal(args)
+    # Keep scan results in memory for the life of the server at least
+    if not args.scan_cache and sqlite3 is not None:
+        args.scan_cache = ":memory:"
+    args.scan_cache = open_scan_cache(args)
+    args.dir_index = None
+    args.decisions = open_track_decisions(args)
+    args.non_interactive = True
+    args.resume = False
+    args.journal = None
+    # Requests have their own output directories
+    args.manifest = None
+    args.progress_events = open_progress_events(args)
+    args.metrics = RunMetrics(args.metrics_json, args.metrics_prom)
+    args.estimator = open_run_estimator(args)
+    try:
+        ConversionDaemon(args).run()
+    finally:
+        if args.scan_cache:
+            args.scan_cache.close()
+        if args.decisions:
+            close_track_decisions(args)
+        if args.progress_events:
+            args.progress_events.close()
+        args.metrics.close()
+        if args.estimator:
+            args.estimator.close()
+
+
+def run_conversion(args):
+    args.shutdown = threading.Event()
+    if args.watch:
+        handle_shutdown_signal(args)
+    args.scan_cache = open_scan_cache(args)
+    args.dir_index = open_dir_index(args)
+    args.decisions = open_track_decisions(args)
+    if args.plan:
+        # Nothing is converted, so there is nothing to resume
+        args.journal = JobJournal(None, args.input_dir, False)
+    else:
+        args.journal = open_job_journal(args)
+    args.manifest = open_output_manifest(args)
+    args.progress_events = open_progress_events(args)
+    args.metrics = RunMetrics(args.metrics_json, args.metrics_prom)
+    args.estimator = open_run_estimator(args)
+    tracer = None
+    if args.trace or args.profile:
+        tracer = Tracer(args.trace, args.profile)
+        tracer.attach()
+    completed = False
+    try:
+        if args.plan:
+            write_job_plan(args, iter_jobs(args))
+        else:
+            if args.serve:
+                scheduler = JobCoordinator(args)
+            else:
+                scheduler = EncodeScheduler(args)
+            scheduler.run(generate_jobs(args))
+        # Videos may have been left in the queue by a shutdown
+        completed = not args.shutdown.is_set()
+    finally:
+        if args.scan_cache:
+            args.scan_cache.close()
+        if args.dir_index:
+            args.dir_index.close()
+        if args.decisions:
+            close_track_decisions(args)
+        # Keep the journal around if the run was interrupted
+        args.journal.close(completed)
+        if args.manifest:
+            args.manifest.close()
+        if args.progress_events:
+            args.progress_events.close()
+        if not args.plan:
+            args.metrics.close()
+        if args.estimator:
+            args.estimator.close()
+        if tracer:
+            tracer.close()
 
 
 def main():
     args = parse_args()
     logging.basicConfig(format=LOGGING_FORMAT, level=args.logging_level, stream=sys.stdout)
     if not sanitize_and_validate_args(args):
-        return
-    batches = generate_batches(args)
-    for batch in batches:
-        execute_batch(args, batch)
+        return 1
+    args.resources = open_resource_control(args)
+    try:
+        if args.worker:
+            WorkerClient(args).run()
+        elif args.daemon:
+            run_daemon(args)
+        else:
+            run_conversion(args)
+    finally:
+        if args.resources:
+            args.resources.close()
     logging.info("Done!")
+    return 0
 
 
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(main())
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,213 @@
+###############################################################
+# asyncio API for AniConvert, for embedding scanning, track
+# selection and conversion in an asyncio program. HandBrake is
+# run with asyncio.create_subprocess_exec and its output is read
+# without blocking, so a single event loop can drive many scans
+# and conversions at once. Requires Python 3.7 or newer, unlike
+# aniconvert.py itself. Example:
+#
+#   tracks = await scan("episode.mkv")
+#   track_info = await select_tracks(tracks, ["jpn"], ["eng"])
+#   job = create_job("episode.mkv", "episode.mp4", track_info)
+#   async for progress in convert(job):
+#       print(progress)
+#
+# Awaiting convert(job) directly waits for the conversion
+# without following its progress.
+###############################################################
+
+import asyncio
+import logging
+import os
+import re
+import signal
+import subprocess
+
+import aniconvert
+
+# HandBrake ends progress updates with a carriage return only
+LINE_SEPARATOR_PATTERN = re.compile(r"\r\n|\r|\n")
+
+_handbrake_path = None
+
+
+def get_handbrake_path():
+    global _handbrake_path
+    if _handbrake_path is None:
+        _handbrake_path = aniconvert.find_handbrake_executable()
+        if _handbrake_path is None:
+            raise RuntimeError("Could not find executable HandBrakeCLI binary")
+    return _handbrake_path
+
+
+async def iter_output_lines(stream):
+    pending = ""
+    while True:
+        data = await stream.read(64 * 1024)
+        if not data:
+            break
+        lines = LINE_SEPARATOR_PATTERN.split(pending + data.decode("utf-8", "replace"))
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+async def kill_process(process):
+    if process.returncode is None:
+        try:
+            # Not process.kill(), which reaps the child if it already
+            # exited and leaves the asyncio child watcher confused
+            os.kill(process.pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        except ProcessLookupError:
+            pass
+    await process.wait()
+
+
+async def run_handbrake_scan(handbrake_path, input_path):
+    arg_list = aniconvert.get_handbrake_scan_args(handbrake_path, input_path)
+    process = await asyncio.create_subprocess_exec(*arg_list,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    parser = aniconvert.HandBrakeScanParser()
+    try:
+        async for line in iter_output_lines(process.stdout):
+            parser.feed(line)
+            if parser.complete:
+                break
+        if parser.complete:
+            # HandBrake may keep working for a while after printing
+            # the track lists, but we have everything we need
+            logging.debug("Scan output complete, stopping HandBrake")
+            await kill_process(process)
+        else:
+            await process.wait()
+    except BaseException:
+        await kill_process(process)
+        raise
+    if process.returncode != 0 and not parser.complete:
+        raise subprocess.CalledProcessError(process.returncode, arg_list)
+    return parser.get_result()
+
+
+async def scan(input_path, handbrake_path=None, scan_cache=None, native_probe=False):
+    loop = asyncio.get_running_loop()
+    if native_probe:
+        track_info = await loop.run_in_executor(None,
+            aniconvert.probe_container_tracks, input_path)
+        if track_info:
+            logging.debug("Read tracks of '%s' from container header", input_path)
+            return track_info
+    handbrake_path = handbrake_path or get_handbrake_path()
+    if not scan_cache:
+        return await run_handbrake_scan(handbrake_path, input_path)
+    # Looking up the cache reads samples of the file to fingerprint it
+    fingerprint, stat, data = await loop.run_in_executor(None, scan_cache.lookup, input_path)
+    if data is not None:
+        logging.debug("Using cached scan results for '%s'", input_path)
+        return (aniconvert.tracks_from_data(data["audio"], aniconvert.HandBrakeAudioInfo),
+                aniconvert.tracks_from_data(data["subtitle"], aniconvert.HandBrakeSubtitleInfo),
+                aniconvert.VideoInfo.from_data(data.get("video")))
+    audio_tracks, subtitle_tracks, video_info = await run_handbrake_scan(handbrake_path, input_path)
+    scan_cache.store(input_path, fingerprint, stat, {
+        "audio": aniconvert.tracks_to_data(audio_tracks),
+        "subtitle": aniconvert.tracks_to_data(subtitle_tracks),
+        "video": video_info.to_data()
+    })
+    return (audio_tracks, subtitle_tracks, video_info)
+
+
+async def select_tracks(tracks, audio_languages=None, subtitle_languages=None,
+        manual_und=False, decisions=None):
+    # Never prompts; raises aniconvert.TrackDecisionNeeded when no track
+    # can be picked and the decision store has no answer either
+    audio_tracks, subtitle_tracks, video_info = tracks
+    audio_track = aniconvert.select_best_track(audio_tracks,
+        audio_languages or aniconvert.AUDIO_LANGUAGES, manual_und,
+        None, "audio", decisions, False)
+    subtitle_track = aniconvert.select_best_track(subtitle_tracks,
+        subtitle_languages or aniconvert.SUBTITLE_LANGUAGES, manual_und,
+        None, "subtitle", decisions, False)
+    return aniconvert.TrackInfo(audio_track, subtitle_track, video_info)
+
+
+def create_job(input_path, output_path, track_info, handbrake_path=None,
+        output_dimensions=None, job_id=None):
+    handbrake_path = handbrake_path or get_handbrake_path()
+    temp_output_path = aniconvert.get_temp_output_path(output_path)
+    handbrake_args = aniconvert.get_handbrake_args(handbrake_path,
+        input_path, temp_output_path, track_info.audio_track,
+        track_info.subtitle_track, output_dimensions or aniconvert.OUTPUT_DIMENSIONS)
+    return aniconvert.EncodeJob(job_id, input_path, output_path, temp_output_path,
+        os.path.basename(input_path), track_info, handbrake_args)
+
+
+class Conversion(object):
+    def __init__(self, job):
+        self.job = job
+        self.progress = None
+        self.updated = False
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    async def run(self):
+        job = self.job
+        aniconvert.try_create_directory(os.path.dirname(job.output_path))
+        logging.debug("HandBrake args: '%s'", subprocess.list2cmdline(job.handbrake_args))
+        parser = aniconvert.HandBrakeProgressParser()
+        try:
+            process = await asyncio.create_subprocess_exec(*job.handbrake_args,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            try:
+                async for line in iter_output_lines(process.stdout):
+                    progress = parser.feed(line)
+                    if progress:
+                        self.progress = progress
+                        self.updated = True
+                        self.changed.set()
+                retcode = await process.wait()
+            except BaseException:
+                await kill_process(process)
+                raise
+            if retcode != 0:
+                raise subprocess.CalledProcessError(retcode, job.handbrake_args)
+            # Only replace the destination once the output is complete
+            aniconvert.replace_file(job.temp_output_path, job.output_path)
+        except BaseException:
+            aniconvert.try_delete_file(job.temp_output_path)
+            raise
+        finally:
+            self.changed.set()
+
+    def __await__(self):
+        return self.start().__await__()
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        # Only the latest update is kept, so a slow consumer skips
+        # updates instead of falling behind
+        while True:
+            if self.updated:
+                self.updated = False
+                return self.progress
+            if self.task.done():
+                self.task.result()
+                raise StopAsyncIteration
+            self.changed.clear()
+            await self.changed.wait()
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+def convert(job):
+    return Conversion(job)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+###############################################################
+# Benchmarks for AniConvert's own overhead. Everything runs
+# offline against synthetic files and the fake HandBrakeCLI in
+# this directory, so the numbers only reflect the time spent
+# in the script itself. Run as:
+#
+#   python benchmark/benchmark.py [--files N] [--only a,b]
+###############################################################
+
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_HANDBRAKE = os.path.join(BENCHMARK_DIR, "fake_handbrake.py")
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import aniconvert
+
+
+def create_tree(root, dir_count, files_per_dir, extension="mkv"):
+    for i in range(dir_count):
+        dir_path = os.path.join(root, "Season {0:03d}".format(i))
+        os.makedirs(dir_path)
+        for j in range(files_per_dir):
+            file_path = os.path.join(dir_path, "Episode {0:03d}.{1}".format(j, extension))
+            open(file_path, "wb").close()
+        # Files that should be ignored
+        open(os.path.join(dir_path, "cover.jpg"), "wb").close()
+
+
+def ebml_element(element_id, data):
+    id_bytes = b""
+    while element_id:
+        id_bytes = struct.pack(">B", element_id & 0xFF) + id_bytes
+        element_id >>= 8
+    return id_bytes + b"\x01" + struct.pack(">Q", len(data))[1:] + data
+
+
+def create_matroska_header(path, audio_languages, subtitle_languages):
+    entries = [ebml_element(0xAE, ebml_element(0x83, b"\x01") + ebml_element(0x86, b"V_MPEG4/ISO/AVC"))]
+    for language in audio_languages:
+        entries.append(ebml_element(0xAE,
+            ebml_element(0x83, b"\x02") +
+            ebml_element(0x86, b"A_AAC") +
+            ebml_element(0x22B59C, language.encode("ascii")) +
+            # Same title and sample rate as the fake scan output
+            ebml_element(0x536E, (aniconvert.LANGUAGE_NAMES[language] + " Audio").encode("ascii")) +
+            ebml_element(0xE1,
+                ebml_element(0xB5, struct.pack(">f", 48000.0)) +
+                ebml_element(0x9F, b"\x02"))))
+    for language in subtitle_languages:
+        entries.append(ebml_element(0xAE,
+            ebml_element(0x83, b"\x11") +
+            ebml_element(0x86, b"S_TEXT/ASS") +
+            ebml_element(0x22B59C, language.encode("ascii"))))
+    segment = ebml_element(0x1654AE6B, b"".join(entries))
+    segment += ebml_element(0x1F43B675, b"\0" * 4096)
+    with open(path, "wb") as f:
+        f.write(ebml_element(0x1A45DFA3, ebml_element(0x4282, b"matroska")))
+        f.write(ebml_element(0x18538067, segment))
+
+
+def get_fake_scan_output(audio_languages, subtitle_languages):
+    env = dict(os.environ)
+    env["FAKE_HANDBRAKE_AUDIO"] = ",".join(audio_languages)
+    env["FAKE_HANDBRAKE_SUBTITLES"] = ",".join(subtitle_languages)
+    output = subprocess.check_output(
+        [sys.executable, FAKE_HANDBRAKE, "-i", "video.mkv", "--scan"], env=env)
+    return output.decode("utf-8")
+
+
+def bench_walk(options, work_dir):
+    root = os.path.join(work_dir, "walk")
+    dir_count = max(options.files // 100, 1)
+    create_tree(root, dir_count, 100)
+    start = time.time()
+    count = 0
+    for dir_path, file_names in aniconvert.get_files_in_dir(root, ["mkv", "mp4"], True):
+        count += len(file_names)
+    return (count, time.time() - start)
+
+
+def bench_filter(options, work_dir):
+    input_dir = os.path.join(work_dir, "filter")
+    dir_count = max(options.files // 100, 1)
+    create_tree(input_dir, dir_count, 100)
+    args = aniconvert.parse_args([input_dir, "-w", "skip"])
+    args.output_dir = input_dir + aniconvert.DEFAULT_OUTPUT_SUFFIX
+    args.journal = aniconvert.JobJournal(os.path.join(work_dir, "journal"), input_dir, False)
+    start = time.time()
+    count = 0
+    for dir_path, file_names in aniconvert.get_files_in_dir(input_dir, ["mkv"], True):
+        count += len(aniconvert.filter_convertible_files(args, dir_path, file_names))
+    elapsed = time.time() - start
+    args.journal.close(True)
+    return (count, elapsed)
+
+
+def bench_parse(options, work_dir):
+    output = get_fake_scan_output(["jpn", "eng"] * 20, ["eng"] * 40)
+    iterations = max(options.files // 10, 1)
+    start = time.time()
+    for _ in range(iterations):
+        aniconvert.parse_handbrake_scan_output(output)
+    return (iterations, time.time() - start)
+
+
+def bench_select(options, work_dir):
+    # Every layout has exactly one preferred track, so no prompts
+    languages = ["jpn", "eng", "fra", "deu", "spa"]
+    layouts = []
+    for count in range(2, 6):
+        layouts.append(aniconvert.parse_handbrake_scan_output(
+            get_fake_scan_output(languages[:count], languages[1:count])))
+    audio_map = {}
+    subtitle_map = {}
+    start = time.time()
+    for i in range(options.files):
+        audio_tracks, subtitle_tracks, _ = layouts[i % len(layouts)]
+        aniconvert.select_best_track_cached(audio_map, audio_tracks,
+            ["jpn"], False, "video.mkv", "audio")
+        aniconvert.select_best_track_cached(subtitle_map, subtitle_tracks,
+            ["eng", "none"], False, "video.mkv", "subtitle")
+    return (options.files, time.time() - start)
+
+
+def bench_probe(options, work_dir):
+    path = os.path.join(work_dir, "probe.mkv")
+    create_matroska_header(path, ["jpn", "eng"], ["eng", "jpn"])
+    iterations = max(options.files // 10, 1)
+    start = time.time()
+    for _ in range(iterations):
+        assert aniconvert.probe_container_tracks(path)
+    return (iterations, time.time() - start)
+
+
+def bench_end_to_end(options, work_dir):
+    input_dir = os.path.join(work_dir, "e2e")
+    file_count = max(options.e2e_files, 1)
+    create_tree(input_dir, max(file_count // 50, 1), min(file_count, 50))
+    command = [
+        sys.executable, os.path.join(os.path.dirname(BENCHMARK_DIR), "aniconvert.py"),
+        input_dir, "-r", "-l", "warning",
+        "-x", FAKE_HANDBRAKE,
+        "--jobs", str(options.jobs),
+        "--scan-jobs", str(options.jobs),
+    ]
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(command, stdout=devnull, stderr=devnull)
+    elapsed = time.time() - start
+    converted = 0
+    for dir_path, dir_names, file_names in os.walk(input_dir + aniconvert.DEFAULT_OUTPUT_SUFFIX):
+        converted += sum(1 for f in file_names if f.endswith(".mp4"))
+    return (converted, elapsed)
+
+
+BENCHMARKS = [
+    ("walk", bench_walk),
+    ("filter", bench_filter),
+    ("parse", bench_parse),
+    ("select", bench_select),
+    ("probe", bench_probe),
+    ("end_to_end", bench_end_to_end),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10000,
+        help="number of synthetic files for the in-process benchmarks")
+    parser.add_argument("--e2e-files", type=int, default=200,
+        help="number of files converted by the end-to-end benchmark")
+    parser.add_argument("--jobs", type=int, default=4,
+        help="scan and encode jobs for the end-to-end benchmark")
+    parser.add_argument("--only",
+        help="comma separated list of benchmarks to run")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    selected = options.only.split(",") if options.only else [name for name, _ in BENCHMARKS]
+    print("{0:<12} {1:>8} {2:>10} {3:>12}".format("benchmark", "items", "total", "per item"))
+    for name, func in BENCHMARKS:
+        if name not in selected:
+            continue
+        work_dir = tempfile.mkdtemp(prefix="aniconvert-bench-")
+        try:
+            count, elapsed = func(options, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+        per_item = elapsed / count * 1e6 if count else 0
+        print("{0:<12} {1:>8} {2:>9.3f}s {3:>10.1f}us".format(name, count, elapsed, per_item))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+###############################################################
+# Stand-in for HandBrakeCLI, used to benchmark AniConvert
+# without encoding anything. It prints scan output and encode
+# progress in the same format as the real thing, at a rate
+# controlled by the following environment variables:
+#
+#   FAKE_HANDBRAKE_VERSION      Version string to report
+#   FAKE_HANDBRAKE_AUDIO        Audio track languages, "jpn,eng"
+#   FAKE_HANDBRAKE_SUBTITLES    Subtitle track languages, "eng"
+#   FAKE_HANDBRAKE_DURATION     Video duration in seconds
+#   FAKE_HANDBRAKE_SIZE         Video dimensions, "1280x720"
+#   FAKE_HANDBRAKE_SCAN_TIME    Seconds to spend scanning before
+#                               printing the track lists
+#   FAKE_HANDBRAKE_SCAN_TAIL    Seconds to keep working after
+#                               printing the track lists
+#   FAKE_HANDBRAKE_ENCODE_TIME  Seconds to spend encoding
+#   FAKE_HANDBRAKE_RATE         Progress updates per second
+#   FAKE_HANDBRAKE_OUTPUT_SIZE  Size of the output file in bytes
+#   FAKE_HANDBRAKE_FAIL         Exit with an error if the input
+#                               path contains this string
+###############################################################
+
+from __future__ import print_function
+import os
+import signal
+import sys
+import time
+
+LANGUAGE_NAMES = {
+    "eng": "English",
+    "jpn": "Japanese",
+    "fra": "French",
+    "deu": "German",
+    "spa": "Spanish",
+    "und": "Unknown",
+}
+
+
+def get_env(name, default):
+    return os.environ.get("FAKE_HANDBRAKE_" + name, default)
+
+
+def get_env_list(name, default):
+    value = get_env(name, default)
+    return [item for item in value.split(",") if item]
+
+
+def get_arg(args, *names):
+    for name in names:
+        if name in args:
+            return args[args.index(name) + 1]
+    return None
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "{0:02d}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def print_scan_output(input_path):
+    audio_languages = get_env_list("AUDIO", "jpn,eng")
+    subtitle_languages = get_env_list("SUBTITLES", "eng")
+    duration = float(get_env("DURATION", "1420"))
+    size = get_env("SIZE", "1280x720")
+    print("[00:00:00] hb_init: starting libhb thread")
+    print("HandBrake {0} - Linux x86_64 - https://handbrake.fr".format(get_env("VERSION", "1.3.3")))
+    print("[00:00:00] hb_scan: path={0}, title_index=1".format(input_path))
+    time.sleep(float(get_env("SCAN_TIME", "0")))
+    print("Input #0, matroska,webm, from '{0}':".format(input_path))
+    print("  Metadata:")
+    print("    encoder         : libebml v1.3.0 + libmatroska v1.4.1")
+    print("  Duration: {0}.00, start: 0.000000, bitrate: 2500 kb/s".format(format_duration(duration)))
+    print("    Stream #0.0: Video: h264 (High), yuv420p, {0}, SAR 1:1 DAR 16:9, 23.98 fps".format(size))
+    stream_index = 1
+    for language in audio_languages:
+        print("    Stream #0.{0}({1}): Audio: aac, 48000 Hz, stereo, fltp".format(stream_index, language))
+        print("    Metadata:")
+        print("      title           : {0} Audio".format(LANGUAGE_NAMES.get(language, language)))
+        stream_index += 1
+    for language in subtitle_languages:
+        print("    Stream #0.{0}({1}): Subtitle: ass".format(stream_index, language))
+        stream_index += 1
+    print("    Stream #0.{0}: Attachment: ttf".format(stream_index))
+    print("    Metadata:")
+    print("      filename        : font.ttf")
+    print("[00:00:01] scan: decoding previews for title 1")
+    print("[00:00:01] scan: 10 previews, {0}, 23.976 fps, autocrop = 0/0/0/0".format(size))
+    print("+ title 1:")
+    print("  + stream: {0}".format(input_path))
+    print("  + duration: {0}".format(format_duration(duration)))
+    print("  + size: {0}, pixel aspect: 1/1, display aspect: 1.78, 23.976 fps".format(size))
+    print("  + autocrop: 0/0/0/0")
+    print("  + chapters:")
+    chapter_count = 4
+    for i in range(chapter_count):
+        chapter_duration = format_duration(duration / chapter_count)
+        print("    + {0}: cells 0->0, 0 blocks, duration {1}".format(i + 1, chapter_duration))
+    print("  + audio tracks:")
+    for i, language in enumerate(audio_languages):
+        name = LANGUAGE_NAMES.get(language, "Unknown")
+        print("    + {0}, {1} (AAC LC) (2.0 ch) (iso639-2: {2}), 48000Hz, 160000bps".format(
+            i + 1, name, language))
+    print("  + subtitle tracks:")
+    for i, language in enumerate(subtitle_languages):
+        name = LANGUAGE_NAMES.get(language, "Unknown")
+        print("    + {0}, {1} (iso639-2: {2}) (Text)(SSA)".format(i + 1, name, language))
+    sys.stdout.flush()
+    time.sleep(float(get_env("SCAN_TAIL", "0")))
+    print("HandBrake has exited.")
+
+
+def encode(output_path):
+    encode_time = float(get_env("ENCODE_TIME", "0"))
+    rate = float(get_env("RATE", "4"))
+    step_count = max(int(encode_time * rate), 1)
+    fps = 24.0 * float(get_env("DURATION", "1420")) / max(encode_time, 0.001)
+    with open(output_path, "wb") as f:
+        f.write(b"\0" * int(get_env("OUTPUT_SIZE", "1024")))
+    for step in range(step_count + 1):
+        remaining = encode_time * (step_count - step) / step_count
+        sys.stdout.write(
+            "Encoding: task 1 of 1, {0:.2f} % ({1:.2f} fps, avg {2:.2f} fps, ETA {3})\r".format(
+                100.0 * step / step_count, fps, fps,
+                format_duration(remaining).replace(":", "h", 1).replace(":", "m") + "s"))
+        sys.stdout.flush()
+        if step < step_count:
+            time.sleep(encode_time / step_count)
+    print()
+    print("Encode done!")
+    print("HandBrake has exited.")
+
+
+def main():
+    args = sys.argv[1:]
+    if "--version" in args:
+        print("HandBrake {0}".format(get_env("VERSION", "1.3.3")))
+        return 0
+    input_path = get_arg(args, "-i", "--input")
+    if not input_path:
+        print("Missing input", file=sys.stderr)
+        return 1
+    fail_pattern = get_env("FAIL", "")
+    if fail_pattern and fail_pattern in input_path:
+        print("Cannot open input: {0}".format(input_path))
+        return 2
+    if "--scan" in args:
+        print_scan_output(input_path)
+        return 0
+    output_path = get_arg(args, "-o", "--output")
+    if not output_path:
+        print("Missing output", file=sys.stderr)
+        return 1
+    encode(output_path)
+    return 0
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(130))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(143))
+    sys.exit(main())
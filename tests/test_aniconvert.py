@@ -0,0 +1,919 @@
+###############################################################
+# Tests for AniConvert, run against the fake HandBrakeCLI in the
+# benchmark directory so that nothing is actually encoded. Run
+# from the repository root as:
+#
+#   python -m pytest tests
+###############################################################
+
+import asyncio
+import json
+import os
+import pstats
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(ROOT_DIR, "benchmark")
+ANICONVERT = os.path.join(ROOT_DIR, "aniconvert.py")
+FAKE_HANDBRAKE = os.path.join(BENCHMARK_DIR, "fake_handbrake.py")
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import aniconvert
+import aniconvert_aio
+import benchmark
+
+
+def create_videos(dir_path, names):
+    os.makedirs(dir_path)
+    for name in names:
+        # Distinct contents, so that no two videos share a fingerprint
+        with open(os.path.join(dir_path, name), "w") as f:
+            f.write(name)
+
+
+def start_aniconvert(args, cwd=None, **env_vars):
+    env = dict(os.environ)
+    env.update(env_vars)
+    return subprocess.Popen([sys.executable, ANICONVERT, "-x", FAKE_HANDBRAKE] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+        cwd=cwd, env=env)
+
+
+def run_aniconvert(args, cwd=None, **env_vars):
+    process = start_aniconvert(args, cwd, **env_vars)
+    output = process.communicate(timeout=60)[0]
+    assert process.returncode == 0, output
+    return output
+
+
+def get_converted(output):
+    return sorted(line.split("'")[1] for line in output.splitlines()
+        if line.startswith("[INFO] Converting '"))
+
+
+def test_scan_parsing(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_HANDBRAKE_AUDIO", "jpn,eng")
+    monkeypatch.setenv("FAKE_HANDBRAKE_SUBTITLES", "eng,fra")
+    monkeypatch.setenv("FAKE_HANDBRAKE_DURATION", "1440")
+    monkeypatch.setenv("FAKE_HANDBRAKE_SIZE", "1920x1080")
+    audio_tracks, subtitle_tracks, video_info = aniconvert.get_track_info(
+        FAKE_HANDBRAKE, str(tmp_path / "video.mkv"))
+    assert [track.language_code for track in audio_tracks] == ["jpn", "eng"]
+    assert audio_tracks[0].description == "Japanese (AAC LC) (2.0 ch)"
+    assert (audio_tracks[0].codec_family, audio_tracks[0].channels) == ("aac", "2.0")
+    assert audio_tracks[0].title == "Japanese Audio"
+    assert (audio_tracks[0].sample_rate, audio_tracks[0].bit_rate) == (48000, 160000)
+    assert [track.language_code for track in subtitle_tracks] == ["eng", "fra"]
+    assert [track.index for track in subtitle_tracks] == [1, 2]
+    assert (video_info.duration, video_info.width, video_info.height) == (1440, 1920, 1080)
+    assert video_info.codec == "h264"
+    assert video_info.chapters == [360] * 4
+
+
+def test_native_probe_matches_scan(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_HANDBRAKE_AUDIO", "jpn,eng")
+    monkeypatch.setenv("FAKE_HANDBRAKE_SUBTITLES", "eng")
+    path = str(tmp_path / "video.mkv")
+    benchmark.create_matroska_header(path, ["jpn", "eng"], ["eng"])
+    probed = aniconvert.probe_container_tracks(path)
+    scanned = aniconvert.get_track_info(FAKE_HANDBRAKE, path)
+    decisions = aniconvert.TrackDecisionStore(None)
+    for track_type, index in (("audio", 0), ("subtitle", 1)):
+        assert probed[index] == scanned[index]
+        assert (decisions.get_fingerprint(probed[index], track_type) ==
+            decisions.get_fingerprint(scanned[index], track_type))
+
+
+@pytest.mark.parametrize("scanned, probed", [
+    ("1, English (E-AC3) (5.1 ch) (iso639-2: eng), 48000Hz, 640000bps",
+        "1, English (E-AC3) (5.1 ch) (iso639-2: eng), 48000Hz"),
+    ("1, English (DTS-HD MA) (7.1 ch) (iso639-2: eng), 48000Hz, 1509000bps",
+        "1, English (DTS) (7.1 ch) (iso639-2: eng), 48000Hz"),
+    ("2, Japanese (FLAC) (2.0 ch) (Commentary) (iso639-2: jpn), 96000Hz, 0bps",
+        "2, Japanese (FLAC) (2.0 ch) (iso639-2: jpn), 48000Hz"),
+])
+def test_probed_layout_matches_handbrake(scanned, probed):
+    scanned_track = aniconvert.HandBrakeAudioInfo(scanned)
+    probed_track = aniconvert.HandBrakeAudioInfo(probed)
+    scanned_track.title = "Surround"
+    assert scanned_track == probed_track
+    assert probed_track != aniconvert.HandBrakeAudioInfo(
+        "1, English (AC3) (5.1 ch) (iso639-2: eng), 48000Hz")
+
+
+def test_resume_skips_converted_videos(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv", "ep03.mkv"])
+    os.makedirs(output_dir)
+    journal_path = os.path.join(output_dir, aniconvert.JOURNAL_FILE_NAME)
+    with open(journal_path, "w") as f:
+        f.write(json.dumps({"input": "ep01.mkv", "state": "done"}) + "\n")
+        f.write(json.dumps({"input": "ep02.mkv", "state": "running"}) + "\n")
+    with open(os.path.join(output_dir, "ep01.mp4"), "w") as f:
+        f.write("converted")
+
+    output = run_aniconvert([input_dir, "-o", output_dir, "--resume"])
+    assert get_converted(output) == ["in/ep02.mkv", "in/ep03.mkv"]
+    with open(os.path.join(output_dir, "ep01.mp4")) as f:
+        assert f.read() == "converted"
+    assert not os.path.exists(journal_path)
+
+
+def test_new_run_moves_journal_aside(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv"])
+    os.makedirs(output_dir)
+    journal_path = os.path.join(output_dir, aniconvert.JOURNAL_FILE_NAME)
+    with open(journal_path, "w") as f:
+        f.write(json.dumps({"input": "ep01.mkv", "state": "running"}) + "\n")
+    output = run_aniconvert([input_dir, "-o", output_dir])
+    assert "--resume" in output
+    assert get_converted(output) == ["in/ep01.mkv", "in/ep02.mkv"]
+    assert not os.path.exists(journal_path)
+    with open(journal_path + ".old") as f:
+        assert "running" in f.read()
+
+
+def test_failed_videos_listed_separately(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    os.makedirs(input_dir)
+    # Probing the header keeps HandBrake from failing the scan too
+    for name in ("ep01.mkv", "ep02.mkv"):
+        benchmark.create_matroska_header(os.path.join(input_dir, name), ["jpn"], ["eng"])
+    journal_path = os.path.join(output_dir, aniconvert.JOURNAL_FILE_NAME)
+    output = run_aniconvert([input_dir, "-o", output_dir, "--native-probe"],
+        FAKE_HANDBRAKE_FAIL="ep02")
+    assert "Error occurred while converting" in output
+    assert not os.path.exists(journal_path)
+    with open(journal_path + "-failed") as f:
+        assert [json.loads(line)["input"] for line in f] == ["ep02.mkv"]
+    # Nothing is left in the way of the next run
+    output = run_aniconvert([input_dir, "-o", output_dir, "--native-probe"])
+    assert get_converted(output) == ["in/ep02.mkv"]
+    assert not os.path.exists(journal_path + "-failed")
+
+
+def test_refusing_to_run_fails(tmp_path):
+    process = start_aniconvert([str(tmp_path / "missing")])
+    process.communicate(timeout=60)
+    assert process.returncode != 0
+
+
+def test_changed_reconverts_modified_videos(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv", "ep03.mkv"])
+    output = run_aniconvert([input_dir, "-o", output_dir])
+    assert len(get_converted(output)) == 3
+
+    with open(os.path.join(input_dir, "ep02.mkv"), "a") as f:
+        f.write("replaced")
+    # Touched, but with the same contents
+    later = time.time() + 60
+    os.utime(os.path.join(input_dir, "ep03.mkv"), (later, later))
+    output = run_aniconvert([input_dir, "-o", output_dir, "-w", "changed"])
+    assert get_converted(output) == ["in/ep02.mkv"]
+
+    output = run_aniconvert([input_dir, "-o", output_dir, "-w", "changed"])
+    assert get_converted(output) == []
+    # Different encode settings change the output
+    output = run_aniconvert([input_dir, "-o", output_dir, "-w", "changed", "-d", "1280x720"])
+    assert len(get_converted(output)) == 3
+
+
+def get_segments(duration, chapters, segment_count):
+    return aniconvert.get_segments(aniconvert.VideoInfo(duration, 1280, 720, None, chapters), segment_count)
+
+
+def test_get_segments_by_chapters():
+    segments = get_segments(3600, [900] * 4, 2)
+    assert [range_args for range_args, _ in segments] == [["--chapters", "1-2"], ["--chapters", "3-4"]]
+    assert [duration for _, duration in segments] == [1800, 1800]
+    # Uneven chapters still give the segments asked for
+    segments = get_segments(3900, [300, 300, 300, 3000], 3)
+    assert len(segments) == 3
+    assert sum(duration for _, duration in segments) == 3900
+
+
+def test_get_segments_by_time():
+    segments = get_segments(3601, None, 4)
+    assert len(segments) == 4
+    assert sum(duration for _, duration in segments) == 3601
+    assert segments[-1][0] == ["--start-at", "seconds:2700"]
+    # Too many segments for the video, none of them past its end
+    segments = get_segments(1200, None, 1000)
+    assert len(segments) == 1200 // aniconvert.SPLIT_MIN_SEGMENT_DURATION
+    for range_args, duration in segments:
+        assert int(range_args[1].split(":")[1]) < 1200
+        assert duration > 0
+
+
+def test_get_segments_not_split():
+    assert get_segments(aniconvert.SPLIT_MIN_DURATION - 1, None, 2) is None
+    assert get_segments(None, None, 2) is None
+    assert get_segments(3600, [3500, 100], 3) is not None
+    assert get_segments(aniconvert.SPLIT_MIN_DURATION, [1, aniconvert.SPLIT_MIN_DURATION - 1], 2)
+
+
+def test_plan_shard_deterministic():
+    entries = [{"input": "video{0:02d}.mkv".format(i), "cost": (i * 37) % 11 or None}
+        for i in range(40)]
+    shuffled = list(entries)
+    random.Random(1).shuffle(shuffled)
+    seen = []
+    for shard_index in range(1, 4):
+        shard, share = aniconvert.get_plan_shard(entries, shard_index, 3)
+        shuffled_shard, shuffled_share = aniconvert.get_plan_shard(shuffled, shard_index, 3)
+        assert sorted(e["input"] for e in shard) == sorted(e["input"] for e in shuffled_shard)
+        assert share == pytest.approx(shuffled_share)
+        assert 0.25 < share < 0.4
+        seen.extend(entry["input"] for entry in shard)
+    assert sorted(seen) == [entry["input"] for entry in entries]
+
+
+def get_free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_coordinator_worker_round_trip(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    secret_path = str(tmp_path / "secret")
+    create_videos(input_dir, ["ep{0:02d}.mkv".format(i) for i in range(1, 6)])
+    with open(secret_path, "w") as f:
+        f.write("hunter2\n")
+    address = "127.0.0.1:{0}".format(get_free_port())
+    coordinator = start_aniconvert([input_dir, "-o", output_dir,
+        "--serve", address, "--secret-file", secret_path])
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", int(address.split(":")[1]))).close()
+                break
+            except socket.error:
+                assert time.time() < deadline, "coordinator did not start"
+                time.sleep(0.1)
+        worker_output = run_aniconvert(["--worker", address, "--secret-file", secret_path,
+            "--jobs", "2"], FAKE_HANDBRAKE_ENCODE_TIME="0.2")
+        output = coordinator.communicate(timeout=60)[0]
+    finally:
+        if coordinator.poll() is None:
+            coordinator.kill()
+    assert coordinator.returncode == 0, output
+    assert len(get_converted(worker_output)) == 5
+    assert "Converted 5 video(s)" in output
+    assert sorted(os.listdir(output_dir)) == sorted(
+        [aniconvert.MANIFEST_FILE_NAME] +
+        ["ep{0:02d}.mp4".format(i) for i in range(1, 6)])
+
+
+def test_worker_checks_coordinator(tmp_path):
+    secret_path = str(tmp_path / "secret")
+    with open(secret_path, "w") as f:
+        f.write("hunter2\n")
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    address = "127.0.0.1:{0}".format(server.getsockname()[1])
+    worker = start_aniconvert(["--worker", address, "--secret-file", secret_path, "--jobs", "1"])
+    try:
+        server.settimeout(30)
+        sock = server.accept()[0]
+        stream = sock.makefile("rw")
+        stream.write(json.dumps({"type": "challenge", "nonce": "abc"}) + "\n")
+        stream.flush()
+        hello = json.loads(stream.readline())
+        assert hello["type"] == "hello" and hello["nonce"]
+        # Accept the worker without knowing the secret
+        stream.write(json.dumps({"type": "ok", "auth": "0" * 64}) + "\n")
+        stream.flush()
+        assert stream.readline() == ""
+        output = worker.communicate(timeout=60)[0]
+    finally:
+        server.close()
+        if worker.poll() is None:
+            worker.kill()
+    assert "failed to authenticate" in output
+
+
+@pytest.mark.skipif(os.name != "posix", reason="needs SIGTERM")
+def test_shutdown_with_full_queue(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    create_videos(input_dir, ["ep{0:02d}.mkv".format(i) for i in range(1, 9)])
+    # Old enough to be converted as soon as watching starts
+    earlier = time.time() - 3600
+    for name in os.listdir(input_dir):
+        os.utime(os.path.join(input_dir, name), (earlier, earlier))
+    process = start_aniconvert([input_dir, "-o", output_dir, "--watch"],
+        FAKE_HANDBRAKE_ENCODE_TIME="2")
+    try:
+        # Long enough for the queue to fill up behind the first video
+        time.sleep(3)
+        process.send_signal(signal.SIGTERM)
+        output = process.communicate(timeout=30)[0]
+    finally:
+        if process.poll() is None:
+            process.kill()
+    assert process.returncode == 0, output
+    assert "Stopping once the videos being converted are done" in output
+    assert 1 <= len(get_converted(output)) < 8
+
+
+def test_metrics(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    json_path = str(tmp_path / "metrics.json")
+    prom_path = str(tmp_path / "metrics.prom")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv"])
+    run_aniconvert([input_dir, "-o", output_dir, "--metrics-json", json_path,
+        "--metrics-prom", prom_path], FAKE_HANDBRAKE_OUTPUT_SIZE="3")
+    with open(json_path) as f:
+        summary = json.load(f)
+    assert (summary["files_done"], summary["files_failed"]) == (2, 0)
+    assert summary["output_bytes"] == 6
+    assert summary["bytes_saved"] == summary["input_bytes"] - 6
+    assert sorted(os.path.basename(job["input_path"]) for job in summary["jobs"]) == [
+        "ep01.mkv", "ep02.mkv"]
+    with open(prom_path) as f:
+        prom = f.read()
+    assert 'aniconvert_files_total{result="done"} 2.0' in prom
+    assert "# TYPE aniconvert_bytes_saved gauge" in prom
+
+
+def test_unwritable_metrics_do_not_stop_run(tmp_path):
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    missing_dir = str(tmp_path / "missing")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv"])
+    output = run_aniconvert([input_dir, "-o", output_dir,
+        "--metrics-json", os.path.join(missing_dir, "m.json"),
+        "--metrics-prom", os.path.join(missing_dir, "m.prom")])
+    assert output.count("Cannot write metrics file") == 2
+    assert get_converted(output) == ["in/ep01.mkv", "in/ep02.mkv"]
+    assert os.path.exists(os.path.join(output_dir, "ep02.mp4"))
+    assert not os.path.exists(os.path.join(output_dir, aniconvert.JOURNAL_FILE_NAME))
+
+
+def test_scan_cache_hits(tmp_path):
+    input_dir = str(tmp_path / "in")
+    cache_path = str(tmp_path / "cache.db")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv"])
+    args = [input_dir, "-o", str(tmp_path / "out"), "--scan-cache", cache_path, "-w", "overwrite"]
+    output = run_aniconvert(args)
+    assert "Scan cache: 0 hit(s), 2 miss(es)" in output
+    # Moved files are still found by their contents
+    os.rename(os.path.join(input_dir, "ep02.mkv"), os.path.join(input_dir, "ep03.mkv"))
+    output = run_aniconvert(args, FAKE_HANDBRAKE_FAIL="mkv")
+    assert "Scan cache: 2 hit(s), 0 miss(es)" in output
+
+
+def test_scan_cache_commits_before_close(monkeypatch, tmp_path):
+    monkeypatch.setattr(aniconvert, "SCAN_CACHE_COMMIT_INTERVAL", 0)
+    video_path = str(tmp_path / "ep01.mkv")
+    cache_path = str(tmp_path / "cache.db")
+    with open(video_path, "w") as f:
+        f.write("ep01")
+    scan_cache = aniconvert.ScanCache(cache_path, "1.0", 10)
+    fingerprint, stat, data = scan_cache.lookup(video_path)
+    assert data is None
+    scan_cache.store(video_path, fingerprint, stat, {"audio": []})
+    # As if the run had been killed here
+    other_cache = aniconvert.ScanCache(cache_path, "1.0", 10)
+    assert other_cache.lookup(video_path)[2] == {"audio": []}
+    other_cache.close()
+    scan_cache.close()
+
+
+class DaemonClient(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(60)
+        self.sock.connect(path)
+        self.stream = self.sock.makefile("r")
+
+    def send(self, message):
+        line = message if isinstance(message, str) else json.dumps(message)
+        self.sock.sendall((line + "\n").encode("utf-8"))
+
+    def receive(self):
+        return json.loads(self.stream.readline())
+
+    def receive_until(self, *message_types):
+        messages = []
+        while not messages or messages[-1]["type"] not in message_types:
+            messages.append(self.receive())
+        return messages
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    path = str(tmp_path / "daemon.sock")
+    process = start_aniconvert(["--daemon", path, "--jobs", "2"])
+    deadline = time.time() + 30
+    while not os.path.exists(path):
+        assert process.poll() is None and time.time() < deadline, "daemon did not start"
+        time.sleep(0.1)
+    yield path, process
+    if process.poll() is None:
+        process.kill()
+        process.communicate()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+def test_daemon_request_finishes(tmp_path, daemon):
+    path, process = daemon
+    input_dir = str(tmp_path / "in")
+    output_dir = str(tmp_path / "out")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv"])
+    client = DaemonClient(path)
+    client.send({"type": "convert", "path": input_dir, "options": {"output_dir": output_dir}})
+    messages = client.receive_until("finished", "error")
+    client.close()
+    assert messages[0]["type"] == "accepted"
+    request_id = messages[0]["request"]
+    assert all(message["request"] == request_id for message in messages)
+    jobs = [message for message in messages if message["type"] == "job"]
+    assert sorted(os.path.basename(job["output"]) for job in jobs) == ["ep01.mp4", "ep02.mp4"]
+    finished = messages[-1]
+    assert (finished["type"], finished["done"], finished["failed"]) == ("finished", 2, 0)
+    assert os.path.exists(os.path.join(output_dir, "ep01.mp4"))
+
+    # Finished requests are no longer listed
+    client = DaemonClient(path)
+    client.send({"type": "list"})
+    assert client.receive()["requests"] == []
+    client.close()
+
+    process.send_signal(signal.SIGTERM)
+    process.communicate(timeout=30)
+    assert not os.path.exists(path)
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+@pytest.mark.parametrize("request_line", [
+    "not json",
+    "[1, 2]",
+    json.dumps({"type": "convert", "path": 5}),
+    json.dumps({"type": "convert", "path": "in", "options": ["eng"]}),
+    json.dumps({"type": "convert", "path": "in", "options": {"output_dir": 5}}),
+    json.dumps({"type": "convert", "path": "in", "options": {"audio_languages": ["eng"]}}),
+    json.dumps({"type": "convert", "path": "in", "options": {"input_formats": 5}}),
+    json.dumps({"type": "convert", "path": "in", "options": {"recursive_search": "yes"}}),
+])
+def test_daemon_rejects_bad_requests(daemon, request_line):
+    path, process = daemon
+    client = DaemonClient(path)
+    client.send(request_line)
+    assert client.receive()["type"] == "error"
+    # The connection is still served
+    client.send({"type": "list"})
+    assert client.receive()["type"] == "requests"
+    client.close()
+    assert process.poll() is None
+
+
+def test_manifest_merges_concurrent_writers(tmp_path):
+    output_dir = str(tmp_path / "out")
+    os.makedirs(output_dir)
+    path = os.path.join(output_dir, aniconvert.MANIFEST_FILE_NAME)
+    manifests = [aniconvert.OutputManifest(path, str(tmp_path), output_dir, "auto")
+        for _ in range(2)]
+    for i, manifest in enumerate(manifests):
+        manifest.update("ep0{0}.mp4".format(i + 1), {"size": i})
+    for manifest in manifests:
+        manifest.close()
+    with open(path) as f:
+        assert sorted(json.load(f)) == ["ep01.mp4", "ep02.mp4"]
+    assert os.listdir(output_dir) == [aniconvert.MANIFEST_FILE_NAME]
+
+
+def test_trace_and_profile(tmp_path):
+    input_dir = str(tmp_path / "in")
+    trace_path = str(tmp_path / "trace.json")
+    profile_path = str(tmp_path / "profile.out")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv"])
+    run_aniconvert([input_dir, "-o", str(tmp_path / "out"), "--jobs", "2",
+        "--trace", trace_path, "--profile", profile_path])
+    with open(trace_path) as f:
+        events = json.load(f)["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    encodes = [span for span in spans if span["name"] == "run_handbrake"]
+    assert sorted(span["args"]["path"] for span in encodes) == ["in/ep01.mkv", "in/ep02.mkv"]
+    assert len([span for span in spans if span["name"] == "run_handbrake_scan"]) == 2
+    assert all(span["dur"] >= 0 for span in spans)
+    # Every span is on a named thread
+    thread_ids = set(event["tid"] for event in events if event["ph"] == "M")
+    assert set(span["tid"] for span in spans) <= thread_ids
+    stats = pstats.Stats(profile_path)
+    assert any(function[2] == "filter_convertible_files" for function in stats.stats)
+
+
+def test_cpu_partitions_follow_numa_nodes(monkeypatch):
+    if not hasattr(os, "sched_getaffinity"):
+        pytest.skip("needs sched_getaffinity")
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(12)))
+    monkeypatch.setattr(aniconvert, "get_numa_nodes", lambda: [list(range(8)), list(range(8, 12))])
+    partitions = aniconvert.get_cpu_partitions(3)
+    assert partitions == [set(range(4)), set(range(4, 8)), set(range(8, 12))]
+    # More jobs than cores share them
+    partitions = aniconvert.get_cpu_partitions(16)
+    assert len(partitions) == 16
+    assert all(len(cpus) == 1 for cpus in partitions)
+
+
+def test_set_encoder_threads():
+    arg_list = ["HandBrakeCLI", "-e", "x264", "-x", "ref=4"]
+    assert aniconvert.set_encoder_threads(arg_list, 4)[-1] == "ref=4:threads=4"
+    assert aniconvert.set_encoder_threads(["-e", "x265"], 2) == ["-e", "x265", "--encopts", "pools=2"]
+    assert aniconvert.set_encoder_threads(["-e", "nvenc_h264"], 2) == ["-e", "nvenc_h264"]
+
+
+@pytest.mark.skipif(not hasattr(os, "getpriority"), reason="needs getpriority")
+def test_resource_control_sets_niceness():
+    args = aniconvert.argparse.Namespace(nice=7, ionice=None, cpu_quota=None,
+        pin_cpus=False, cgroup=None)
+    resources = aniconvert.ResourceControl(args, 1)
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        resources.apply(0, process)
+        assert os.getpriority(os.PRIO_PROCESS, process.pid) == 7
+    finally:
+        process.kill()
+        process.wait()
+        resources.close()
+
+
+class FakeDisplay(object):
+    visible_slots = None
+
+
+def decide_with_fps(controller, fps):
+    controller.samples = [fps] * (aniconvert.AUTO_JOBS_INTERVAL // 2)
+    controller.decide()
+
+
+def test_concurrency_controller_follows_fps(monkeypatch):
+    monkeypatch.setattr(aniconvert, "get_memory_pressure", lambda: None)
+    controller = aniconvert.ConcurrencyController(4, FakeDisplay())
+    decide_with_fps(controller, 100)
+    assert controller.level == 2
+    # Enough of a gain to try one more
+    decide_with_fps(controller, 180)
+    assert controller.level == 3
+    # No gain, so back to the last level that helped
+    decide_with_fps(controller, 181)
+    assert controller.level == 2
+    assert controller.display.visible_slots == 2
+    # and stay there for a while
+    for _ in range(aniconvert.AUTO_JOBS_HOLD_INTERVALS):
+        decide_with_fps(controller, 180)
+        assert controller.level == 2
+    # Too few samples decide nothing
+    controller.samples = [500]
+    controller.decide()
+    assert controller.level == 2
+
+
+def test_concurrency_controller_backs_off_under_pressure(monkeypatch):
+    monkeypatch.setattr(aniconvert, "get_memory_pressure", lambda: "low memory")
+    controller = aniconvert.ConcurrencyController(4, FakeDisplay())
+    controller.level = 3
+    controller.decide()
+    assert controller.level == 2
+    controller.level = 1
+    decide_with_fps(controller, 100)
+    assert controller.level == 1
+
+
+def test_auto_jobs_converts_everything(tmp_path):
+    input_dir = str(tmp_path / "in")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv", "ep03.mkv"])
+    output = run_aniconvert([input_dir, "-o", str(tmp_path / "out"), "--jobs", "auto"])
+    assert "adjusting automatically" in output
+    assert len(get_converted(output)) == 3
+
+
+def create_sort_job(job_id, duration, width=1280, height=720):
+    video_info = aniconvert.VideoInfo(duration, width, height)
+    return aniconvert.argparse.Namespace(job_id=job_id,
+        track_info=aniconvert.TrackInfo(None, None, video_info))
+
+
+def test_sort_jobs():
+    jobs = [
+        create_sort_job(1, 1400),
+        create_sort_job(2, 5400),
+        create_sort_job(3, None),
+        create_sort_job(4, 1400),
+        create_sort_job(5, 3000, 640, 360),
+    ]
+    # Unknown lengths first, then ties in input order
+    assert [job.job_id for job in aniconvert.sort_jobs(jobs, "longest")] == [3, 2, 5, 1, 4]
+    assert [job.job_id for job in aniconvert.sort_jobs(jobs, "cost")] == [3, 2, 1, 4, 5]
+
+
+def test_order_longest_scans_before_converting(tmp_path):
+    input_dir = str(tmp_path / "in")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv", "ep03.mkv"])
+    output = run_aniconvert([input_dir, "-o", str(tmp_path / "out"), "--jobs", "2",
+        "--order", "longest"])
+    lines = output.splitlines()
+    assert "[INFO] Converting 3 video(s), longest first" in lines
+    first_conversion = min(i for i, line in enumerate(lines) if line.startswith("[INFO] Converting '"))
+    last_scan = max(i for i, line in enumerate(lines) if line.startswith("[INFO] Scanning '"))
+    assert last_scan < first_conversion
+
+
+def test_run_estimator_learns_speed(tmp_path):
+    history_path = str(tmp_path / "eta.json")
+    video_info = aniconvert.VideoInfo(1200, 1920, 1080, "h264")
+    estimator = aniconvert.RunEstimator(history_path, "x264", 2)
+    done_job = create_sort_job(1, 1200, 1920, 1080)
+    done_job.track_info.video_info = video_info
+    estimator.add_job(done_job)
+    estimator.job_started(done_job)
+    estimator.job_finished(done_job, "done", 60)
+    estimator.close()
+
+    # A later run with the same settings knows the speed from the start
+    estimator = aniconvert.RunEstimator(history_path, "x264", 2)
+    for job_id in range(2, 6):
+        job = create_sort_job(job_id, 1200, 1920, 1080)
+        job.track_info.video_info = aniconvert.VideoInfo(1200, 1920, 1080, "h264")
+        estimator.add_job(job)
+    estimator.add_job(create_sort_job(6, None))
+    remaining, job_count, unknown = estimator.get_remaining_time()
+    # 4 videos of 60 seconds each, on 2 slots
+    assert remaining == pytest.approx(120)
+    assert (job_count, unknown) == (5, 1)
+    # Other settings start out without an estimate
+    estimator = aniconvert.RunEstimator(history_path, "x265", 2)
+    estimator.add_job(job)
+    assert estimator.get_remaining_time() == (0.0, 1, 1)
+
+
+def test_eta_history_across_runs(tmp_path):
+    input_dir = str(tmp_path / "in")
+    history_path = str(tmp_path / "eta.json")
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv"])
+    args = [input_dir, "-o", str(tmp_path / "out"), "--eta-history", history_path, "-w", "overwrite"]
+    run_aniconvert(args, FAKE_HANDBRAKE_ENCODE_TIME="0.5")
+    with open(history_path) as f:
+        history = json.load(f)
+    assert [entry["count"] for entry in history.values()] == [2]
+    output = run_aniconvert(args, FAKE_HANDBRAKE_ENCODE_TIME="0.5")
+    assert "Estimated time left" in output
+
+
+def test_dir_index_reuses_listings(tmp_path):
+    input_dir = str(tmp_path / "in")
+    season_dir = os.path.join(input_dir, "s1")
+    create_videos(season_dir, ["ep01.mkv", "ep02.mkv", "notes.txt"])
+    index_path = str(tmp_path / "index.json")
+    dir_index = aniconvert.DirectoryIndex(index_path, input_dir)
+    walked = list(aniconvert.get_files_in_dir(input_dir, ["mkv"], True, dir_index))
+    assert walked == list(aniconvert.get_files_in_dir(input_dir, ["mkv"], True))
+    assert walked == [(season_dir, ["ep01.mkv", "ep02.mkv"])]
+    dir_index.close()
+
+    # Unchanged directories are not listed again
+    dir_index = aniconvert.DirectoryIndex(index_path, input_dir)
+    dir_index.entries[season_dir]["files"] = ["cached.mkv"]
+    walked = list(aniconvert.get_files_in_dir(input_dir, ["mkv"], True, dir_index))
+    assert walked == [(season_dir, ["cached.mkv"])]
+    # but changed ones are
+    with open(os.path.join(season_dir, "ep03.mkv"), "w") as f:
+        f.write("ep03")
+    walked = list(aniconvert.get_files_in_dir(input_dir, ["mkv"], True, dir_index))
+    assert walked == [(season_dir, ["ep01.mkv", "ep02.mkv", "ep03.mkv"])]
+
+
+def test_dir_index_skips_settled_dirs(tmp_path):
+    input_dir = str(tmp_path / "in")
+    create_videos(os.path.join(input_dir, "s1"), ["ep01.mkv"])
+    create_videos(os.path.join(input_dir, "s2"), ["ep01.mkv"])
+    args = [input_dir, "-o", str(tmp_path / "out"), "-r", "--dir-index", str(tmp_path / "index.json")]
+    output = run_aniconvert(args)
+    assert len(get_converted(output)) == 2
+    # Settled once a run finds nothing to convert
+    output = run_aniconvert(args)
+    assert get_converted(output) == []
+    output = run_aniconvert(args)
+    assert output.count("Nothing has changed since the last run") == 2
+    with open(os.path.join(input_dir, "s2", "ep02.mkv"), "w") as f:
+        f.write("ep02")
+    output = run_aniconvert(args)
+    assert output.count("Nothing has changed since the last run") == 1
+    assert get_converted(output) == ["in/s2/ep02.mkv"]
+
+
+def test_decisions_for_unattended_runs(tmp_path):
+    input_dir = str(tmp_path / "in")
+    create_videos(os.path.join(input_dir, "s1"), ["ep01.mkv", "ep02.mkv"])
+    create_videos(os.path.join(input_dir, "s2"), ["ep01.mkv"])
+    # Relative to the working directory
+    args = [input_dir, "-o", "out", "-r", "-a", "jpn", "--non-interactive",
+        "--decisions", "decisions.json"]
+    env_vars = {"FAKE_HANDBRAKE_AUDIO": "fra,deu"}
+    output = run_aniconvert(args, str(tmp_path), **env_vars)
+    assert get_converted(output) == []
+    assert "3 video(s) are waiting for a track decision" in output
+
+    # One decision covers the same layout in every directory
+    decisions_path = str(tmp_path / "decisions.json")
+    with open(decisions_path) as f:
+        decisions = json.load(f)
+    [entry] = decisions.values()
+    assert entry["type"] == "audio" and len(entry["unresolved"]) == 3
+    entry["selected"] = 2
+    with open(decisions_path, "w") as f:
+        json.dump(decisions, f)
+    output = run_aniconvert(args + ["-l", "debug"], str(tmp_path), **env_vars)
+    assert get_converted(output) == ["in/s1/ep01.mkv", "in/s1/ep02.mkv", "in/s2/ep01.mkv"]
+    assert output.count("Previously selected audio track #2 with language 'deu'") == 2
+    handbrake_args = [line for line in output.splitlines() if "HandBrake args" in line]
+    assert len(handbrake_args) == 3
+    assert all(" -a 2 " in line for line in handbrake_args)
+    assert "waiting for a track decision" not in output
+
+
+def test_decisions_export_and_import(tmp_path):
+    tracks = [aniconvert.HandBrakeAudioInfo("1, French (AAC LC) (2.0 ch) (iso639-2: fra)"),
+        aniconvert.HandBrakeAudioInfo("2, German (AAC LC) (2.0 ch) (iso639-2: deu)")]
+    decisions = aniconvert.TrackDecisionStore(str(tmp_path / "a.json"))
+    decisions.record(tracks, "audio", tracks[1])
+    decisions.export_file(str(tmp_path / "export.json"))
+    other = aniconvert.TrackDecisionStore(str(tmp_path / "b.json"))
+    with pytest.raises(KeyError):
+        other.get_selection(tracks, "audio")
+    other.import_file(str(tmp_path / "export.json"))
+    assert other.get_selection(tracks, "audio") is tracks[1]
+    # Unresolved layouts never replace decisions
+    other.add_unresolved(tracks, "audio", "ep01.mkv")
+    assert other.get_selection(tracks, "audio") is tracks[1]
+    assert aniconvert.TrackDecisionStore(str(tmp_path / "b.json")).get_unresolved_count() == 0
+
+
+def wait_until(predicate, timeout=30):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def create_stage_job(tmp_path, job_id, size):
+    input_path = str(tmp_path / "ep{0:02d}.mkv".format(job_id))
+    with open(input_path, "wb") as f:
+        f.write(b"\0" * size)
+    output_path = str(tmp_path / "ep{0:02d}.mp4".format(job_id))
+    return aniconvert.argparse.Namespace(job_id=job_id, input_path=input_path,
+        output_path=output_path, temp_output_path=aniconvert.get_temp_output_path(output_path),
+        simp_input_path=os.path.basename(input_path))
+
+
+def test_scratch_stager_budget(tmp_path):
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+    # Every staged video reserves twice its size, for its output
+    stager = aniconvert.ScratchStager(str(scratch_dir), 3, 450)
+    jobs = [create_stage_job(tmp_path, job_id, 100) for job_id in (1, 2, 3)]
+    too_big = create_stage_job(tmp_path, 4, 300)
+    stager.start()
+    try:
+        for job in jobs + [too_big]:
+            stager.add_job(job)
+        wait_until(lambda: len(stager.staged) == 2)
+        time.sleep(0.2)
+        assert sorted(stager.staged) == [1, 2]
+        assert stager.used_bytes == 400
+
+        handbrake_args = ["HandBrakeCLI", "-i", jobs[0].input_path, "-o", jobs[0].temp_output_path]
+        staged_job, staged_args = stager.start_job(jobs[0], handbrake_args)
+        assert staged_args[2] == staged_job.input_path
+        assert os.path.dirname(staged_args[4]) == stager.scratch_dir
+        with open(staged_job.output_path, "wb") as f:
+            f.write(b"converted")
+
+        # The output keeps its half of the budget until it is moved
+        moving = aniconvert.threading.Event()
+        release = aniconvert.threading.Event()
+        moved = []
+
+        def on_moved(success):
+            moved.append(success)
+            moving.set()
+            release.wait(30)
+
+        stager.finish_job(staged_job, on_moved)
+        assert not os.path.exists(staged_job.input_path)
+        assert moving.wait(30)
+        assert stager.used_bytes == 300
+        assert 3 not in stager.staged
+        release.set()
+        wait_until(lambda: 3 in stager.staged)
+        assert moved == [True]
+        with open(jobs[0].output_path, "rb") as f:
+            assert f.read() == b"converted"
+        assert stager.used_bytes == 400
+
+        # A failed conversion frees its whole reservation at once
+        staged_job = stager.start_job(jobs[1], handbrake_args)[0]
+        stager.finish_job(staged_job)
+        wait_until(lambda: 4 in stager.staged)
+        assert stager.used_bytes == 200
+        # and videos larger than the budget are converted in place
+        assert stager.start_job(too_big, handbrake_args) == (None, handbrake_args)
+    finally:
+        stager.close()
+    assert os.listdir(str(scratch_dir)) == []
+
+
+def test_scratch_dir_end_to_end(tmp_path):
+    input_dir = str(tmp_path / "in")
+    scratch_dir = str(tmp_path / "scratch")
+    os.makedirs(scratch_dir)
+    create_videos(input_dir, ["ep01.mkv", "ep02.mkv", "ep03.mkv"])
+    output = run_aniconvert([input_dir, "-o", str(tmp_path / "out"), "--jobs", "2",
+        "--scratch-dir", scratch_dir, "--stage-ahead", "1", "--scratch-budget", "1K"])
+    assert len(get_converted(output)) == 3
+    assert sorted(os.listdir(str(tmp_path / "out"))) == [
+        aniconvert.MANIFEST_FILE_NAME, "ep01.mp4", "ep02.mp4", "ep03.mp4"]
+    assert os.listdir(scratch_dir) == []
+
+
+def create_aio_job(tmp_path, name="ep01"):
+    input_path = str(tmp_path / (name + ".mkv"))
+    with open(input_path, "w") as f:
+        f.write(name)
+
+    async def create():
+        tracks = await aniconvert_aio.scan(input_path, FAKE_HANDBRAKE)
+        track_info = await aniconvert_aio.select_tracks(tracks, ["jpn"], ["eng"])
+        return aniconvert_aio.create_job(input_path, str(tmp_path / "out" / (name + ".mp4")),
+            track_info, FAKE_HANDBRAKE)
+    return asyncio.run(create())
+
+
+def test_aio_convert_progress(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_HANDBRAKE_ENCODE_TIME", "1")
+    job = create_aio_job(tmp_path)
+    assert job.track_info.audio_track.language_code == "jpn"
+
+    async def convert():
+        return [progress.percent async for progress in aniconvert_aio.convert(job)]
+    percents = asyncio.run(convert())
+    assert len(percents) > 1
+    assert percents == sorted(percents) and percents[-1] == 100
+    assert os.path.exists(job.output_path)
+    assert not os.path.exists(job.temp_output_path)
+
+
+def test_aio_convert_cancel(monkeypatch, tmp_path):
+    monkeypatch.setenv("FAKE_HANDBRAKE_ENCODE_TIME", "30")
+    job = create_aio_job(tmp_path)
+
+    async def convert_and_cancel():
+        conversion = aniconvert_aio.convert(job)
+        async for progress in conversion:
+            assert os.path.exists(job.temp_output_path)
+            conversion.cancel()
+            break
+        with pytest.raises(asyncio.CancelledError):
+            await conversion
+    start_time = time.time()
+    asyncio.run(convert_and_cancel())
+    assert time.time() - start_time < 10
+    assert not os.path.exists(job.temp_output_path)
+    assert not os.path.exists(job.output_path)
+
+
+def test_aio_convert_failure(monkeypatch, tmp_path):
+    job = create_aio_job(tmp_path, "broken")
+    monkeypatch.setenv("FAKE_HANDBRAKE_FAIL", "broken")
+
+    async def convert():
+        await aniconvert_aio.convert(job)
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(convert())
+    assert not os.path.exists(job.output_path)